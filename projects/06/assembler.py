@@ -1,179 +1,323 @@
-import sys 
-import os 
-
-class AInstruction(object): 
-    def __init__(self, instruction, symbols):
-        addressstr = instruction[1:]
-        try: 
-            address = int(addressstr)
-        except:
-            address = symbols.get(addressstr)
-            if address is None:
-                raise Exception(f"Don't recognise address {addressstr}")
-        
-        self.address = address
-    
-    def get_binary(self):
-        address = "{0:b}".format(self.address).zfill(15)
-        return f"0{address}"
-
-class CInstruction(object):
-    JUMPS = {
-        None: "000",
-        "JGT": "001", 
-        "JEQ": "010", 
-        "JGE": "011",
-        "JLT": "100", 
-        "JNE": "101", 
-        "JLE": "110",
-        "JMP": "111"
-    }
-    DESTS = {
-        None: "000",
-        "M": "001", 
-        "D": "010", 
-        "MD": "011",
-        "A": "100", 
-        "AM": "101", 
-        "AD": "110",
-        "AMD": "111"
-    }
-    OPERATIONS = {
-        "0": "0101010",
-        "1": "0111111",
-        "-1": "0111010",
-        "D": "0001100",
-        "A": "0110000",
-        "M": "1110000",
-        "!D": "0001101",
-        "!A": "0110001",
-        "!M": "1110001",
-        "-D": "0001111",
-        "-A": "0110011",
-        "-M": "1110011",
-        "D+1": "0011111",
-        "A+1": "0110111",
-        "M+1": "1110111",
-        "D-1": "0001110",
-        "A-1": "0110010",
-        "M-1": "1110010",
-        "D+A": "0000010",
-        "D+M": "1000010",
-        "D-A": "0010011",
-        "D-M": "1010011",
-        "A-D": "0000111",
-        "M-D": "1000111",
-        "D&A": "0000000",
-        "D&M": "1000000",
-        "D|A": "0010101",
-        "D|M": "1010101"
-    }
-
-    def __init__(self, instruction):
-        dest_opjump = instruction.split("=")
-        if len(dest_opjump) == 2:
-            self.dest = dest_opjump[0].strip()
-            op_jump = dest_opjump[1].strip()
-        else:
-            self.dest = None
-            op_jump = dest_opjump[0]
-        
-        op_jump = op_jump.split(";")
-        if len(op_jump) == 2:
-            self.jump = op_jump[1].strip()
-            self.operation = op_jump[0].strip()
+import sys
+import os
+import argparse
+from array import array
+from rom import FORMATS, write_rom
+from outliner import Outliner
+
+PREDEFINED_SYMBOLS = {"SCREEN": 16384, "KBD": 24576, "SP": 0, "LCL": 1, "ARG": 2, "THIS": 3, "THAT": 4}
+for i in range(16):
+    PREDEFINED_SYMBOLS[f"R{i}"] = i
+
+VARIABLE_BASE = 16
+MAX_ADDRESS = 0x7FFF
+
+JUMPS = {
+    None: 0b000,
+    "JGT": 0b001,
+    "JEQ": 0b010,
+    "JGE": 0b011,
+    "JLT": 0b100,
+    "JNE": 0b101,
+    "JLE": 0b110,
+    "JMP": 0b111
+}
+DESTS = {
+    None: 0b000,
+    "M": 0b001,
+    "D": 0b010,
+    "MD": 0b011,
+    "A": 0b100,
+    "AM": 0b101,
+    "AD": 0b110,
+    "AMD": 0b111
+}
+OPERATIONS = {
+    "0": 0b0101010,
+    "1": 0b0111111,
+    "-1": 0b0111010,
+    "D": 0b0001100,
+    "A": 0b0110000,
+    "M": 0b1110000,
+    "!D": 0b0001101,
+    "!A": 0b0110001,
+    "!M": 0b1110001,
+    "-D": 0b0001111,
+    "-A": 0b0110011,
+    "-M": 0b1110011,
+    "D+1": 0b0011111,
+    "A+1": 0b0110111,
+    "M+1": 0b1110111,
+    "D-1": 0b0001110,
+    "A-1": 0b0110010,
+    "M-1": 0b1110010,
+    "D+A": 0b0000010,
+    "D+M": 0b1000010,
+    "D-A": 0b0010011,
+    "D-M": 0b1010011,
+    "A-D": 0b0000111,
+    "M-D": 0b1000111,
+    "D&A": 0b0000000,
+    "D&M": 0b1000000,
+    "D|A": 0b0010101,
+    "D|M": 0b1010101,
+    # Commutative spellings accepted by the nand2tetris tools (and emitted
+    # by VMTranslator)
+    "A+D": 0b0000010,
+    "M+D": 0b1000010,
+    "A&D": 0b0000000,
+    "M&D": 0b1000000,
+    "A|D": 0b0010101,
+    "M|D": 0b1010101,
+}
+
+
+def _build_c_instructions():
+    """
+    Precompute the 16 bit word for every dest=comp;jump combination so that
+    encoding a C-instruction is a single dict lookup
+    """
+    table = {}
+    for dest, dest_bits in DESTS.items():
+        for operation, operation_bits in OPERATIONS.items():
+            for jump, jump_bits in JUMPS.items():
+                text = f"{dest}={operation}" if dest else operation
+                if jump:
+                    text = f"{text};{jump}"
+                table[text] = 0b111 << 13 | operation_bits << 6 | dest_bits << 3 | jump_bits
+    return table
+
+C_INSTRUCTIONS = _build_c_instructions()
+
+
+def encode_c_instruction(instruction):
+    word = C_INSTRUCTIONS.get(instruction)
+    if word is None:
+        word = C_INSTRUCTIONS.get(instruction.replace(" ", ""))
+        if word is None:
+            raise Exception(f"Don't recognise instruction {instruction}")
+    return word
+
+
+def clean_lines(lines):
+    """
+    Strip comments and whitespace, dropping empty lines
+    """
+    for line in lines:
+        line = line.split("//")[0].strip()
+        if line:
+            yield line
+
+
+def read_code(lines):
+    """
+    Assembly source lines as the instruction tuples Assembler.feed_code
+    takes, without the comments
+    """
+    code = []
+    for line in clean_lines(lines):
+        if line[0] == "@":
+            code.append(("@", line[1:]))
+        elif line[0] == "(":
+            code.append(("(", line[1:-1]))
         else:
-            self.jump = None
-            self.operation = op_jump[0]
-    
-    def get_operation_binary(self):
+            code.append(("C", encode_c_instruction(line), line))
+    return code
+
+
+class Assembler(object):
+    """
+    Single pass assembler. Forward references are threaded through the
+    output words themselves: the word of each unresolved @symbol holds the
+    position of the previous reference to the same symbol, so the only
+    bookkeeping is one chain head per pending symbol. Chains are patched
+    when the label is declared, and whatever is still pending at the end
+    is allocated as a variable in order of first use. References beyond
+    the reach of a 16 bit chain link (only possible in programs far larger
+    than the 32K ROM) are kept in a per-symbol overflow list.
+
+    With marks=True, every comment is recorded as (address, text) in
+    self.marks, the address being that of the next instruction; this is
+    what VMTranslator builds its source map from.
+    """
+    END_OF_CHAIN = 0xFFFF
+
+    def __init__(self, marks=False):
+        self.symbols = dict(PREDEFINED_SYMBOLS)
+        self.pending = {}
+        self.far_references = {}
+        self.words = array("H")
+        self.marks = [] if marks else None
+        self.outliner = None
+
+    def reserve(self, symbols):
         """
-        Get 7 digit binary number for operation: a c1 c2 c3 c4 c5 c6
+        Take the symbols, in order, as used before anything is fed, so the
+        ones that turn out to be variables are allocated in this order
+        whatever order the code uses them in
         """
-        return CInstruction.OPERATIONS[self.operation]
+        for symbol in symbols:
+            if symbol not in self.symbols:
+                self.pending.setdefault(symbol, self.END_OF_CHAIN)
 
-    def get_dest_binary(self):
+    def outline(self, code, speed):
         """
-        Get 3 digit binary number for destination: d1 d2 d3
+        The code with repeated sequences outlined (see outliner.Outliner),
+        its variables reserved in the order the original code used them
         """
-        return CInstruction.DESTS[self.dest]
-    
-    def get_jump_binary(self):
+        self.outliner = Outliner(code, speed)
+        code = self.outliner.outline()
+        self.reserve(self.outliner.symbols)
+        return code
+
+    def _patch(self, symbol, chain, value):
+        if value > MAX_ADDRESS:
+            raise Exception(f"Address {symbol} out of range")
+        words = self.words
+        for position in self.far_references.pop(symbol, ()):
+            words[position] = value
+        while chain != self.END_OF_CHAIN:
+            next_chain = words[chain]
+            words[chain] = value
+            chain = next_chain
+
+    def label(self, label):
+        address = len(self.words)
+        self.symbols[label] = address
+        chain = self.pending.pop(label, None)
+        if chain is not None:
+            self._patch(label, chain, address)
+
+    def address(self, address):
+        if address.isdigit():
+            value = int(address)
+        else:
+            value = self.symbols.get(address)
+            if value is None:
+                position = len(self.words)
+                chain = self.pending.setdefault(address, self.END_OF_CHAIN)
+                if position < self.END_OF_CHAIN:
+                    self.words.append(chain)
+                    self.pending[address] = position
+                else:
+                    self.words.append(0)
+                    self.far_references.setdefault(address, array("L")).append(position)
+                return
+        if value > MAX_ADDRESS:
+            raise Exception(f"Address {address} out of range")
+        self.words.append(value)
+
+    def compute(self, word):
+        self.words.append(word)
+
+    def feed(self, lines):
+        if self.marks is not None:
+            lines = self._mark_comments(lines)
+        symbols, words = self.symbols, self.words
+        append = words.append
+        for line in clean_lines(lines):
+            first = line[0]
+            if first == "@":
+                address = line[1:]
+                value = symbols.get(address)
+                if value is None or value > MAX_ADDRESS:
+                    self.address(address)
+                else:
+                    append(value)
+            elif first == "(":
+                self.label(line[1:-1])
+            else:
+                append(encode_c_instruction(line))
+
+    def _mark_comments(self, lines):
+        marks, words = self.marks, self.words
+        for line in lines:
+            stripped = line.strip()
+            if stripped.startswith("//"):
+                marks.append((len(words), stripped[2:]))
+            else:
+                yield line
+
+    def feed_code(self, code):
         """
-        Get 3 digit binary number for jump: j1 j2 j3
+        Assemble instruction tuples as VMTranslator's CodeWriter builds
+        them, skipping the text stage: ("@", address), ("(", label) and
+        ("C", word, text); ("//", comment) tuples only count as marks
         """
-        return CInstruction.JUMPS[self.jump]
-
-        
-    def get_binary(self):
-        return f"111{self.get_operation_binary()}{self.get_dest_binary()}{self.get_jump_binary()}"
-
-
-class Instruction(object):
-    def __init__(self, line):
-        self.line = line
-    
-    def get_binary(self, symbols):
-        if self.line.startswith("("):
-            return None
-        if self.line.startswith("@"):
-            instruction = AInstruction(self.line, symbols)
-        else:
-            instruction = CInstruction(self.line)
-        
-        return instruction.get_binary()
+        symbols, words, marks = self.symbols, self.words, self.marks
+        append = words.append
+        for instruction in code:
+            kind = instruction[0]
+            if kind == "C":
+                append(instruction[1])
+            elif kind == "@":
+                address = instruction[1]
+                value = symbols.get(address)
+                if value is None or value > MAX_ADDRESS:
+                    self.address(address)
+                else:
+                    append(value)
+            elif kind == "(":
+                self.label(instruction[1])
+            elif marks is not None:
+                marks.append((len(words), instruction[1]))
 
+    def finish(self):
+        variable = VARIABLE_BASE
+        for symbol, chain in self.pending.items():
+            self._patch(symbol, chain, variable)
+            variable += 1
+        self.pending = {}
+        return self.words
 
-class ASM(object):
-    def __init__(self, filename):
-        self.filename = filename
-        self.symbols = {"SCREEN": 16384, "KBD": 24576, "SP": 0, "LCL": 1, "ARG": 2, "THIS": 3, "THAT": 4}
-        for i in range(16):
-            self.symbols[f"R{i}"] = i
 
-        lines_no_comments = map(lambda x: x.split("//")[0], open(filename).readlines())
-        self.lines = list(filter(lambda x: x != "", map(lambda x: x.strip(" \n"), lines_no_comments)))
+def assemble(lines, outline=None):
+    """
+    Assemble Hack assembly source lines into an array of 16 bit words,
+    outlining repeated sequences first when outline is a speed (see
+    outliner.Outliner)
+    """
+    assembler = Assembler()
+    if outline is None:
+        assembler.feed(lines)
+    else:
+        assembler.feed_code(assembler.outline(read_code(lines), outline))
+    return assembler.finish()
 
+
+class ASM(object):
+    def __init__(self, filename, rom_format="hack", outline=None):
+        self.filename = filename
+        self.rom_format = rom_format
+        self.outline = outline
+        self.outliner = None
         base = os.path.splitext(self.filename)[0]
-        self.hack_filename = f"{base}.hack"
-    
-    def load_labels(self):
-        i = 0
-        for line in self.lines: 
-            if line.startswith("("):
-                # Label
-                self.symbols[line.strip("()")] = i
-            else:
-                i += 1
-        
-    def load_variables(self):
-        symbol_count = 16
-        for line in self.lines:             
-            if line.startswith("@"):
-                try: 
-                    int(line[1:])
-                except:
-                    # Variable
-                    if not line[1:] in self.symbols:
-                        self.symbols[line[1:]] = symbol_count
-                        symbol_count += 1
-        
-    def parse_instructions(self):
-        with open(self.hack_filename, "w+") as f:
-            for line in self.lines:
-                binary = Instruction(line).get_binary(self.symbols)
-                if binary:
-                    f.write(f"{binary}\n")
+        self.hack_filename = f"{base}{FORMATS[rom_format][0]}"
 
     def assemble(self):
-        self.load_labels()
-        self.load_variables()
-        self.parse_instructions()
+        assembler = Assembler()
+        with open(self.filename) as f:
+            if self.outline is None:
+                assembler.feed(f)
+            else:
+                assembler.feed_code(assembler.outline(read_code(f), self.outline))
+        words = assembler.finish()
+        self.outliner = assembler.outliner
+        write_rom(self.hack_filename, words, self.rom_format)
         return self.hack_filename
 
 
-if len(sys.argv) < 2:
-    raise Exception("Expected filename in command line argument")
-assembler = ASM(sys.argv[1])
-assembler.assemble()
-
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Assemble a Hack .asm file")
+    argparser.add_argument("filename")
+    argparser.add_argument("--format", choices=FORMATS, default="hack", dest="rom_format",
+                           help="output format: .hack text, packed 16 bit binary (.bin little endian, "
+                                ".binbe big endian) or Intel HEX")
+    argparser.add_argument("--outline", nargs="?", type=float, const=0.0, metavar="SPEED",
+                           help="move repeated instruction sequences into subroutines, charging each call site "
+                                "SPEED words per cycle it adds (default 0: smallest ROM)")
+    args = argparser.parse_args()
+    assembler = ASM(args.filename, args.rom_format, args.outline)
+    assembler.assemble()
+    if assembler.outliner:
+        print(assembler.outliner.report())
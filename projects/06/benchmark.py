@@ -0,0 +1,52 @@
+"""
+Time the assembler on the Pong sources, replicated to show how it scales
+with program size. Usage: python benchmark.py [max_factor]
+"""
+import sys
+import os
+import time
+from assembler import assemble, clean_lines
+from rom import format_hack
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PROGRAMS = [os.path.join(HERE, "pong", "Pong.asm"), os.path.join(HERE, "pong", "PongL.asm")]
+
+
+def best_of(function, repeats=3):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def replicate(lines, factor):
+    """
+    Repeat the program body factor times. Label declarations are only kept
+    in the first copy so every jump still targets a valid ROM address
+    """
+    body = [line for line in lines if line[0] != "("]
+    return lines + body * (factor - 1)
+
+
+def benchmark(filename, max_factor):
+    lines = list(clean_lines(open(filename)))
+    print(os.path.basename(filename))
+    print(f"{'factor':>8} {'lines':>10} {'assemble s':>12} {'format s':>10} {'lines/s':>12}")
+    factor = 1
+    while factor <= max_factor:
+        source = replicate(lines, factor)
+        assemble_time = best_of(lambda: assemble(source))
+        words = assemble(source)
+        format_time = best_of(lambda: format_hack(words))
+        rate = len(source) / (assemble_time + format_time)
+        print(f"{factor:>8} {len(source):>10} {assemble_time:>12.4f} {format_time:>10.4f} {rate:>12.0f}")
+        factor *= 2
+
+
+if __name__ == "__main__":
+    max_factor = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    for program in PROGRAMS:
+        benchmark(program, max_factor)
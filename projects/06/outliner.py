@@ -0,0 +1,317 @@
+"""
+Procedural abstraction (outlining) for whole Hack programs. Instruction
+sequences that repeat are found with a suffix array over the program's
+instructions, with every label splitting the program so no sequence can
+be jumped into, and are moved into subroutines at the end of the ROM:
+
+    call site                   routine
+    @$$OUTLINE.n.ret.i          ($$OUTLINE.n)
+    D=A                         @$$OUTLINE.return
+    @$$OUTLINE.n                M=D
+    0;JMP                       <sequence>
+    ($$OUTLINE.n.ret.i)         @$$OUTLINE.return
+                                A=M
+                                0;JMP
+
+Hack has no call instruction, so the return address travels in D and A is
+lost on return: a sequence is only outlined where it starts by loading A,
+sets D before reading it or jumping, and is followed by code that sets A
+before using it. A sequence ending in an unconditional jump never returns,
+and its call sites are just @$$OUTLINE.n, 0;JMP.
+
+Each candidate is charged the call site words and the routine's linkage
+against the words it removes, plus speed words per cycle it adds to every
+call site; speed=0 makes the ROM as small as possible, and larger values
+only outline sequences long enough to be worth the jumps. Candidates are
+taken greedily, ranked by the words they save times their length, which
+keeps short sequences from breaking up the longer ones they overlap.
+"""
+from heapq import heapify, heappop, heappush
+
+ROUTINE = "$$OUTLINE"
+RETURN = f"{ROUTINE}.return"
+D_EQUALS_A = ("C", 0b1110110000010000, "D=A")
+M_EQUALS_D = ("C", 0b1110001100001000, "M=D")
+A_EQUALS_M = ("C", 0b1111110000100000, "A=M")
+JUMP = ("C", 0b1110101010000111, "0;JMP")
+# Words at each call site, cycles each call adds and the routine's own words
+CALL_WORDS, CALL_CYCLES, LINKAGE_WORDS = 4, 9, 5
+TAIL_WORDS, TAIL_CYCLES = 2, 2
+NEVER = 1 << 30
+REPORT_SPEEDS = (0, 0.5, 1, 2, 4)
+
+
+def _reads_d(word):
+    return not word >> 11 & 1                   # zx clear: the ALU's x input is D
+
+
+def _uses_a(word):
+    # y input is A or M, M is written, or A is the jump target
+    return not word >> 9 & 1 or word >> 3 & 1 or word & 0b111
+
+
+def suffix_array(tokens):
+    """
+    Suffix array of a list of ints by prefix doubling, and the rank of
+    each suffix
+    """
+    n = len(tokens)
+    values = {value: rank for rank, value in enumerate(sorted(set(tokens)))}
+    rank = [values[token] for token in tokens]
+    suffixes = sorted(range(n), key=rank.__getitem__)
+    k = 1
+    while k < n:
+        key = [rank[i] * (n + 1) + (rank[i + k] + 1 if i + k < n else 0) for i in range(n)]
+        suffixes.sort(key=key.__getitem__)
+        previous, r = key[suffixes[0]], 0
+        for i in suffixes:
+            if key[i] != previous:
+                previous = key[i]
+                r += 1
+            rank[i] = r
+        if r == n - 1:
+            break
+        k *= 2
+    return suffixes, rank
+
+
+def longest_common_prefixes(tokens, suffixes, rank):
+    """
+    lcp[r] is the length of the prefix suffixes[r] shares with suffixes[r-1]
+    """
+    n = len(tokens)
+    lcp = [0] * n
+    h = 0
+    for i in range(n):
+        r = rank[i]
+        if r == 0:
+            h = 0
+            continue
+        j = suffixes[r - 1]
+        while i + h < n and j + h < n and tokens[i + h] == tokens[j + h]:
+            h += 1
+        lcp[r] = h
+        if h:
+            h -= 1
+    return lcp
+
+
+def repeats(lcp):
+    """
+    (length, first, last) for every group of suffixes[first:last+1] that
+    share a prefix of length, longest shared prefix only
+    """
+    stack = [(0, 0)]
+    for i in range(1, len(lcp) + 1):
+        h = lcp[i] if i < len(lcp) else 0
+        left = i - 1
+        while h < stack[-1][0]:
+            length, left = stack.pop()
+            yield length, left, i - 1
+        if h > stack[-1][0]:
+            stack.append((h, left))
+
+
+class Outliner(object):
+    def __init__(self, code, speed=0.0):
+        """
+        code is a list of instruction tuples as Assembler.feed_code takes
+        them; speed is the ROM words a call site must save for each cycle
+        it adds
+        """
+        self.code = code
+        self.speed = speed
+        self.routines = []
+        self.sites = 0
+        self.symbols = []
+        self.words_before = self.words_after = 0
+
+    def _tokenize(self):
+        """
+        One int per instruction, with a unique negative separator for each
+        label, and the code index of each
+        """
+        ids, seen = {}, set()
+        tokens, where, words = [], [], []
+        separator = -1
+        for index, instruction in enumerate(self.code):
+            kind = instruction[0]
+            if kind == "C":
+                key = instruction[1]
+            elif kind == "@":
+                key = instruction[1]
+                if key not in seen and not key.isdigit():
+                    seen.add(key)
+                    self.symbols.append(key)
+            elif kind == "(":
+                tokens.append(separator)
+                where.append(index)
+                words.append(None)
+                separator -= 1
+                continue
+            else:
+                continue
+            token = ids.get(key)
+            if token is None:
+                token = ids[key] = len(ids)
+            tokens.append(token)
+            where.append(index)
+            words.append(instruction[1] if kind == "C" else None)
+        return tokens, where, words
+
+    def _analyse(self, tokens, words):
+        """
+        For each position: instructions until D is set with nothing
+        reading D or jumping first, whether A is dead there, and the last
+        unconditional jump at or before it since the last label
+        """
+        n = len(tokens)
+        d_set, a_dead = [NEVER] * (n + 1), [True] * (n + 1)
+        for i in range(n - 1, -1, -1):
+            word = words[i]
+            if tokens[i] < 0:
+                a_dead[i] = a_dead[i + 1]
+            elif word is None:
+                d_set[i] = d_set[i + 1] + 1 if d_set[i + 1] < NEVER else NEVER
+            else:
+                if not (_reads_d(word) or word & 0b111):
+                    if word >> 4 & 1:                   # dest D
+                        d_set[i] = 1
+                    elif d_set[i + 1] < NEVER:
+                        d_set[i] = d_set[i + 1] + 1
+                if _uses_a(word):
+                    a_dead[i] = False
+                elif not word >> 5 & 1:                 # dest A
+                    a_dead[i] = a_dead[i + 1]
+        last_jump, jump = [-1] * n, -1
+        for i in range(n):
+            if tokens[i] < 0:
+                jump = -1
+            elif words[i] is not None and words[i] & 0b111 == 0b111:
+                jump = i
+            last_jump[i] = jump
+        return d_set, a_dead, last_jump
+
+    def _score(self, count, length, tail):
+        if tail:
+            return count * (length - TAIL_WORDS - self.speed * TAIL_CYCLES) - length
+        return count * (length - CALL_WORDS - self.speed * CALL_CYCLES) - length - LINKAGE_WORDS
+
+    def _candidates(self, tokens, words, suffixes, lcp, d_set, last_jump):
+        heap = []
+        for length, first, last in repeats(lcp):
+            start = suffixes[first]
+            if words[start] is not None or tokens[start] < 0:
+                continue
+            count = last - first + 1
+            jump = last_jump[start + length - 1]
+            if jump >= start:
+                tail = jump - start + 1
+                score = self._score(count, tail, True)
+                if score > 0:
+                    heap.append((-score * tail, len(heap), first, last, tail, True))
+            if d_set[start] <= length:
+                score = self._score(count, length, False)
+                if score > 0:
+                    heap.append((-score * length, len(heap), first, last, length, False))
+        heapify(heap)
+        return heap
+
+    def _choose(self, tokens, words):
+        """
+        The sequences to outline as (length, tail, starts), best first,
+        taking each one's sites from those no earlier choice covers
+        """
+        if len(tokens) < 2:
+            return []
+        suffixes, rank = suffix_array(tokens)
+        lcp = longest_common_prefixes(tokens, suffixes, rank)
+        d_set, a_dead, last_jump = self._analyse(tokens, words)
+        heap = self._candidates(tokens, words, suffixes, lcp, d_set, last_jump)
+        claimed = bytearray(len(tokens))
+        chosen = []
+        while heap:
+            _, serial, first, last, length, tail = heappop(heap)
+            starts, end = [], -1
+            for start in sorted(suffixes[first:last + 1]):
+                if start < end or any(claimed[start:start + length]):
+                    continue
+                if not tail and not a_dead[start + length]:
+                    continue
+                starts.append(start)
+                end = start + length
+            if len(starts) < 2:
+                continue
+            score = self._score(len(starts), length, tail)
+            if score <= 0:
+                continue
+            if heap and score * length < -heap[0][0]:
+                heappush(heap, (-score * length, serial, first, last, length, tail))
+                continue
+            for start in starts:
+                claimed[start:start + length] = b"\1" * length
+            chosen.append((length, tail, starts))
+        return chosen
+
+    def outline(self):
+        """
+        The program with the chosen sequences replaced by calls and the
+        routines appended
+        """
+        tokens, where, words = self._tokenize()
+        chosen = self._choose(tokens, words)
+        sites, routines = {}, []
+        returns = 0
+        for number, (length, tail, starts) in enumerate(chosen):
+            name = f"{ROUTINE}.{number}"
+            for start in starts:
+                sites[where[start]] = (name, where[start + length - 1], tail)
+            body = [self.code[where[i]] for i in range(starts[0], starts[0] + length)]
+            self.routines.append(name)
+            routines += [("//", name), ("(", name)]
+            if tail:
+                routines += body
+            else:
+                routines += [("@", RETURN), M_EQUALS_D] + body + [("@", RETURN), A_EQUALS_M, JUMP]
+
+        code, i = [], 0
+        while i < len(self.code):
+            site = sites.get(i)
+            if site is None:
+                code.append(self.code[i])
+                i += 1
+                continue
+            name, end, tail = site
+            code += [instruction for instruction in self.code[i:end + 1] if instruction[0] == "//"]
+            if tail:
+                code += [("@", name), JUMP]
+            else:
+                label = f"{name}.ret.{returns}"
+                returns += 1
+                code += [("@", label), D_EQUALS_A, ("@", name), JUMP, ("(", label)]
+            i = end + 1
+        code += routines
+        self.sites = len(sites)
+        self.words_before = sum(1 for instruction in self.code if instruction[0] in "@C")
+        self.words_after = sum(1 for instruction in code if instruction[0] in "@C")
+        return code
+
+    def report(self):
+        saved = self.words_before - self.words_after
+        return (f"Outlined {self.sites} sites into {len(self.routines)} routines: {self.words_before} -> "
+                f"{self.words_after} ROM words ({saved} saved, {saved / max(self.words_before, 1):.1%}); "
+                f"each call adds {CALL_CYCLES} cycles, {TAIL_CYCLES} for a jump to a routine that doesn't return")
+
+
+def outline_report(code, speeds=REPORT_SPEEDS):
+    """
+    Print the ROM words left after outlining code at each speed, with the
+    routines and call sites it takes
+    """
+    print(f"{'speed':>6} {'ROM words':>10} {'saved':>8} {'routines':>9} {'sites':>7}")
+    for speed in speeds:
+        outliner = Outliner(code, speed)
+        outliner.outline()
+        saved = outliner.words_before - outliner.words_after
+        print(f"{speed:>6g} {outliner.words_after:>10} {saved / outliner.words_before:>8.1%} "
+              f"{len(outliner.routines):>9} {outliner.sites:>7}")
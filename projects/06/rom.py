@@ -0,0 +1,168 @@
+"""
+Hack ROM image formats: the textual .hack format, packed 16 bit binary in
+either byte order (.bin little endian, .binbe big endian) and Intel HEX.
+Every formatter builds the whole image in one buffer so it can be written
+with a single call.
+"""
+import sys
+import os
+import mmap
+from array import array
+
+
+def format_hack(words):
+    return "".join(f"{word:016b}\n" for word in words).encode()
+
+
+def _packed(words, byteorder):
+    if byteorder == sys.byteorder:
+        return words.tobytes()
+    swapped = array("H", words)
+    swapped.byteswap()
+    return swapped.tobytes()
+
+
+def format_bin_le(words):
+    return _packed(words, "little")
+
+
+def format_bin_be(words):
+    return _packed(words, "big")
+
+
+def _ihex_record(record_type, address, data):
+    record = bytes([len(data), address >> 8, address & 0xFF, record_type]) + data
+    checksum = -sum(record) & 0xFF
+    return f":{record.hex().upper()}{checksum:02X}\n"
+
+
+def format_ihex(words, record_size=16):
+    """
+    Intel HEX with big-endian words, using extended linear address records
+    for images larger than 64KB
+    """
+    data = _packed(words, "big")
+    records = []
+    segment = 0
+    for offset in range(0, len(data), record_size):
+        if offset >> 16 != segment:
+            segment = offset >> 16
+            records.append(_ihex_record(0x04, 0, segment.to_bytes(2, "big")))
+        records.append(_ihex_record(0x00, offset & 0xFFFF, data[offset:offset + record_size]))
+    records.append(_ihex_record(0x01, 0, b""))
+    return "".join(records).encode()
+
+
+FORMATS = {
+    "hack": (".hack", format_hack),
+    "bin-le": (".bin", format_bin_le),
+    "bin-be": (".binbe", format_bin_be),
+    "ihex": (".hex", format_ihex),
+}
+
+EXTENSIONS = {extension: rom_format for rom_format, (extension, _) in FORMATS.items()}
+
+
+def write_rom(filename, words, rom_format="hack"):
+    _, formatter = FORMATS[rom_format]
+    with open(filename, "wb") as f:
+        f.write(formatter(words))
+
+
+def parse_hack(lines):
+    return array("H", (int(line, 2) for line in map(str.strip, lines) if line))
+
+
+def parse_ihex(lines):
+    data = bytearray()
+    segment = 0
+    for line in map(str.strip, lines):
+        if not line:
+            continue
+        if not line.startswith(":"):
+            raise Exception(f"Don't recognise Intel HEX record {line}")
+        record = bytes.fromhex(line[1:])
+        if sum(record) & 0xFF:
+            raise Exception(f"Bad checksum in Intel HEX record {line}")
+        length, record_type = record[0], record[3]
+        address = segment + (record[1] << 8 | record[2])
+        payload = record[4:4 + length]
+        if record_type == 0x00:
+            if len(data) < address:
+                data.extend(bytes(address - len(data)))
+            data[address:address + length] = payload
+        elif record_type == 0x04:
+            segment = int.from_bytes(payload, "big") << 16
+        elif record_type == 0x01:
+            break
+    words = array("H", bytes(data))
+    if sys.byteorder != "big":
+        words.byteswap()
+    return words
+
+
+class ROMImage(object):
+    """
+    Read-only view of a packed binary ROM image. When the image is in the
+    machine's byte order the words are a memoryview straight onto the
+    mapped file, so opening even a large ROM copies nothing.
+    """
+    def __init__(self, filename, byteorder="little"):
+        self.filename = filename
+        self.file = open(filename, "rb")
+        self.mmap = None
+        if os.fstat(self.file.fileno()).st_size == 0:
+            self.words = array("H")
+            return
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mmap) % 2:
+            self.close()
+            raise Exception(f"ROM image {filename} has an odd number of bytes")
+        if byteorder == sys.byteorder:
+            self.words = memoryview(self.mmap).cast("H")
+        else:
+            self.words = array("H")
+            self.words.frombytes(self.mmap)
+            self.words.byteswap()
+
+    def __len__(self):
+        return len(self.words)
+
+    def __getitem__(self, index):
+        return self.words[index]
+
+    def close(self):
+        if isinstance(self.words, memoryview):
+            self.words.release()
+        if self.mmap is not None:
+            self.mmap.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_rom(filename, rom_format=None):
+    """
+    Load a ROM as a sequence of words, choosing the reader from the format
+    or the file extension. Binary images are memory mapped.
+    """
+    if rom_format is None:
+        extension = os.path.splitext(filename)[1]
+        rom_format = EXTENSIONS.get(extension)
+        if rom_format is None:
+            raise Exception(f"Don't recognise ROM extension {extension}")
+    if rom_format == "hack":
+        with open(filename) as f:
+            return parse_hack(f)
+    if rom_format == "ihex":
+        with open(filename) as f:
+            return parse_ihex(f)
+    if rom_format == "bin-le":
+        return ROMImage(filename, "little")
+    if rom_format == "bin-be":
+        return ROMImage(filename, "big")
+    raise Exception(f"Don't recognise ROM format {rom_format}")
@@ -0,0 +1,252 @@
+"""
+Benchmark suite for the toolchain. Every bundled program is assembled
+(06) or translated (07, 08, and any compiled Jack program under 09-12)
+and measured for throughput, peak memory, ROM size and, for the VM
+programs, the instructions executed to the end of their test. Synthetic
+inputs replicate Pong and StaticsTest to show how the tools scale.
+
+Results are compared with a JSON baseline: ROM size and instruction
+counts must not grow at all, while throughput and memory, which depend
+on the machine and its load, may move by up to --threshold before the
+run fails. Timings in baseline.json are from the machine that saved it.
+"""
+import sys
+import os
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PROJECTS = os.path.dirname(HERE)
+sys.path.insert(0, os.path.join(PROJECTS, "06"))
+sys.path.insert(0, os.path.join(PROJECTS, "VMTranslator"))
+sys.path.insert(0, os.path.join(PROJECTS, "CPUEmulator"))
+sys.path.insert(0, os.path.join(PROJECTS, "VMEmulator"))
+from assembler import assemble, clean_lines
+from VMTranslator import vm2hack
+from Machine import CPU
+from VMEmulator import find_vm_files, test_setup
+
+BASELINE = os.path.join(HERE, "baseline.json")
+ASM_PROGRAMS = [os.path.join("06", "add", "Add.asm"), os.path.join("06", "max", "Max.asm"),
+                os.path.join("06", "rect", "Rect.asm"), os.path.join("06", "pong", "Pong.asm")]
+VM_PROJECTS = ["07", "08", "09", "10", "11", "12"]
+SCALE_ASM = os.path.join("06", "pong", "Pong.asm")
+SCALE_VM = os.path.join("08", "FunctionCalls", "StaticsTest")
+MODES = {
+    "inline": {},
+    "optimized": {"optimize": True},
+    "registers": {"registers": True},
+}
+MAX_CYCLES = 1000000
+BATCH_SECONDS = 0.05
+# metric: (better, exact); exact metrics may not get worse at all
+METRICS = {
+    "lines_per_s": ("higher", False),
+    "peak_kib": ("lower", False),
+    "rom_words": ("lower", True),
+    "cycles": ("lower", True),
+}
+
+
+def best_of(function, repeats):
+    """
+    Seconds per call, the best of repeats batches; small programs are
+    called enough times per batch to take BATCH_SECONDS
+    """
+    function()
+    best = None
+    for _ in range(repeats):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            function()
+            calls += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= BATCH_SECONDS:
+                break
+        best = elapsed / calls if best is None else min(best, elapsed / calls)
+    return best
+
+
+def peak_memory(function):
+    """
+    Peak KiB allocated while function runs
+    """
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1] // 1024
+    finally:
+        tracemalloc.stop()
+
+
+def vm_directories():
+    """
+    Every directory of .vm files in the VM and Jack projects, as the
+    translator's input (the file itself when there is only one)
+    """
+    inputs = []
+    for project in VM_PROJECTS:
+        for directory, _, _ in sorted(os.walk(os.path.join(PROJECTS, project))):
+            files = find_vm_files(directory)
+            if files:
+                inputs.append(files[0] if len(files) == 1 else directory)
+    return sorted(inputs)
+
+
+def replicate_asm(lines, factor):
+    """
+    Repeat the program body factor times, keeping label declarations in
+    the first copy only so every jump still has a target
+    """
+    body = [line for line in lines if line[0] != "("]
+    return lines + body * (factor - 1)
+
+
+def replicate_vm(directory, factor, target):
+    """
+    Copy a program into target with factor-1 renamed copies of every
+    class but Sys, which nothing calls: the same ROM to execute, with
+    factor times the code to translate
+    """
+    for filename in find_vm_files(directory):
+        shutil.copy(filename, target)
+        name = os.path.splitext(os.path.basename(filename))[0]
+        if name == "Sys":
+            continue
+        with open(filename) as f:
+            source = f.read()
+        for copy in range(1, factor):
+            with open(os.path.join(target, f"{name}{copy}.vm"), "w") as f:
+                f.write(source.replace(f"{name}.", f"{name}{copy}."))
+    return target
+
+
+def assembly_results(lines, repeats):
+    seconds = best_of(lambda: assemble(lines), repeats)
+    return {
+        "lines": len(lines),
+        "lines_per_s": round(len(lines) / seconds),
+        "peak_kib": peak_memory(lambda: assemble(lines)),
+        "rom_words": len(assemble(lines)),
+    }
+
+
+def dynamic_count(words, directory):
+    """
+    Instructions executed to the halt, or to the cycle count of the
+    program's test script
+    """
+    ram, _, cycles = test_setup(directory)
+    cpu = CPU(words)
+    for address, value in ram:
+        cpu.poke(address, value)
+    return cpu.run(cycles or MAX_CYCLES)
+
+
+def translation_results(input, repeats, execute=True):
+    files = find_vm_files(input)
+    lines = 0
+    for filename in files:
+        with open(filename) as f:
+            lines += len(list(clean_lines(f)))
+    seconds = best_of(lambda: vm2hack(input), repeats)
+    results = {
+        "lines": lines,
+        "lines_per_s": round(lines / seconds),
+        "peak_kib": peak_memory(lambda: vm2hack(input)),
+    }
+    directory = input if os.path.isdir(input) else os.path.dirname(input)
+    for mode, options in MODES.items():
+        words = vm2hack(input, **options)
+        results[f"{mode}_rom_words"] = len(words)
+        if execute:
+            results[f"{mode}_cycles"] = dynamic_count(words, directory)
+    return results
+
+
+def run_suite(scales, repeats):
+    results = {}
+    for program in ASM_PROGRAMS:
+        with open(os.path.join(PROJECTS, program)) as f:
+            lines = list(clean_lines(f))
+        results[f"asm {program}"] = assembly_results(lines, repeats)
+    for input in vm_directories():
+        results[f"vm {os.path.relpath(input, PROJECTS)}"] = translation_results(input, repeats)
+
+    with open(os.path.join(PROJECTS, SCALE_ASM)) as f:
+        lines = list(clean_lines(f))
+    for factor in scales:
+        results[f"asm {SCALE_ASM} x{factor}"] = assembly_results(replicate_asm(lines, factor), repeats)
+        with tempfile.TemporaryDirectory() as target:
+            input = replicate_vm(os.path.join(PROJECTS, SCALE_VM), factor, target)
+            results[f"vm {SCALE_VM} x{factor}"] = translation_results(input, repeats, execute=False)
+    return results
+
+
+def metric_kind(metric):
+    for name, kind in METRICS.items():
+        if metric.endswith(name):
+            return kind
+    return None
+
+
+def compare(results, baseline, threshold):
+    """
+    (benchmark, metric, baseline, current) for every regression
+    """
+    regressions = []
+    for name, metrics in baseline.items():
+        for metric, old in metrics.items():
+            kind = metric_kind(metric)
+            new = results.get(name, {}).get(metric)
+            if kind is None or new is None:
+                continue
+            better, exact = kind
+            allowed = 0 if exact else threshold
+            if better == "higher" and new < old * (1 - allowed) or better == "lower" and new > old * (1 + allowed):
+                regressions.append((name, metric, old, new))
+    return regressions
+
+
+def report(results, baseline):
+    for name, metrics in results.items():
+        print(name)
+        for metric, value in metrics.items():
+            old = baseline.get(name, {}).get(metric)
+            change = f"{100 * (value - old) / old:+.1f}%" if old else ""
+            print(f"    {metric:<24} {value:>12} {change:>8}")
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Benchmark the assembler and VM translator on every sample program")
+    argparser.add_argument("--baseline", default=BASELINE, help="JSON baseline to compare with and --save to")
+    argparser.add_argument("--save", action="store_true", help="write this run as the new baseline")
+    argparser.add_argument("--threshold", type=float, default=0.5,
+                           help="fraction throughput and memory may get worse before the run fails")
+    argparser.add_argument("--scale", type=int, nargs="*", default=[10],
+                           help="replication factors for the synthetic Pong and StaticsTest inputs")
+    argparser.add_argument("--repeats", type=int, default=5, help="timing runs per measurement (best is kept)")
+    args = argparser.parse_args()
+
+    results = run_suite(args.scale, args.repeats)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    report(results, baseline)
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(), "results": results},
+                      f, indent=1, sort_keys=True)
+            f.write("\n")
+    elif baseline:
+        regressions = compare(results, baseline, args.threshold)
+        for name, metric, old, new in regressions:
+            print(f"REGRESSION {name} {metric}: {old} -> {new}")
+        sys.exit(1 if regressions else 0)
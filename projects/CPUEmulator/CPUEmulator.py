@@ -0,0 +1,99 @@
+"""
+Command line for the headless Hack CPU emulator in Machine.py: run a
+program, optionally under the JIT, tracing, screen capture or snapshots.
+"""
+import sys
+import argparse
+
+from Machine import CPU, load_program, parse_range, resolve_address
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Run a Hack program headless")
+    argparser.add_argument("program", help=".asm, .hack, .bin, .binbe or .hex file")
+    argparser.add_argument("--cycles", type=int, default=1000000, help="cycle budget")
+    argparser.add_argument("--set", action="append", default=[], metavar="ADDRESS=VALUE",
+                           help="initialise a RAM word before running")
+    argparser.add_argument("--dump", action="append", default=[], metavar="START[:END]",
+                           help="RAM range to print at exit")
+    argparser.add_argument("--no-halt", action="store_true", help="keep running through the final halt loop")
+    argparser.add_argument("--jit", action="store_true", help="run compiled basic blocks instead of interpreting")
+    argparser.add_argument("--cache", help="with --jit, directory of compiled blocks reused for the same ROM")
+    argparser.add_argument("--frames", metavar="DIRECTORY", help="capture the screen into this directory while running")
+    argparser.add_argument("--frame-interval", type=int, default=100000, help="cycles between screen captures")
+    argparser.add_argument("--frame-format", choices=("png", "raw"), default="png",
+                           help="a PNG per changed frame, or every frame appended to frames.raw")
+    argparser.add_argument("--compare", metavar="DIRECTORY",
+                           help="with --frames, check the frames against the files of the same name here")
+    argparser.add_argument("--until", metavar="ADDRESS",
+                           help="stop when the PC reaches this ROM address or .asm label (main.main, say)")
+    argparser.add_argument("--restore", metavar="SNAPSHOT", help="start from a saved machine state")
+    argparser.add_argument("--snapshot", metavar="SNAPSHOT", help="save the machine state at exit")
+    argparser.add_argument("--no-rom-hash", action="store_true",
+                           help="with --snapshot, don't record the ROM, so the state can be restored under any ROM")
+    argparser.add_argument("--trace", metavar="FILE",
+                           help="record the last cycles, ROM coverage and watch hits into FILE (list it with Trace.py)")
+    argparser.add_argument("--trace-records", type=int, default=65536, help="with --trace, cycles kept")
+    argparser.add_argument("--watch", action="append", default=[], metavar="ADDRESS[:LOW:HIGH]",
+                           help="trace, logging writes to a RAM word (SP, LCL, ARG...) or only those outside LOW..HIGH")
+    argparser.add_argument("--watch-break", action="store_true", help="stop at the first watch hit")
+    args = argparser.parse_args()
+    tracing = args.trace or args.watch
+    if tracing and args.frames:
+        argparser.error("--trace and --watch can't be combined with --frames")
+
+    if args.jit:
+        from JIT import JITCPU
+        cpu = JITCPU(load_program(args.program), stop_on_halt=not args.no_halt, cache=args.cache)
+    else:
+        cpu = CPU(load_program(args.program), stop_on_halt=not args.no_halt)
+    if args.restore:
+        from Snapshot import Snapshot
+        with Snapshot(args.restore) as snapshot:
+            snapshot.restore(cpu)
+    for assignment in args.set:
+        address, value = assignment.split("=")
+        cpu.poke(int(address), int(value))
+    start = cpu.cycles
+    if tracing:
+        from Trace import Tracer, describe_hit, parse_watch
+        tracer = Tracer(cpu, args.trace_records)
+        for text in args.watch:
+            tracer.watch(*parse_watch(text))
+        tracer.stop_on_watch = args.watch_break
+        until = resolve_address(args.program, args.until) if args.until else None
+        executed = tracer.run(args.cycles, until)
+        if until is not None and cpu.pc != until:
+            print(f"did not reach {args.until}")
+        for hit in tracer.watch_hits():
+            print(describe_hit(hit))
+        covered, words = tracer.coverage()
+        print(f"covered {covered} of {words} ROM words")
+        if args.trace:
+            tracer.write(args.trace)
+    elif args.until:
+        if not cpu.run_to(resolve_address(args.program, args.until), args.cycles):
+            print(f"did not reach {args.until}")
+        executed = cpu.cycles - start
+    elif args.frames:
+        from Screen import record, compare_frames
+        written = record(cpu, args.cycles, args.frame_interval, args.frames, args.frame_format)
+        executed = cpu.cycles - start
+        print(f"wrote {len(written)} frame files to {args.frames}")
+    else:
+        executed = cpu.run(args.cycles)
+    if args.jit:
+        cpu.save()
+    if args.snapshot:
+        from Snapshot import write_snapshot
+        write_snapshot(cpu, args.snapshot, with_rom=not args.no_rom_hash)
+    print(f"executed {executed} cycles{' (halted)' if cpu.halted else ''}, PC={cpu.pc} A={cpu.a} D={cpu.d}")
+    for text in args.dump:
+        start, end = parse_range(text)
+        for address in range(start, end):
+            print(f"RAM[{address}] = {cpu.peek(address)}")
+    if args.frames and args.compare and not args.until:
+        differences = compare_frames(written, args.compare)
+        for name in differences:
+            print(f"frame differs: {name}")
+        sys.exit(1 if differences else 0)
@@ -0,0 +1,254 @@
+"""
+Basic block compiler for the Hack CPU emulator. The ROM is split into
+straight-line blocks that end at a jump instruction or at the next jump
+target, and every block becomes one generated Python function taking
+and returning (A, D) as locals, with A-instructions folded into the
+code as constants. The run loop chains blocks through a dict from start
+address to function, compiling a new block on the spot when control
+reaches an address that is not a known start (a return address read
+from RAM, say).
+
+The generated module is cached on disk as marshalled bytecode keyed by
+a hash of the ROM, so a second run of the same program skips code
+generation and compilation entirely.
+"""
+import sys
+import os
+import hashlib
+import marshal
+
+from Machine import CPU, COMPUTATIONS, JUMPS, HALT_JUMP, alu
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+JUMP_BITS = 0b111
+
+
+def _jit_version():
+    digest = hashlib.sha256(sys.implementation.cache_tag.encode())
+    for module in ("Machine.py", "JIT.py"):
+        with open(os.path.join(HERE, module), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+JIT_VERSION = _jit_version()
+
+
+def is_jump(word):
+    return word & 0x8000 and word & JUMP_BITS
+
+
+def is_halt(rom, address):
+    """
+    The '@here-1, 0;JMP' loop programs end with, as CPU.load spots it
+    """
+    return rom[address] == HALT_JUMP and address and rom[address - 1] == address - 1
+
+
+def find_leaders(rom):
+    """
+    Addresses blocks start at: 0, every address after a jump, and every
+    address an A-instruction loads right before a jump. Targets only
+    known at run time (return addresses read from RAM) get their blocks
+    compiled when first reached
+    """
+    leaders = {0}
+    for address, word in enumerate(rom):
+        if is_jump(word):
+            leaders.add(address + 1)
+            if address and not rom[address - 1] & 0x8000 and rom[address - 1] < len(rom):
+                leaders.add(rom[address - 1])
+    return leaders
+
+
+def block_source(rom, start, leaders, stop_on_halt=True):
+    """
+    Python source for the block at start, and its length. The block runs
+    to its first jump or up to the next leader; A is tracked as a
+    constant while it is known, and only written back at the exits
+    """
+    lines = [f"def b{start}(a, d, ram=ram, alu=alu):"]
+    known = None
+
+    def register_a():
+        return "a" if known is None else str(known)
+
+    address = start
+    end = len(rom)
+    while address < end:
+        if address != start and address in leaders:
+            break
+        word = rom[address]
+        address += 1
+        if not word & 0x8000:
+            known = word
+            continue
+        if stop_on_halt and is_halt(rom, address - 1):
+            lines.append(f"    return {-address}, {register_a()}, d")
+            return "\n".join(lines), address - start
+        bits = word >> 6 & 0b111111
+        y = f"ram[{register_a()}]" if word & 0x1000 else register_a()
+        computation = COMPUTATIONS.get(bits, f"alu(d, y, {bits})").replace("y", y)
+        jump = JUMPS[word & JUMP_BITS]
+        target = register_a()
+        destinations = [dest for bit, dest in ((0b001000, "M"), (0b010000, "D"), (0b100000, "A")) if word & bit]
+        if not jump:
+            if len(destinations) == 1:
+                out = computation
+            elif destinations:
+                lines.append(f"    out = {computation}")
+                out = "out"
+            else:
+                continue
+            if "M" in destinations:
+                lines.append(f"    ram[{register_a()}] = {out}")
+            if "D" in destinations:
+                lines.append(f"    d = {out}")
+            if "A" in destinations:
+                lines.append(f"    a = {out}")
+                known = None
+            continue
+        if destinations or jump != "True" and not computation.isidentifier():
+            lines.append(f"    out = {computation}")
+        elif jump != "True":
+            jump = jump.replace("out", computation)     # D;JGT tests d directly
+        if "M" in destinations:
+            lines.append(f"    ram[{register_a()}] = out")
+        new_a = "out" if "A" in destinations else register_a()
+        new_d = "out" if "D" in destinations else "d"
+        if jump == "True":
+            lines.append(f"    return {target}, {new_a}, {new_d}")
+        else:
+            lines.append(f"    if {jump}:")
+            lines.append(f"        return {target}, {new_a}, {new_d}")
+            lines.append(f"    return {address}, {new_a}, {new_d}")
+        return "\n".join(lines), address - start
+    lines.append(f"    return {address}, {register_a()}, d")
+    return "\n".join(lines), address - start
+
+
+class BlockCache(object):
+    """
+    Compiled block modules on disk, keyed by ROM contents, halt handling,
+    the JIT's own source and the Python version (marshal is version
+    specific)
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(rom, stop_on_halt):
+        digest = hashlib.sha256(f"{JIT_VERSION}\0{int(stop_on_halt)}\0".encode())
+        digest.update(rom.tobytes())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.blocks")
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                return marshal.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, starts, code):
+        path = self._path(key)
+        with open(f"{path}.{os.getpid()}.tmp", "wb") as f:
+            marshal.dump((starts, code), f)
+        os.replace(f"{path}.{os.getpid()}.tmp", path)
+
+
+class JITCPU(CPU):
+    """
+    CPU whose run() executes compiled blocks. Cycle counts stay exact:
+    a block that would overrun the budget is left to the interpreter,
+    and a halt inside a block returns the negated address after it
+    """
+    def __init__(self, rom, stop_on_halt=True, cache=None):
+        self.cache = BlockCache(cache) if cache else None
+        super().__init__(rom, stop_on_halt)
+
+    def load(self, rom):
+        super().load(rom)
+        self.leaders = find_leaders(self.rom)
+        self.namespace = {"ram": self.ram, "alu": alu}
+        self.blocks = {}
+        self.sources = []
+        self.compiled_from_cache = False
+        self.key = self.cache.key(self.rom, self.stop_on_halt) if self.cache else None
+        cached = self.cache.get(self.key) if self.cache else None
+        if cached is not None:
+            starts, code = cached
+            self.compiled_from_cache = True
+        else:
+            starts = sorted(self.leaders)
+            code = self._compile(starts)
+        self._install(starts, code)
+        self.dirty = False
+
+    def _compile(self, starts):
+        sources = []
+        for start in starts:
+            source, length = block_source(self.rom, start, self.leaders, self.stop_on_halt)
+            sources.append(source)
+            sources.append(f"BLOCKS[{start}] = (b{start}, {length})")
+        self.sources += sources
+        return compile("\n".join(sources), "<hack blocks>", "exec")
+
+    def _install(self, starts, code):
+        self.namespace["BLOCKS"] = self.blocks
+        exec(code, self.namespace)
+        self.starts = list(starts)
+
+    def _block(self, pc):
+        """
+        Compile a block starting at an address no known block starts at
+        """
+        if not 0 <= pc < len(self.rom):
+            return None
+        self._install(self.starts + [pc], self._compile([pc]))
+        self.dirty = True
+        return self.blocks[pc]
+
+    def save(self):
+        """
+        Write the blocks back to the cache, including any compiled on the
+        fly during the run
+        """
+        if self.cache and (self.dirty or not self.compiled_from_cache):
+            if self.compiled_from_cache:
+                self.sources = []
+                self._install(self.starts, self._compile(self.starts))
+            self.cache.put(self.key, self.starts, compile("\n".join(self.sources), "<hack blocks>", "exec"))
+            self.dirty = False
+            self.compiled_from_cache = True
+
+    def run(self, cycles, counts=None):
+        if counts is not None:
+            return super().run(cycles, counts)
+        blocks = self.blocks
+        pc, a, d = self.pc, self.a, self.d
+        remaining = cycles
+        while remaining > 0:
+            block = blocks.get(pc)
+            if block is None:
+                block = self._block(pc)
+                if block is None:
+                    break
+            function, length = block
+            if length > remaining:
+                break
+            start = pc
+            pc, a, d = function(a, d)
+            if pc < 0:
+                pc = -pc - 1
+                remaining -= pc - start + 1
+                self.halted = True
+                break
+            remaining -= length
+        self.pc, self.a, self.d = pc, a, d
+        self.cycles += cycles - remaining
+        if remaining and not self.halted:
+            return cycles - remaining + super().run(remaining)
+        return cycles - remaining
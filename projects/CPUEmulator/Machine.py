@@ -0,0 +1,232 @@
+"""
+Headless Hack CPU emulator. The ROM is decoded once: every distinct
+instruction word is compiled into a small Python function taking and
+returning (pc, A, D), so the run loop is a single indexed call per cycle.
+"""
+import sys
+import os
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "06"))
+from assembler import Assembler, assemble
+from rom import load_rom
+
+ROM_SIZE = 0x8000
+RAM_SIZE = 0x10000      # addresses above 32767 are not aliased back onto RAM
+SCREEN = 16384
+KBD = 24576
+HALT_JUMP = 0b1110101010000111   # 0;JMP
+
+COMPUTATIONS = {
+    0b101010: "0",
+    0b111111: "1",
+    0b111010: "0xFFFF",
+    0b001100: "d",
+    0b110000: "y",
+    0b001101: "d ^ 0xFFFF",
+    0b110001: "y ^ 0xFFFF",
+    0b001111: "-d & 0xFFFF",
+    0b110011: "-y & 0xFFFF",
+    0b011111: "(d + 1) & 0xFFFF",
+    0b110111: "(y + 1) & 0xFFFF",
+    0b001110: "(d - 1) & 0xFFFF",
+    0b110010: "(y - 1) & 0xFFFF",
+    0b000010: "(d + y) & 0xFFFF",
+    0b010011: "(d - y) & 0xFFFF",
+    0b000111: "(y - d) & 0xFFFF",
+    0b000000: "d & y",
+    0b010101: "d | y",
+}
+JUMPS = {
+    0b000: None,
+    0b001: "0 < out < 0x8000",
+    0b010: "out == 0",
+    0b011: "out < 0x8000",
+    0b100: "out >= 0x8000",
+    0b101: "out != 0",
+    0b110: "not 0 < out < 0x8000",
+    0b111: "True",
+}
+
+
+class Halt(Exception):
+    """
+    Raised by the final 'loop forever' jump when halting is enabled
+    """
+    def __init__(self, pc):
+        self.pc = pc
+
+
+def alu(x, y, bits):
+    """
+    Hack ALU for comp codes outside the documented table
+    """
+    if bits & 0b100000:
+        x = 0
+    if bits & 0b010000:
+        x ^= 0xFFFF
+    if bits & 0b001000:
+        y = 0
+    if bits & 0b000100:
+        y ^= 0xFFFF
+    out = (x + y) & 0xFFFF if bits & 0b000010 else x & y
+    if bits & 0b000001:
+        out ^= 0xFFFF
+    return out
+
+
+def c_instruction_source(word, name="op"):
+    """
+    Python source for a function executing one C-instruction word
+    """
+    bits = word >> 6 & 0b111111
+    y = "ram[a]" if word & 0x1000 else "a"
+    computation = COMPUTATIONS.get(bits, f"alu(d, y, {bits})").replace("y", y)
+    lines = [f"def {name}(pc, a, d, ram=ram, alu=alu):", f"    out = {computation}"]
+    if word & 0b001000:
+        lines.append("    ram[a] = out")
+    new_a = "out" if word & 0b100000 else "a"
+    new_d = "out" if word & 0b010000 else "d"
+    condition = JUMPS[word & 0b111]
+    if condition == "True":
+        lines.append(f"    return a, {new_a}, {new_d}")
+    else:
+        if condition:
+            lines.append(f"    if {condition}:")
+            lines.append(f"        return a, {new_a}, {new_d}")
+        lines.append(f"    return pc + 1, {new_a}, {new_d}")
+    return "\n".join(lines)
+
+
+def _a_instruction(value):
+    def op(pc, a, d):
+        return pc + 1, value, d
+    return op
+
+
+def _halt(pc, a, d):
+    raise Halt(pc)
+
+
+class CPU(object):
+    def __init__(self, rom, stop_on_halt=True):
+        self.ram = array("H", bytes(2 * RAM_SIZE))
+        self.stop_on_halt = stop_on_halt
+        self.load(rom)
+
+    def load(self, rom):
+        """
+        Decode the ROM into a table of per-instruction functions, padded
+        to the full ROM size with @0 like an unprogrammed ROM
+        """
+        self.rom = array("H", rom)
+        if len(self.rom) > ROM_SIZE:
+            raise Exception(f"Program of {len(self.rom)} instructions does not fit in ROM")
+        compiled = {}
+        namespace = {"ram": self.ram, "alu": alu}
+        ops = []
+        for address, word in enumerate(self.rom):
+            if self.stop_on_halt and word == HALT_JUMP and address and self.rom[address - 1] == address - 1:
+                ops.append(_halt)
+                continue
+            op = compiled.get(word)
+            if op is None:
+                if word & 0x8000:
+                    exec(c_instruction_source(word), namespace)
+                    op = namespace.pop("op")
+                else:
+                    op = _a_instruction(word)
+                compiled[word] = op
+            ops.append(op)
+        ops += [compiled.get(0) or _a_instruction(0)] * (ROM_SIZE - len(ops))
+        self.ops = ops
+        self.reset()
+
+    def reset(self):
+        self.pc = self.a = self.d = 0
+        self.cycles = 0
+        self.halted = False
+
+    def run(self, cycles, counts=None):
+        """
+        Execute up to cycles instructions, stopping early at a halt loop.
+        With counts, a per-address array, each instruction executed is
+        also counted there. Returns the number of instructions executed
+        """
+        ops = self.ops
+        pc, a, d = self.pc, self.a, self.d
+        executed = cycles
+        try:
+            if counts is None:
+                for executed in range(cycles):
+                    pc, a, d = ops[pc](pc, a, d)
+            else:
+                for executed in range(cycles):
+                    counts[pc] += 1
+                    pc, a, d = ops[pc](pc, a, d)
+            executed = cycles
+        except Halt as halt:
+            pc = halt.pc
+            executed += 1
+            self.halted = True
+        self.pc, self.a, self.d = pc, a, d
+        self.cycles += executed
+        return executed
+
+    def run_to(self, address, cycles):
+        """
+        Execute until the PC reaches address, or for at most cycles
+        instructions. Returns whether address was reached
+        """
+        ops = self.ops
+        pc, a, d = self.pc, self.a, self.d
+        executed = 0
+        try:
+            while pc != address and executed < cycles:
+                pc, a, d = ops[pc](pc, a, d)
+                executed += 1
+        except Halt as halt:
+            pc = halt.pc
+            executed += 1
+            self.halted = True
+        self.pc, self.a, self.d = pc, a, d
+        self.cycles += executed
+        return pc == address
+
+    def peek(self, address):
+        value = self.ram[address]
+        return value - 0x10000 if value & 0x8000 else value
+
+    def poke(self, address, value):
+        self.ram[address] = value & 0xFFFF
+
+
+def load_program(filename):
+    """
+    Load a ROM from a .asm source or any of the ROM formats rom.py reads
+    """
+    if os.path.splitext(filename)[1] == ".asm":
+        with open(filename) as f:
+            return assemble(f)
+    return load_rom(filename)
+
+
+def resolve_address(program, text):
+    """
+    A ROM address given as a number, or as a label of an .asm program
+    """
+    if text.isdigit():
+        return int(text)
+    if os.path.splitext(program)[1] == ".asm":
+        assembler = Assembler()
+        with open(program) as f:
+            assembler.feed(f)
+        if text in assembler.symbols:
+            return assembler.symbols[text]
+    raise Exception(f"Don't recognise address {text}")
+
+
+def parse_range(text):
+    start, _, end = text.partition(":")
+    start = int(start)
+    return start, int(end) if end else start + 1
@@ -0,0 +1,265 @@
+"""
+Cycle counting profiler for Hack programs translated from VM code. Every
+instruction executed is counted against its ROM address, and the source
+map turns those counts into cycles per VM function, per VM command and
+per translation template (push constant, call, return, $$CALL...).
+
+Inclusive cycles are exact too: the run loop notes each function entry,
+with the return address the call left in the new frame, and charges a
+function everything from its outermost entry to the return that comes
+back to that address.
+
+Call stacks for flame graphs are sampled from the VM frames in RAM: the
+return address of the frame at LCL points just past the call command
+that made it, so the chain of saved LCLs gives every function on the
+stack. Stacks are sampled every interval cycles (a prime by default, so
+the samples don't lock onto a loop's period) and written in the
+collapsed 'a;b;c count' format that flamegraph.pl and speedscope read.
+"""
+import sys
+import os
+import argparse
+from array import array
+from collections import Counter, defaultdict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "VMTranslator"))
+from Machine import CPU, Halt, ROM_SIZE, SCREEN, parse_range
+from assembler import Assembler
+from rom import load_rom
+from SourceMap import SourceMap, command_type, map_filename, origin_name
+from VMTranslator import vm2hack
+
+LCL = 1
+MAX_DEPTH = 1024
+
+
+def callee(origin):
+    """
+    The function a call command (or the bootstrap) calls, else None
+    """
+    command = origin[2]
+    if command.startswith("call"):
+        return command.split()[1]
+    if command == "init":
+        return "Sys.init"
+    return None
+
+
+class Profiler(object):
+    def __init__(self, words, source_map, interval=97):
+        self.cpu = CPU(words)
+        self.source_map = source_map
+        self.interval = interval
+        self.counts = array("L", bytes(4 * ROM_SIZE))
+        self.stacks = Counter()
+        self.entries = [None] * ROM_SIZE
+        previous = None
+        for start, end, origin in source_map.ranges():
+            if origin[1] and origin[1] != previous:
+                self.entries[start] = origin[1]
+            previous = origin[1]
+        # (function, entry cycle, LCL, return address, caller's LCL) of each call in progress
+        self.frames = []
+        self.active = Counter()
+        self.inclusive_cycles = Counter()
+
+    def stack(self):
+        """
+        Function names from the outermost frame to the code at PC, ending
+        with the template being executed
+        """
+        source_map, ram = self.source_map, self.cpu.ram
+        frames = []
+        lcl = ram[LCL]
+        while len(frames) < MAX_DEPTH and 5 <= lcl < SCREEN:
+            call = source_map.lookup(ram[lcl - 5] - 1)
+            name = callee(call) if call else None
+            if name is None:
+                break
+            frames.append(name)
+            previous = ram[lcl - 4]
+            if previous >= lcl:
+                break
+            lcl = previous
+        frames.reverse()
+        origin = source_map.lookup(self.cpu.pc)
+        if origin is None:
+            return ";".join(frames + ["?"])
+        name = origin_name(origin)
+        if not frames or frames[-1] != name:
+            frames.append(name)
+        template = command_type(origin[2])
+        if template != name:
+            frames.append(template)
+        return ";".join(frames)
+
+    def run(self, cycles):
+        """
+        Run up to cycles instructions, sampling the stack every interval
+        cycles and charging the whole interval to it
+        """
+        cpu, interval, stacks = self.cpu, self.interval, self.stacks
+        executed = 0
+        while executed < cycles and not cpu.halted:
+            stack = self.stack()
+            step = self._run(min(interval, cycles - executed))
+            stacks[stack] += step
+            executed += step
+        return executed
+
+    def _run(self, cycles):
+        """
+        CPU.run with counts, also following calls and returns. A function
+        is entered when the PC reaches its first instruction with LCL
+        moved, since a loop at the top of a function comes back there too
+        """
+        cpu, counts, entries, frames = self.cpu, self.counts, self.entries, self.frames
+        ops, ram = cpu.ops, cpu.ram
+        pc, a, d = cpu.pc, cpu.a, cpu.d
+        ret = frames[-1][3] if frames else -1
+        executed = cycles
+        try:
+            for executed in range(cycles):
+                if pc == ret or entries[pc]:
+                    ret = self._call_or_return(pc, cpu.cycles + executed)
+                counts[pc] += 1
+                pc, a, d = ops[pc](pc, a, d)
+            executed = cycles
+        except Halt as halt:
+            pc = halt.pc
+            executed += 1
+            cpu.halted = True
+        cpu.pc, cpu.a, cpu.d = pc, a, d
+        cpu.cycles += executed
+        return executed
+
+    def _call_or_return(self, pc, cycle):
+        """
+        Push or pop a frame for the PC about to execute, returning the
+        address the innermost call returns to. A return address can also
+        be a function's first instruction (the bootstrap's is), so a
+        return must also have restored the caller's LCL
+        """
+        frames, active, ram = self.frames, self.active, self.cpu.ram
+        lcl = ram[LCL]
+        if frames and pc == frames[-1][3] and lcl == frames[-1][4]:
+            name, entry, _, _, _ = frames.pop()
+            active[name] -= 1
+            if not active[name]:
+                self.inclusive_cycles[name] += cycle - entry
+        elif self.entries[pc] and (not frames or frames[-1][2] != lcl):
+            name = self.entries[pc]
+            active[name] += 1
+            frames.append((name, cycle, lcl, ram[(lcl - 5) & 0xFFFF], ram[(lcl - 4) & 0xFFFF]))
+        return frames[-1][3] if frames else -1
+
+    def by_command(self):
+        """
+        (origin, executions, cycles) for every command that ran
+        """
+        counts = self.counts
+        rows = []
+        for start, end, origin in self.source_map.ranges():
+            cycles = sum(counts[start:end])
+            if cycles:
+                rows.append((origin, counts[start], cycles))
+        return rows
+
+    def totals(self, key):
+        """
+        Executions and cycles summed by key(origin), largest first
+        """
+        totals = defaultdict(lambda: [0, 0])
+        for origin, executions, cycles in self.by_command():
+            total = totals[key(origin)]
+            total[0] += executions
+            total[1] += cycles
+        return sorted(totals.items(), key=lambda item: -item[1][1])
+
+    def inclusive(self):
+        """
+        Cycles spent in each function including its callees, with calls
+        still in progress counted up to now
+        """
+        totals = Counter(self.inclusive_cycles)
+        outermost = {}
+        for name, entry, _, _, _ in self.frames:
+            outermost.setdefault(name, entry)
+        for name, entry in outermost.items():
+            totals[name] += self.cpu.cycles - entry
+        return totals
+
+    def write_flame(self, filename):
+        with open(filename, "w") as f:
+            for stack, cycles in sorted(self.stacks.items()):
+                f.write(f"{stack} {cycles}\n")
+
+    def report(self, top=20):
+        total = self.cpu.cycles
+        print(f"{total} cycles{' (halted)' if self.cpu.halted else ''}")
+        inclusive = self.inclusive()
+        print(f"{'function':<32} {'self':>10} {'self %':>7} {'total':>10} {'commands':>10}")
+        for name, (executions, cycles) in self.totals(origin_name)[:top]:
+            # The translator's own code (bootstrap, shared routines) isn't entered by calls
+            print(f"{name:<32} {cycles:>10} {100 * cycles / total:>6.1f}% {max(inclusive[name], cycles):>10} "
+                  f"{executions:>10}")
+        print(f"{'template':<32} {'cycles':>10} {'%':>7} {'executed':>10} {'cycles/cmd':>10}")
+        for template, (executions, cycles) in self.totals(lambda origin: command_type(origin[2]))[:top]:
+            print(f"{template:<32} {cycles:>10} {100 * cycles / total:>6.1f}% {executions:>10} "
+                  f"{cycles / executions if executions else 0:>10.1f}")
+        print(f"{'command':<48} {'cycles':>10} {'%':>7} {'executed':>10}")
+        for origin, executions, cycles in sorted(self.by_command(), key=lambda row: -row[2])[:top]:
+            command = f"{origin_name(origin)}: {origin[2]}"
+            print(f"{command:<48} {cycles:>10} {100 * cycles / total:>6.1f}% {executions:>10}")
+
+
+def load_mapped_program(input, optimize=False, shared=False, registers=False):
+    """
+    ROM words and source map for a .vm file or directory (translated
+    here), an .asm file written by VMTranslator, or a ROM with a .map
+    next to it
+    """
+    extension = os.path.splitext(input)[1]
+    if os.path.isdir(input) or extension == ".vm":
+        return vm2hack(input, optimize=optimize, shared=shared, registers=registers, source_map=True)
+    if extension == ".asm":
+        assembler = Assembler(marks=True)
+        with open(input) as f:
+            assembler.feed(f)
+        words = assembler.finish()
+        return words, SourceMap.from_assembly_marks(assembler.marks, len(words))
+    return load_rom(input), SourceMap.load(map_filename(input))
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Profile a Hack program by VM function and command")
+    argparser.add_argument("input", help=".vm file or directory, translated .asm, or ROM with a .map beside it")
+    argparser.add_argument("--cycles", type=int, default=1000000, help="cycle budget")
+    argparser.add_argument("--optimize", action="store_true", help="translate with the peephole optimizer")
+    argparser.add_argument("--shared", action="store_true", help="translate with shared call/return routines")
+    argparser.add_argument("--registers", action="store_true", help="translate with stack caching in registers")
+    argparser.add_argument("--interval", type=int, default=97,
+                           help="cycles between call stack samples; 1 walks the stack every cycle (slow)")
+    argparser.add_argument("--set", action="append", default=[], metavar="ADDRESS=VALUE",
+                           help="initialise a RAM word before running")
+    argparser.add_argument("--dump", action="append", default=[], metavar="START[:END]",
+                           help="RAM range to print at exit")
+    argparser.add_argument("--flame", help="write sampled stacks in collapsed flame graph format")
+    argparser.add_argument("--top", type=int, default=20, help="rows per table")
+    args = argparser.parse_args()
+
+    words, source_map = load_mapped_program(args.input, optimize=args.optimize, shared=args.shared,
+                                            registers=args.registers)
+    profiler = Profiler(words, source_map, interval=args.interval)
+    for assignment in args.set:
+        address, value = assignment.split("=")
+        profiler.cpu.poke(int(address), int(value))
+    profiler.run(args.cycles)
+    profiler.report(args.top)
+    if args.flame:
+        profiler.write_flame(args.flame)
+    for text in args.dump:
+        start, end = parse_range(text)
+        for address in range(start, end):
+            print(f"RAM[{address}] = {profiler.cpu.peek(address)}")
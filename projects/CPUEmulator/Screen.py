@@ -0,0 +1,161 @@
+"""
+Frame capture for the memory-mapped screen: 256 rows of 32 words from
+SCREEN, bit 0 of each word being its leftmost pixel and 1 being black.
+Writes are not trapped in the run loop; the screen is compared with the
+previous frame whenever one is captured, which gives the words drawn
+since then at no cost per cycle. Frames export as 1-bit PNG or as raw
+8-bit greyscale, with the bit unpacking done by NumPy when it is
+installed and by byte lookup tables when it is not.
+"""
+import os
+import sys
+import zlib
+import struct
+from Machine import SCREEN
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+ROWS, COLUMNS = 256, 512
+ROW_WORDS = COLUMNS // 16
+WORDS = ROWS * ROW_WORDS
+ROW_BYTES = 2 * ROW_WORDS
+
+# Each screen byte as 8 pixels, leftmost first: 0/1 for the image, white=255 for raw frames
+PIXELS = [bytes(byte >> i & 1 for i in range(8)) for byte in range(256)]
+GREYS = [bytes(0 if byte >> i & 1 else 255 for i in range(8)) for byte in range(256)]
+# PNG packs 1-bit pixels from the top bit, and in greyscale 1 is white
+PNG_BYTES = bytes(int(f"{byte:08b}"[::-1], 2) ^ 0xFF for byte in range(256))
+
+
+def _png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+class Screen(object):
+    def __init__(self, ram):
+        self.ram = ram
+        self.frame = self._read()
+        self.dirty = bytearray(WORDS)
+
+    def _read(self):
+        """
+        The screen words as little endian bytes, two per word
+        """
+        words = self.ram[SCREEN:SCREEN + WORDS]
+        if sys.byteorder == "big":
+            words.byteswap()
+        return words.tobytes()
+
+    def capture(self):
+        """
+        Take the current screen as the frame, marking the words that differ
+        from the previous frame in self.dirty. Returns how many do
+        """
+        frame, previous = self._read(), self.frame
+        self.frame = frame
+        if frame == previous:
+            self.dirty = bytearray(WORDS)
+            return 0
+        if numpy is not None:
+            changed = numpy.frombuffer(frame, numpy.uint16) != numpy.frombuffer(previous, numpy.uint16)
+            self.dirty = bytearray(changed.view(numpy.uint8))
+            return int(changed.sum())
+        dirty = bytearray(WORDS)
+        for start in range(0, 2 * WORDS, ROW_BYTES):
+            if frame[start:start + ROW_BYTES] != previous[start:start + ROW_BYTES]:
+                for i in range(start, start + ROW_BYTES, 2):
+                    if frame[i:i + 2] != previous[i:i + 2]:
+                        dirty[i >> 1] = 1
+        self.dirty = dirty
+        return dirty.count(1)
+
+    def dirty_region(self):
+        """
+        (top, left, bottom, right) pixel bounds, exclusive at the bottom
+        right, of the words changed by the last capture, or None
+        """
+        words = [i for i, flag in enumerate(self.dirty) if flag]
+        if not words:
+            return None
+        rows = [i // ROW_WORDS for i in words]
+        columns = [i % ROW_WORDS for i in words]
+        return min(rows), 16 * min(columns), max(rows) + 1, 16 * (max(columns) + 1)
+
+    def image(self):
+        """
+        The frame as 256 rows of 512 pixels, 1 for black: a NumPy array, or
+        a list of bytes rows without NumPy
+        """
+        if numpy is not None:
+            bits = numpy.unpackbits(numpy.frombuffer(self.frame, numpy.uint8), bitorder="little")
+            return bits.reshape(ROWS, COLUMNS)
+        pixels = b"".join(map(PIXELS.__getitem__, self.frame))
+        return [pixels[row:row + COLUMNS] for row in range(0, ROWS * COLUMNS, COLUMNS)]
+
+    def raw(self):
+        """
+        The frame as 8-bit greyscale, row by row (ffmpeg -f rawvideo
+        -pix_fmt gray -s 512x256)
+        """
+        if numpy is not None:
+            return numpy.where(self.image(), 0, 255).astype(numpy.uint8).tobytes()
+        return b"".join(map(GREYS.__getitem__, self.frame))
+
+    def png(self):
+        packed = self.frame.translate(PNG_BYTES)
+        rows = b"".join(b"\0" + packed[start:start + ROW_BYTES] for start in range(0, len(packed), ROW_BYTES))
+        header = struct.pack(">IIBBBBB", COLUMNS, ROWS, 1, 0, 0, 0, 0)
+        return (b"\x89PNG\r\n\x1a\n" + _png_chunk(b"IHDR", header) + _png_chunk(b"IDAT", zlib.compress(rows, 9)) +
+                _png_chunk(b"IEND", b""))
+
+
+def record(cpu, cycles, interval, directory, format="png"):
+    """
+    Run cpu for up to cycles, capturing the screen every interval cycles.
+    PNG frames are written to directory as frame_<cycle>.png, skipping
+    frames where nothing changed; raw frames are all appended to
+    directory/frames.raw. Returns the files written
+    """
+    os.makedirs(directory, exist_ok=True)
+    screen = Screen(cpu.ram)
+    written = []
+    raw = open(os.path.join(directory, "frames.raw"), "wb") if format == "raw" else None
+    try:
+        executed = 0
+        while executed < cycles and not cpu.halted:
+            executed += cpu.run(min(interval, cycles - executed))
+            changed = screen.capture()
+            if raw is not None:
+                raw.write(screen.raw())
+            elif changed or not written:
+                filename = os.path.join(directory, f"frame_{cpu.cycles:09d}.png")
+                with open(filename, "wb") as f:
+                    f.write(screen.png())
+                written.append(filename)
+    finally:
+        if raw is not None:
+            raw.close()
+            written.append(raw.name)
+    return written
+
+
+def compare_frames(written, reference):
+    """
+    Names of the frames that are missing from, or differ from, the files
+    of the same name in the reference directory
+    """
+    differences = []
+    for filename in written:
+        expected = os.path.join(reference, os.path.basename(filename))
+        with open(filename, "rb") as f:
+            frame = f.read()
+        if not os.path.exists(expected):
+            differences.append(f"{os.path.basename(filename)} (no reference)")
+            continue
+        with open(expected, "rb") as f:
+            if f.read() != frame:
+                differences.append(os.path.basename(filename))
+    return differences
@@ -0,0 +1,96 @@
+"""
+Machine state snapshots, so runs can start from a checkpoint taken after
+the OS has booted instead of replaying Sys.init every time. A snapshot
+file is a 64 byte header (PC, A, D, cycle count, halt flag and an
+optional SHA-256 of the ROM) followed by the RAM as little endian words,
+cut after the last non-zero word. Restoring maps the file and copies the
+RAM straight from the mapping into the CPU's RAM, and one Snapshot can
+restore into any number of CPUs.
+"""
+import sys
+import mmap
+import struct
+import hashlib
+from array import array
+
+MAGIC = b"HACKSNAP"
+VERSION = 1
+HAS_ROM_HASH = 1
+# magic, version, flags, pc, a, d, halted, cycles, ROM hash, RAM words
+HEADER = struct.Struct("<8sHHHHHBxQ32sI")
+
+
+def _little_endian(words):
+    if sys.byteorder == "big":
+        words = array("H", words)
+        words.byteswap()
+    return words.tobytes()
+
+
+def rom_hash(rom):
+    return hashlib.sha256(_little_endian(array("H", rom))).digest()
+
+
+def write_snapshot(cpu, filename, with_rom=True):
+    """
+    Save the CPU's registers and RAM, with a hash of its ROM unless
+    with_rom is False
+    """
+    ram = _little_endian(cpu.ram).rstrip(b"\0")
+    if len(ram) % 2:
+        ram += b"\0"
+    header = HEADER.pack(MAGIC, VERSION, HAS_ROM_HASH if with_rom else 0, cpu.pc, cpu.a, cpu.d, cpu.halted,
+                         cpu.cycles, rom_hash(cpu.rom) if with_rom else bytes(32), len(ram) // 2)
+    with open(filename, "wb") as f:
+        f.write(header + ram)
+
+
+class Snapshot(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, "rb")
+        try:
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise Exception(f"Snapshot {filename} is empty")
+        if len(self.mmap) < HEADER.size or self.mmap[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise Exception(f"{filename} is not a Hack snapshot")
+        (_, version, flags, self.pc, self.a, self.d, halted, self.cycles, digest,
+         self.words) = HEADER.unpack_from(self.mmap)
+        if version != VERSION:
+            self.close()
+            raise Exception(f"Don't recognise snapshot version {version} in {filename}")
+        if len(self.mmap) != HEADER.size + 2 * self.words:
+            self.close()
+            raise Exception(f"Snapshot {filename} is truncated")
+        self.halted = bool(halted)
+        self.rom_hash = digest if flags & HAS_ROM_HASH else None
+
+    def restore(self, cpu):
+        """
+        Put the CPU in the saved state. The RAM array is overwritten in
+        place, since the CPU's compiled instructions hold on to it
+        """
+        if self.rom_hash is not None and rom_hash(cpu.rom) != self.rom_hash:
+            raise Exception(f"Snapshot {self.filename} was taken with a different ROM")
+        if self.words > len(cpu.ram):
+            raise Exception(f"Snapshot {self.filename} has more RAM than the CPU")
+        size = 2 * self.words
+        with memoryview(cpu.ram) as words, words.cast("B") as ram, memoryview(self.mmap) as mapped:
+            ram[:size] = mapped[HEADER.size:]
+            ram[size:] = bytes(len(ram) - size)
+        if sys.byteorder == "big":
+            cpu.ram.byteswap()
+        cpu.pc, cpu.a, cpu.d, cpu.cycles, cpu.halted = self.pc, self.a, self.d, self.cycles, self.halted
+
+    def close(self):
+        self.mmap.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,348 @@
+"""
+Execution tracing for the Hack CPU emulator. A Tracer runs a CPU's
+instruction table in a loop of its own, so CPU.run is untouched and
+costs nothing when tracing is off. Each cycle it marks the PC in a ROM
+coverage map and stores a packed record into a ring buffer allocated up
+front, which keeps the last records cycles:
+
+    word 0  PC of the instruction, with WRITE set if it wrote M
+    word 1  A after the instruction
+    word 2  D after the instruction
+    word 3  RAM address written (with WRITE)
+    word 4  value written (with WRITE)
+
+Watchpoints on RAM addresses (SP, LCL, ARG...) log every write to them,
+or only writes of values outside a range, and can stop the run.
+
+A trace file is a 64 byte header followed by the records oldest first as
+little endian words, the coverage bitmap (bit n of byte n // 8 for ROM
+address n), the watched addresses with their ranges, and the watch hits
+as (cycle, PC, address, old value, new value).
+"""
+import sys
+import struct
+import argparse
+from array import array
+
+from Machine import Halt, ROM_SIZE, RAM_SIZE, load_program
+from assembler import C_INSTRUCTIONS, PREDEFINED_SYMBOLS
+
+MAGIC = b"HACKTRAC"
+VERSION = 1
+WRAPPED = 1
+HALTED = 2
+WRITE = 0x8000
+RECORD_WORDS = 5
+# magic, version, flags, capacity, records, ROM words, watches, hits, first cycle, cycles traced
+HEADER = struct.Struct("<8sHHIIIII4xQQ")
+WATCH = struct.Struct("<HHH")
+HIT = struct.Struct("<QHHHH")
+# A range that no value is in, for watches that log every write
+EVERY_WRITE = (1, 0)
+
+# The canonical spelling of each C-instruction word, for listings
+MNEMONICS = {}
+for _text, _word in C_INSTRUCTIONS.items():
+    MNEMONICS.setdefault(_word, _text)
+
+
+def _little_endian(words):
+    if sys.byteorder == "big":
+        words = array(words.typecode, words)
+        words.byteswap()
+    return words.tobytes()
+
+
+def _from_little_endian(typecode, data):
+    words = array(typecode, data)
+    if sys.byteorder == "big":
+        words.byteswap()
+    return words
+
+
+def disassemble(word):
+    if not word & 0x8000:
+        return f"@{word}"
+    return MNEMONICS.get(word | 0b111 << 13, f"{word:016b}")
+
+
+def pack_bits(flags):
+    """
+    A bytearray of 0/1 flags as a bitmap, bit n of byte n // 8 for flag n
+    """
+    bits = bytearray((len(flags) + 7) // 8)
+    index = flags.find(1)
+    while index >= 0:
+        bits[index >> 3] |= 1 << (index & 7)
+        index = flags.find(1, index + 1)
+    return bits
+
+
+def unpack_bits(bits, size):
+    return bytearray(bits[i >> 3] >> (i & 7) & 1 for i in range(size))
+
+
+def address_ranges(flags, value):
+    """
+    (start, end) runs of addresses whose flag is value, end exclusive
+    """
+    ranges, start = [], None
+    for address, flag in enumerate(flags):
+        if flag == value and start is None:
+            start = address
+        elif flag != value and start is not None:
+            ranges.append((start, address))
+            start = None
+    if start is not None:
+        ranges.append((start, len(flags)))
+    return ranges
+
+
+def describe_hit(hit):
+    cycle, pc, address, old, value = hit
+    return f"watch RAM[{address}]: {old} -> {value} at cycle {cycle}, PC={pc}"
+
+
+def parse_watch(text):
+    """
+    A --watch argument: ADDRESS for every write, or ADDRESS:LOW:HIGH for
+    writes of values outside LOW..HIGH. ADDRESS is a number or SP, LCL,
+    ARG, THIS, THAT, R0..R15
+    """
+    name, *bounds = text.split(":")
+    address = int(name) if name.isdigit() else PREDEFINED_SYMBOLS.get(name)
+    if address is None:
+        raise Exception(f"Don't recognise watch address {name}")
+    if not bounds:
+        return address, EVERY_WRITE
+    if len(bounds) != 2:
+        raise Exception(f"Don't recognise watch {text}")
+    return address, (int(bounds[0]) & 0xFFFF, int(bounds[1]) & 0xFFFF)
+
+
+class Tracer(object):
+    def __init__(self, cpu, records=65536):
+        """
+        Trace cpu, a CPU or JITCPU (traced runs always interpret), keeping
+        the last records cycles
+        """
+        if records < 1:
+            raise Exception("A trace needs room for at least one record")
+        self.cpu = cpu
+        self.capacity = records
+        self.buffer = array("H", bytes(2 * RECORD_WORDS * records))
+        self.position = 0
+        self.traced = 0
+        self.covered = bytearray(ROM_SIZE)
+        self.writes = bytearray(1 if word & 0x8000 and word & 0b1000 else 0 for word in cpu.rom)
+        self.writes += bytes(ROM_SIZE - len(self.writes))
+        self.watched = bytearray(RAM_SIZE)
+        self.watches = {}
+        self.stop_on_watch = False
+        self.hit_cycles = array("Q")
+        self.hits = array("H")
+        self.stopped = False
+
+    def watch(self, address, bounds=EVERY_WRITE):
+        """
+        Log writes to a RAM address whose value is outside bounds, an
+        inclusive (low, high) range of unsigned words
+        """
+        self.watched[address] = 1
+        self.watches[address] = bounds
+
+    def run(self, cycles, until=None):
+        """
+        Execute up to cycles instructions like CPU.run, stopping early at
+        a halt loop, at ROM address until, or at a watch hit when
+        stop_on_watch is set. Returns the number of instructions executed
+        """
+        cpu = self.cpu
+        ops, ram, buffer = cpu.ops, cpu.ram, self.buffer
+        covered, writes, watched, watches = self.covered, self.writes, self.watched, self.watches
+        size = len(buffer)
+        i = self.position
+        pc, a, d = cpu.pc, cpu.a, cpu.d
+        until = -1 if until is None else until
+        executed = 0
+        self.stopped = False
+        try:
+            while executed < cycles and pc != until:
+                covered[pc] = 1
+                if writes[pc]:
+                    address = a
+                    old = ram[address]
+                    buffer[i] = pc | WRITE
+                    pc, a, d = ops[pc](pc, a, d)
+                    value = buffer[i + 4] = ram[address]
+                    buffer[i + 3] = address
+                    if watched[address]:
+                        low, high = watches[address]
+                        if not low <= value <= high:
+                            self._hit(cpu.cycles + executed, buffer[i] ^ WRITE, address, old, value)
+                            if self.stop_on_watch:
+                                self.stopped = True
+                                cycles = executed + 1
+                else:
+                    buffer[i] = pc
+                    pc, a, d = ops[pc](pc, a, d)
+                buffer[i + 1] = a
+                buffer[i + 2] = d
+                i += RECORD_WORDS
+                if i == size:
+                    i = 0
+                executed += 1
+        except Halt as halt:
+            # The halt loop's own jump is recorded with the state it leaves
+            pc = halt.pc
+            buffer[i + 1] = a
+            buffer[i + 2] = d
+            i += RECORD_WORDS
+            if i == size:
+                i = 0
+            executed += 1
+            cpu.halted = True
+        cpu.pc, cpu.a, cpu.d = pc, a, d
+        cpu.cycles += executed
+        self.position = i
+        self.traced += executed
+        return executed
+
+    def _hit(self, cycle, pc, address, old, value):
+        self.hit_cycles.append(cycle)
+        self.hits.extend((pc, address, old, value))
+
+    def watch_hits(self):
+        """
+        (cycle, pc, address, old value, new value) for each watch hit
+        """
+        hits = self.hits
+        return [(cycle,) + tuple(hits[4 * n:4 * n + 4]) for n, cycle in enumerate(self.hit_cycles)]
+
+    def records(self):
+        """
+        The buffered records, oldest first, as a flat array of words with
+        the write fields of records without WRITE zeroed
+        """
+        buffer = self.buffer
+        if self.traced >= self.capacity:
+            records = buffer[self.position:] + buffer[:self.position]
+        else:
+            records = buffer[:self.position]
+        for i in range(0, len(records), RECORD_WORDS):
+            if not records[i] & WRITE:
+                records[i + 3] = records[i + 4] = 0
+        return records
+
+    def coverage(self):
+        """
+        ROM words executed, of those in the program
+        """
+        return self.covered.count(1), len(self.cpu.rom)
+
+    def write(self, filename):
+        records = self.records()
+        flags = (WRAPPED if self.traced > self.capacity else 0) | (HALTED if self.cpu.halted else 0)
+        header = HEADER.pack(MAGIC, VERSION, flags, self.capacity, len(records) // RECORD_WORDS,
+                             len(self.cpu.rom), len(self.watches), len(self.hit_cycles),
+                             self.cpu.cycles - len(records) // RECORD_WORDS, self.traced)
+        with open(filename, "wb") as f:
+            f.write(header)
+            f.write(_little_endian(records))
+            f.write(pack_bits(self.covered))
+            for address, (low, high) in sorted(self.watches.items()):
+                f.write(WATCH.pack(address, low, high))
+            for hit in self.watch_hits():
+                f.write(HIT.pack(*hit))
+
+
+class Trace(object):
+    """
+    A trace file read back: records is a flat array of RECORD_WORDS words
+    per record, oldest first, the first at cycle first_cycle
+    """
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            data = f.read()
+        if len(data) < HEADER.size or data[:len(MAGIC)] != MAGIC:
+            raise Exception(f"{filename} is not a Hack trace")
+        (_, version, flags, self.capacity, count, self.rom_words, watches, hits, self.first_cycle,
+         self.traced) = HEADER.unpack_from(data)
+        if version != VERSION:
+            raise Exception(f"Don't recognise trace version {version} in {filename}")
+        bitmap = ROM_SIZE // 8
+        size = HEADER.size + 2 * RECORD_WORDS * count + bitmap + WATCH.size * watches + HIT.size * hits
+        if len(data) != size:
+            raise Exception(f"Trace {filename} is truncated")
+        self.wrapped = bool(flags & WRAPPED)
+        self.halted = bool(flags & HALTED)
+        offset = HEADER.size
+        self.records = _from_little_endian("H", data[offset:offset + 2 * RECORD_WORDS * count])
+        offset += 2 * RECORD_WORDS * count
+        self.covered = unpack_bits(data[offset:offset + bitmap], ROM_SIZE)
+        offset += bitmap
+        self.watches = {}
+        for _ in range(watches):
+            address, low, high = WATCH.unpack_from(data, offset)
+            self.watches[address] = (low, high)
+            offset += WATCH.size
+        self.hits = [HIT.unpack_from(data, offset + HIT.size * n) for n in range(hits)]
+
+    def __len__(self):
+        return len(self.records) // RECORD_WORDS
+
+    def __iter__(self):
+        """
+        (cycle, pc, a, d, write) per record, write being (address, value)
+        or None
+        """
+        records = self.records
+        for n in range(len(self)):
+            pc, a, d, address, value = records[RECORD_WORDS * n:RECORD_WORDS * n + RECORD_WORDS]
+            if pc & WRITE:
+                yield self.first_cycle + n, pc ^ WRITE, a, d, (address, value)
+            else:
+                yield self.first_cycle + n, pc, a, d, None
+
+    def uncovered(self):
+        """
+        (start, end) ranges of program ROM addresses never executed
+        """
+        return address_ranges(self.covered[:self.rom_words], 0)
+
+    def print(self, rom=None, last=None):
+        """
+        List the records, with the instructions when rom is given, then
+        the watch hits and the coverage
+        """
+        skip = len(self) - last if last is not None and last < len(self) else 0
+        for cycle, pc, a, d, write in self:
+            if skip:
+                skip -= 1
+                continue
+            instruction = f" {disassemble(rom[pc]):<12}" if rom is not None and pc < len(rom) else ""
+            line = f"{cycle:>10} {pc:>5}{instruction} A={a:<5} D={d}"
+            if write:
+                line = f"{line:<40} RAM[{write[0]}]={write[1]}"
+            print(line)
+        for hit in self.hits:
+            print(describe_hit(hit))
+        covered = self.covered[:self.rom_words].count(1)
+        print(f"{len(self)} of {self.traced} cycles traced{' (halted)' if self.halted else ''}; "
+              f"covered {covered} of {self.rom_words} ROM words ({covered / max(self.rom_words, 1):.1%})")
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="List a trace written by CPUEmulator.py --trace")
+    argparser.add_argument("trace", help="trace file")
+    argparser.add_argument("--program",
+                           help="the traced program (.asm, .hack, .bin, .binbe or .hex), to list its instructions")
+    argparser.add_argument("--last", type=int, help="list only the last records")
+    argparser.add_argument("--uncovered", action="store_true", help="list the ROM ranges never executed")
+    args = argparser.parse_args()
+
+    trace = Trace(args.trace)
+    trace.print(load_program(args.program) if args.program else None, args.last)
+    if args.uncovered:
+        for start, end in trace.uncovered():
+            print(f"never executed: {start}" + (f"-{end - 1}" if end - start > 1 else ""))
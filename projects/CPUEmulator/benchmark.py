@@ -0,0 +1,63 @@
+"""
+Times the block compiler against plain interpretation: each program is
+run for the same number of cycles by the interpreter, by the JIT with an
+empty block cache, and by the JIT again with the cache filled by the
+first run. Every run must end in exactly the interpreter's state.
+"""
+import os
+import time
+import tempfile
+import argparse
+
+from Machine import CPU, load_program
+from JIT import JITCPU
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PROJECTS = os.path.dirname(HERE)
+# Both run for the whole budget: Pong through its game loop, Fill redrawing
+# the screen in a tight loop while no key is pressed
+PROGRAMS = [os.path.join(PROJECTS, "06", "pong", "Pong.asm"),
+            os.path.join(PROJECTS, "04", "fill", "Fill.asm")]
+
+
+def state(cpu):
+    return cpu.pc, cpu.a, cpu.d, cpu.cycles, cpu.halted, bytes(cpu.ram)
+
+
+def timed(make, cycles):
+    start = time.perf_counter()
+    cpu = make()
+    loaded = time.perf_counter()
+    cpu.run(cycles)
+    ran = time.perf_counter()
+    if isinstance(cpu, JITCPU):
+        cpu.save()
+    return cpu, loaded - start, ran - loaded
+
+
+def benchmark(programs, cycles):
+    print(f"{'program':<24} {'mode':<10} {'blocks':>7} {'load s':>8} {'run s':>8} {'cycles/s':>10} {'speedup':>8}")
+    with tempfile.TemporaryDirectory() as cache:
+        for program in programs:
+            rom = load_program(program)
+            runs = (("interpret", lambda: CPU(rom)),
+                    ("jit cold", lambda: JITCPU(rom, cache=cache)),
+                    ("jit warm", lambda: JITCPU(rom, cache=cache)))
+            want = None
+            for mode, make in runs:
+                cpu, load, run = timed(make, cycles)
+                if want is None:
+                    want, baseline = state(cpu), load + run
+                elif state(cpu) != want:
+                    raise Exception(f"{mode} run of {program} ends in a different state from the interpreter")
+                blocks = len(cpu.blocks) if isinstance(cpu, JITCPU) else ""
+                print(f"{os.path.basename(program):<24} {mode:<10} {blocks:>7} {load:>8.3f} {run:>8.3f} "
+                      f"{cpu.cycles / run:>10.0f} {baseline / (load + run):>7.1f}x")
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Benchmark the basic block JIT against the interpreter")
+    argparser.add_argument("programs", nargs="*", default=PROGRAMS, help=".asm or ROM files to run")
+    argparser.add_argument("--cycles", type=int, default=5000000, help="cycle budget per run")
+    args = argparser.parse_args()
+    benchmark(args.programs, args.cycles)
@@ -0,0 +1,389 @@
+"""
+Native implementations of the chips built in projects 01-05. The
+combinational ones are written only with operators that behave the same
+on Python ints and on NumPy integer arrays, so a whole truth table can be
+evaluated in one call when NumPy is installed.
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _mask(sel):
+    # all ones when sel is 1, zero when it is 0
+    return -sel & 0xFFFF
+
+
+def _mux(a, b, sel):
+    return a ^ ((a ^ b) & _mask(sel))
+
+
+def _is(value, constant):
+    return (value == constant) * 1
+
+
+def _bit(value, i):
+    return value >> i & 1
+
+
+def alu(x, y, zx, nx, zy, ny, f, no):
+    x = x & ~_mask(zx) & 0xFFFF
+    x = x ^ _mask(nx)
+    y = y & ~_mask(zy) & 0xFFFF
+    y = y ^ _mask(ny)
+    out = _mux(x & y, (x + y) & 0xFFFF, f)
+    out = out ^ _mask(no)
+    return out, _is(out, 0), out >> 15
+
+
+def _mux4(pins, sel):
+    return _mux(_mux(pins["a"], pins["b"], _bit(sel, 0)), _mux(pins["c"], pins["d"], _bit(sel, 0)), _bit(sel, 1))
+
+
+def _mux8(pins, sel):
+    low = _mux4(pins, sel)
+    high = _mux(_mux(pins["e"], pins["f"], _bit(sel, 0)), _mux(pins["g"], pins["h"], _bit(sel, 0)), _bit(sel, 1))
+    return _mux(low, high, _bit(sel, 2))
+
+
+def _full_adder(p):
+    total = p["a"] ^ p["b"] ^ p["c"]
+    return {"sum": total, "carry": (p["a"] & p["b"]) | (p["c"] & (p["a"] ^ p["b"]))}
+
+
+def _alu(p):
+    out, zr, ng = alu(p["x"], p["y"], p["zx"], p["nx"], p["zy"], p["ny"], p["f"], p["no"])
+    return {"out": out, "zr": zr, "ng": ng}
+
+
+# name: (inputs, outputs, function of a dict of input pins)
+COMBINATIONAL = {
+    "Nand": ({"a": 1, "b": 1}, {"out": 1}, lambda p: {"out": (p["a"] & p["b"]) ^ 1}),
+    "Not": ({"in": 1}, {"out": 1}, lambda p: {"out": p["in"] ^ 1}),
+    "And": ({"a": 1, "b": 1}, {"out": 1}, lambda p: {"out": p["a"] & p["b"]}),
+    "Or": ({"a": 1, "b": 1}, {"out": 1}, lambda p: {"out": p["a"] | p["b"]}),
+    "Xor": ({"a": 1, "b": 1}, {"out": 1}, lambda p: {"out": p["a"] ^ p["b"]}),
+    "Mux": ({"a": 1, "b": 1, "sel": 1}, {"out": 1}, lambda p: {"out": _mux(p["a"], p["b"], p["sel"])}),
+    "DMux": ({"in": 1, "sel": 1}, {"a": 1, "b": 1},
+             lambda p: {"a": p["in"] & (p["sel"] ^ 1), "b": p["in"] & p["sel"]}),
+    "Not16": ({"in": 16}, {"out": 16}, lambda p: {"out": p["in"] ^ 0xFFFF}),
+    "And16": ({"a": 16, "b": 16}, {"out": 16}, lambda p: {"out": p["a"] & p["b"]}),
+    "Or16": ({"a": 16, "b": 16}, {"out": 16}, lambda p: {"out": p["a"] | p["b"]}),
+    "Mux16": ({"a": 16, "b": 16, "sel": 1}, {"out": 16}, lambda p: {"out": _mux(p["a"], p["b"], p["sel"])}),
+    "Or8Way": ({"in": 8}, {"out": 1}, lambda p: {"out": (p["in"] != 0) * 1}),
+    "Mux4Way": ({"a": 1, "b": 1, "c": 1, "d": 1, "sel": 2}, {"out": 1}, lambda p: {"out": _mux4(p, p["sel"])}),
+    "Mux8Way": ({"a": 1, "b": 1, "c": 1, "d": 1, "e": 1, "f": 1, "g": 1, "h": 1, "sel": 3}, {"out": 1},
+                lambda p: {"out": _mux8(p, p["sel"])}),
+    "Mux4Way16": ({"a": 16, "b": 16, "c": 16, "d": 16, "sel": 2}, {"out": 16}, lambda p: {"out": _mux4(p, p["sel"])}),
+    "Mux8Way16": ({"a": 16, "b": 16, "c": 16, "d": 16, "e": 16, "f": 16, "g": 16, "h": 16, "sel": 3}, {"out": 16},
+                  lambda p: {"out": _mux8(p, p["sel"])}),
+    "DMux4Way": ({"in": 1, "sel": 2}, {"a": 1, "b": 1, "c": 1, "d": 1},
+                 lambda p: {pin: p["in"] & _is(p["sel"], i) for i, pin in enumerate("abcd")}),
+    "DMux8Way": ({"in": 1, "sel": 3}, {"a": 1, "b": 1, "c": 1, "d": 1, "e": 1, "f": 1, "g": 1, "h": 1},
+                 lambda p: {pin: p["in"] & _is(p["sel"], i) for i, pin in enumerate("abcdefgh")}),
+    "HalfAdder": ({"a": 1, "b": 1}, {"sum": 1, "carry": 1},
+                  lambda p: {"sum": p["a"] ^ p["b"], "carry": p["a"] & p["b"]}),
+    "FullAdder": ({"a": 1, "b": 1, "c": 1}, {"sum": 1, "carry": 1}, _full_adder),
+    "Add16": ({"a": 16, "b": 16}, {"out": 16}, lambda p: {"out": (p["a"] + p["b"]) & 0xFFFF}),
+    "Inc16": ({"in": 16}, {"out": 16}, lambda p: {"out": (p["in"] + 1) & 0xFFFF}),
+    "ALU": ({"x": 16, "y": 16, "zx": 1, "nx": 1, "zy": 1, "ny": 1, "f": 1, "no": 1}, {"out": 16, "zr": 1, "ng": 1},
+            _alu),
+}
+
+
+class Chip(object):
+    """
+    A chip simulated one step at a time. Clocked chips latch new state on
+    tick (visible through chip[] pins) and drive their outputs on tock
+    """
+    inputs = {}
+    outputs = {}
+    clocked = False
+
+    def __init__(self):
+        self.pins = {pin: 0 for pin in list(self.inputs) + list(self.outputs)}
+
+    def width(self, pin):
+        return self.inputs.get(pin) or self.outputs.get(pin) or 16
+
+    def set(self, pin, value):
+        if pin not in self.inputs:
+            raise Exception(f"{type(self).__name__} has no input pin {pin}")
+        self.pins[pin] = value & ((1 << self.inputs[pin]) - 1)
+
+    def get(self, pin):
+        if "[" in pin:
+            return self.internal(pin)
+        return self.pins[pin]
+
+    def internal(self, pin):
+        raise Exception(f"{type(self).__name__} has no internal pin {pin}")
+
+    def eval(self):
+        pass
+
+    def tick(self):
+        self.eval()
+
+    def tock(self):
+        self.eval()
+
+
+class Combinational(Chip):
+    def __init__(self, inputs, outputs, function):
+        self.inputs, self.outputs, self.function = inputs, outputs, function
+        super().__init__()
+
+    def eval(self):
+        self.pins.update(self.function({pin: self.pins[pin] for pin in self.inputs}))
+
+
+def evaluate_batch(function, columns):
+    """
+    Evaluate a combinational chip over many input rows at once. columns
+    maps each input pin to its list of values; returns output pin lists
+    """
+    if numpy is not None:
+        outputs = function({pin: numpy.array(values, dtype=numpy.int64) for pin, values in columns.items()})
+        size = len(next(iter(columns.values())))
+        return {pin: (numpy.broadcast_to(values, (size,)) if numpy.ndim(values) == 0 else values).tolist()
+                for pin, values in outputs.items()}
+    rows = [dict(zip(columns, values)) for values in zip(*columns.values())]
+    results = [function(row) for row in rows]
+    return {pin: [result[pin] for result in results] for pin in (results[0] if results else {})}
+
+
+class Register(Chip):
+    inputs = {"in": 16, "load": 1}
+    outputs = {"out": 16}
+    clocked = True
+
+    def __init__(self):
+        super().__init__()
+        self.state = 0
+
+    def internal(self, pin):
+        return self.state
+
+    def tick(self):
+        if self.pins["load"]:
+            self.state = self.pins["in"]
+
+    def tock(self):
+        self.pins["out"] = self.state
+
+
+class Bit(Register):
+    inputs = {"in": 1, "load": 1}
+    outputs = {"out": 1}
+
+
+class DFF(Register):
+    inputs = {"in": 1}
+    outputs = {"out": 1}
+
+    def tick(self):
+        self.state = self.pins["in"]
+
+
+class PC(Register):
+    inputs = {"in": 16, "load": 1, "inc": 1, "reset": 1}
+
+    def tick(self):
+        if self.pins["reset"]:
+            self.state = 0
+        elif self.pins["load"]:
+            self.state = self.pins["in"]
+        elif self.pins["inc"]:
+            self.state = (self.state + 1) & 0xFFFF
+
+
+class RAM(Chip):
+    """
+    RAM of 2**address_bits words. Writes latch on tick and become visible
+    on tock; out always reads the addressed word
+    """
+    address_bits = 3
+    clocked = True
+
+    def __init__(self):
+        self.inputs = {"in": 16, "load": 1, "address": self.address_bits}
+        self.outputs = {"out": 16}
+        super().__init__()
+        self.memory = [0] * (1 << self.address_bits)
+        self.pending = None
+
+    def internal(self, pin):
+        return self.memory[int(pin[pin.index("[") + 1:-1] or 0)]
+
+    def set_internal(self, pin, value):
+        self.memory[int(pin[pin.index("[") + 1:-1] or 0)] = value & 0xFFFF
+
+    def eval(self):
+        self.pins["out"] = self.memory[self.pins["address"]]
+
+    def tick(self):
+        self.pending = (self.pins["address"], self.pins["in"]) if self.pins["load"] else None
+        self.eval()
+
+    def tock(self):
+        if self.pending:
+            address, value = self.pending
+            self.memory[address] = value
+            self.pending = None
+        self.eval()
+
+
+def _ram(address_bits):
+    return type(f"RAM{1 << address_bits}", (RAM,), {"address_bits": address_bits})
+
+
+class Memory(RAM):
+    """
+    RAM16K, the screen and the keyboard mapped into one 32K address space
+    """
+    address_bits = 15
+    keyboard = 0
+
+    def eval(self):
+        address = self.pins["address"]
+        self.pins["out"] = self.keyboard if address == 0x6000 else (self.memory[address] if address < 0x6000 else 0)
+
+    def tock(self):
+        if self.pending and self.pending[0] >= 0x6000:
+            self.pending = None
+        super().tock()
+
+
+def cpu_step(instruction, a, d, pc, in_m, reset):
+    """
+    One Hack CPU cycle from register values. Returns the ALU output,
+    whether it is written to M, and the next A, D and PC
+    """
+    if not instruction & 0x8000:
+        return 0, 0, instruction, d, 0 if reset else (pc + 1) & 0x7FFF
+    y = in_m if instruction & 0x1000 else a
+    bits = [_bit(instruction, i) for i in range(11, 5, -1)]
+    out, zr, ng = alu(d, y, *bits)
+    jump = ((instruction & 4 and ng) or (instruction & 2 and zr)
+            or (instruction & 1 and not ng and not zr))
+    next_pc = 0 if reset else (a & 0x7FFF if jump else (pc + 1) & 0x7FFF)
+    next_a = out if instruction & 0b100000 else a
+    next_d = out if instruction & 0b010000 else d
+    return out, (instruction >> 3) & 1, next_a, next_d, next_pc
+
+
+class CPU(Chip):
+    inputs = {"inM": 16, "instruction": 16, "reset": 1}
+    outputs = {"outM": 16, "writeM": 1, "addressM": 15, "pc": 15}
+    clocked = True
+
+    def __init__(self):
+        super().__init__()
+        self.a = self.d = self.pc = 0
+        self.next = (0, 0, 0)
+
+    def internal(self, pin):
+        name = pin[:pin.index("[")]
+        if name == "DRegister":
+            return self.next[1]
+        if name == "ARegister":
+            return self.next[0]
+        if name == "PC":
+            return self.next[2]
+        return super().internal(pin)
+
+    def eval(self):
+        out, write, _, _, _ = cpu_step(self.pins["instruction"], self.a, self.d, self.pc,
+                                       self.pins["inM"], self.pins["reset"])
+        self.pins.update(outM=out, writeM=write, addressM=self.a & 0x7FFF, pc=self.pc)
+
+    def tick(self):
+        _, _, a, d, pc = cpu_step(self.pins["instruction"], self.a, self.d, self.pc,
+                                  self.pins["inM"], self.pins["reset"])
+        self.next = (a, d, pc)
+        self.eval()
+
+    def tock(self):
+        self.a, self.d, self.pc = self.next
+        self.eval()
+
+
+class Computer(Chip):
+    """
+    CPU, ROM32K and Memory wired together; the ROM is loaded by the test
+    script with 'ROM32K load <file>.hack'
+    """
+    inputs = {"reset": 1}
+    outputs = {}
+    clocked = True
+
+    def __init__(self):
+        super().__init__()
+        self.rom = [0] * 0x8000
+        self.ram = [0] * 0x8000
+        self.a = self.d = self.pc = 0
+        self.next = None
+
+    def load_rom(self, words):
+        self.rom = list(words) + [0] * (0x8000 - len(words))
+
+    def internal(self, pin):
+        name, index = pin[:pin.index("[")], pin[pin.index("[") + 1:-1]
+        if name == "ARegister":
+            return self.a
+        if name == "DRegister":
+            return self.d
+        if name == "PC":
+            return self.pc
+        if name in ("RAM16K", "Memory"):
+            return self.ram[int(index)]
+        if name == "ROM32K":
+            return self.rom[int(index)]
+        return super().internal(pin)
+
+    def set_internal(self, pin, value):
+        name, index = pin[:pin.index("[")], pin[pin.index("[") + 1:-1]
+        if name not in ("RAM16K", "Memory"):
+            raise Exception(f"Can't set {pin}")
+        self.ram[int(index)] = value & 0xFFFF
+
+    def tick(self):
+        instruction = self.rom[self.pc]
+        out, write, a, d, pc = cpu_step(instruction, self.a, self.d, self.pc,
+                                        self.ram[self.a & 0x7FFF], self.pins["reset"])
+        self.next = (out if write and self.a < 0x6000 else None, self.a & 0x7FFF, a, d, pc)
+
+    def tock(self):
+        if self.next:
+            out, address, self.a, self.d, self.pc = self.next
+            if out is not None:
+                self.ram[address] = out
+            self.next = None
+
+
+SEQUENTIAL = {
+    "DFF": DFF,
+    "Bit": Bit,
+    "Register": Register,
+    "ARegister": Register,
+    "DRegister": Register,
+    "PC": PC,
+    "RAM8": _ram(3),
+    "RAM64": _ram(6),
+    "RAM512": _ram(9),
+    "RAM4K": _ram(12),
+    "RAM16K": _ram(14),
+    "Memory": Memory,
+    "CPU": CPU,
+    "Computer": Computer,
+}
+
+
+def create(name):
+    if name in COMBINATIONAL:
+        return Combinational(*COMBINATIONAL[name])
+    if name in SEQUENTIAL:
+        return SEQUENTIAL[name]()
+    raise Exception(f"No built-in implementation of chip {name}")
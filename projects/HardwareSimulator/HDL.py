@@ -0,0 +1,877 @@
+"""
+Gate-level simulator for the .hdl chips of projects 01-05. A chip is
+parsed, its part hierarchy flattened into a netlist of single-bit gates,
+flip-flops and memory blocks, and the netlist compiled into one Python
+function in topological order.
+
+Every wire holds a Python int with one bit per lane, so a single call
+evaluates the chip for as many independent input vectors (or independent
+machines, for clocked chips) as there are lanes. Chips without an .hdl
+file, and the memories too large to flatten, use native gate-level
+implementations.
+"""
+import os
+import re
+import sys
+import time
+import argparse
+from array import array
+
+import Chips
+
+TOKENS = re.compile(r"\.\.|\w+|\S")
+COMMENTS = re.compile(r"//[^\n]*|/\*.*?\*/", re.S)
+FALSE, TRUE = 0, 1
+LARGE_MEMORIES = {"RAM4K", "RAM16K"}     # 65536 flip-flops and up are always native
+
+
+class HDLChip(object):
+    """
+    A parsed CHIP: pin widths and a list of parts, each a chip name and
+    a list of (pin, pin range, signal, signal range) connections
+    """
+    def __init__(self, name, inputs, outputs, parts, builtin=False):
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+        self.parts = parts
+        self.builtin = builtin
+
+
+def parse_hdl(text):
+    tokens = TOKENS.findall(COMMENTS.sub("", text))
+    position = 0
+
+    def take(expected=None):
+        nonlocal position
+        token = tokens[position] if position < len(tokens) else None
+        if expected is not None and token != expected:
+            raise Exception(f"Expected {expected} but found {token}")
+        position += 1
+        return token
+
+    def sub_range():
+        if tokens[position] != "[":
+            return None
+        take("[")
+        low = high = int(take())
+        if tokens[position] == "..":
+            take("..")
+            high = int(take())
+        take("]")
+        return low, high
+
+    def pin_list():
+        pins = {}
+        while True:
+            name = take()
+            width = sub_range()
+            pins[name] = width[0] if width else 1
+            if take() == ";":
+                return pins
+
+    take("CHIP")
+    name = take()
+    take("{")
+    inputs, outputs, parts, builtin = {}, {}, [], False
+    while tokens[position] != "}":
+        word = take()
+        if word == "IN":
+            inputs = pin_list()
+        elif word == "OUT":
+            outputs = pin_list()
+        elif word == "BUILTIN":
+            builtin = True
+            take()
+            take(";")
+        elif word == "CLOCKED":
+            pin_list()
+        elif word == "PARTS":
+            take(":")
+            while tokens[position] != "}":
+                part, connections = take(), []
+                take("(")
+                while True:
+                    pin, pin_range = take(), sub_range()
+                    take("=")
+                    signal, signal_range = take(), sub_range()
+                    connections.append((pin, pin_range, signal, signal_range))
+                    if take() == ")":
+                        break
+                take(";")
+                parts.append((part, connections))
+        else:
+            raise Exception(f"Don't recognise HDL keyword {word}")
+    return HDLChip(name, inputs, outputs, parts, builtin)
+
+
+class Netlist(object):
+    """
+    Single-bit gates over numbered wires. Wire 0 is false and wire 1 true;
+    signals used before they are driven get a placeholder wire that is
+    connected to its driver later. Gates fold constants and are shared
+    when the same gate is asked for twice
+    """
+    def __init__(self):
+        self.wires = 2
+        self.gates = []         # (op, out, inputs)
+        self.dffs = []          # (out, in)
+        self.memories = []      # (kind, size, data, load, address, out)
+        self.alias = {}
+        self.state = {}         # chip name -> (dff indices, memory indices) of its first instance
+        self.shared = {}
+
+    def wire(self):
+        self.wires += 1
+        return self.wires - 1
+
+    def connect(self, placeholder, wire):
+        if placeholder in self.alias:
+            raise Exception("Signal is driven twice")
+        if placeholder != wire:
+            self.alias[placeholder] = wire
+
+    def resolve(self, wire):
+        seen = 0
+        while wire in self.alias:
+            wire = self.alias[wire]
+            seen += 1
+            if seen > len(self.alias):
+                raise Exception("Signal is connected only to itself")
+        return wire
+
+    def gate(self, op, *inputs):
+        key = (op,) + inputs
+        out = self.shared.get(key)
+        if out is None:
+            out = self.shared[key] = self.wire()
+            self.gates.append((op, out, inputs))
+        return out
+
+    def not_(self, a):
+        if a in (FALSE, TRUE):
+            return TRUE - a
+        return self.gate("not", a)
+
+    def and_(self, a, b):
+        if FALSE in (a, b):
+            return FALSE
+        if a == TRUE or a == b:
+            return b
+        if b == TRUE:
+            return a
+        return self.gate("and", a, b)
+
+    def or_(self, a, b):
+        if TRUE in (a, b):
+            return TRUE
+        if a == FALSE or a == b:
+            return b
+        if b == FALSE:
+            return a
+        return self.gate("or", a, b)
+
+    def xor(self, a, b):
+        if a == FALSE:
+            return b
+        if b == FALSE:
+            return a
+        if a == TRUE:
+            return self.not_(b)
+        if b == TRUE:
+            return self.not_(a)
+        return FALSE if a == b else self.gate("xor", a, b)
+
+    def nand(self, a, b):
+        if FALSE in (a, b):
+            return TRUE
+        if TRUE in (a, b) or a == b:
+            return self.not_(b if a in (TRUE, b) else a)
+        return self.gate("nand", a, b)
+
+    def mux(self, a, b, sel):
+        if sel == FALSE or a == b:
+            return a
+        if sel == TRUE:
+            return b
+        return self.gate("mux", a, b, sel)
+
+    def dff(self, data):
+        out = self.wire()
+        self.dffs.append((out, data))
+        return out
+
+    def memory(self, kind, size, data=(), load=FALSE, address=()):
+        out = [self.wire() for _ in range(16)]
+        self.memories.append((kind, size, list(data), load, list(address), out))
+        return out
+
+
+def _bus(op, *buses):
+    return [op(*bits) for bits in zip(*buses)]
+
+
+def _select(nl, buses, sel):
+    level = buses
+    for bit in sel:
+        level = [_bus(lambda a, b: nl.mux(a, b, bit), level[i], level[i + 1]) for i in range(0, len(level), 2)]
+    return level[0]
+
+
+def _decode(nl, data, sel):
+    outs = [data]
+    for bit in reversed(sel):
+        outs = [wire for out in outs for wire in (nl.and_(out, nl.not_(bit)), nl.and_(out, bit))]
+    return outs
+
+
+def _any(nl, bits):
+    out = FALSE
+    for bit in bits:
+        out = nl.or_(out, bit)
+    return out
+
+
+def _add(nl, a, b, carry=FALSE):
+    out = []
+    for x, y in zip(a, b):
+        half = nl.xor(x, y)
+        out.append(nl.xor(half, carry))
+        carry = nl.or_(nl.and_(x, y), nl.and_(carry, half))
+    return out
+
+
+def _alu(nl, p):
+    (zx,), (nx,), (zy,), (ny,), (f,), (no,) = (p[pin] for pin in ("zx", "nx", "zy", "ny", "f", "no"))
+    x = [nl.xor(nl.and_(bit, nl.not_(zx)), nx) for bit in p["x"]]
+    y = [nl.xor(nl.and_(bit, nl.not_(zy)), ny) for bit in p["y"]]
+    out = _bus(lambda a, b: nl.mux(a, b, f), _bus(nl.and_, x, y), _add(nl, x, y))
+    out = [nl.xor(bit, no) for bit in out]
+    return {"out": out, "zr": [nl.not_(_any(nl, out))], "ng": [out[15]]}
+
+
+def _register(nl, data, load):
+    out = [nl.wire() for _ in data]
+    for placeholder, bit in zip(out, data):
+        nl.connect(placeholder, nl.dff(nl.mux(placeholder, bit, load)))
+    return {"out": out}
+
+
+def _pc(nl, p):
+    (load,), (inc,), (reset,) = p["load"], p["inc"], p["reset"]
+    out = [nl.wire() for _ in range(16)]
+    incremented = _add(nl, out, [FALSE] * 16, TRUE)
+    for i, placeholder in enumerate(out):
+        bit = nl.mux(nl.mux(placeholder, incremented[i], inc), p["in"][i], load)
+        nl.connect(placeholder, nl.dff(nl.and_(bit, nl.not_(reset))))
+    return {"out": out}
+
+
+def _memory(nl, p):
+    """
+    RAM16K, the screen and the keyboard in one address space, decoded on
+    the top two address bits
+    """
+    (load,), address = p["load"], p["address"]
+    screen_bit, high = address[13], address[14]
+    ram = nl.memory("ram", 1 << 14, p["in"], nl.and_(load, nl.not_(high)), address[:14])
+    nl.state.setdefault("RAM16K", (range(0), range(len(nl.memories) - 1, len(nl.memories))))
+    screen = nl.memory("ram", 1 << 13, p["in"], nl.and_(load, nl.and_(high, nl.not_(screen_bit))), address[:13])
+    nl.state.setdefault("Screen", (range(0), range(len(nl.memories) - 1, len(nl.memories))))
+    return {"out": _select(nl, [ram, ram, screen, nl.memory("keyboard", 1)], [screen_bit, high])}
+
+
+def _ram(address_bits):
+    interface = {"in": 16, "load": 1, "address": address_bits}
+    return (interface, {"out": 16},
+            lambda nl, p: {"out": nl.memory("ram", 1 << address_bits, p["in"], p["load"][0], p["address"])})
+
+
+def _gates(name):
+    inputs, outputs, _ = Chips.COMBINATIONAL[name]
+    return inputs, outputs
+
+
+# name: (inputs, outputs, function adding the chip to a netlist given its input wires)
+NATIVE = {
+    "Nand": _gates("Nand") + (lambda nl, p: {"out": [nl.nand(p["a"][0], p["b"][0])]},),
+    "Not": _gates("Not") + (lambda nl, p: {"out": [nl.not_(p["in"][0])]},),
+    "And": _gates("And") + (lambda nl, p: {"out": [nl.and_(p["a"][0], p["b"][0])]},),
+    "Or": _gates("Or") + (lambda nl, p: {"out": [nl.or_(p["a"][0], p["b"][0])]},),
+    "Xor": _gates("Xor") + (lambda nl, p: {"out": [nl.xor(p["a"][0], p["b"][0])]},),
+    "Mux": _gates("Mux") + (lambda nl, p: {"out": _select(nl, [p["a"], p["b"]], p["sel"])},),
+    "DMux": _gates("DMux") + (lambda nl, p: dict(zip("ab", ([w] for w in _decode(nl, p["in"][0], p["sel"])))),),
+    "Not16": _gates("Not16") + (lambda nl, p: {"out": _bus(nl.not_, p["in"])},),
+    "And16": _gates("And16") + (lambda nl, p: {"out": _bus(nl.and_, p["a"], p["b"])},),
+    "Or16": _gates("Or16") + (lambda nl, p: {"out": _bus(nl.or_, p["a"], p["b"])},),
+    "Mux16": _gates("Mux16") + (lambda nl, p: {"out": _select(nl, [p["a"], p["b"]], p["sel"])},),
+    "Or8Way": _gates("Or8Way") + (lambda nl, p: {"out": [_any(nl, p["in"])]},),
+    "Mux4Way": _gates("Mux4Way") + (lambda nl, p: {"out": _select(nl, [p[pin] for pin in "abcd"], p["sel"])},),
+    "Mux8Way": _gates("Mux8Way") + (lambda nl, p: {"out": _select(nl, [p[pin] for pin in "abcdefgh"], p["sel"])},),
+    "Mux4Way16": _gates("Mux4Way16") + (lambda nl, p: {"out": _select(nl, [p[pin] for pin in "abcd"], p["sel"])},),
+    "Mux8Way16": _gates("Mux8Way16") + (
+        lambda nl, p: {"out": _select(nl, [p[pin] for pin in "abcdefgh"], p["sel"])},),
+    "DMux4Way": _gates("DMux4Way") + (
+        lambda nl, p: dict(zip("abcd", ([w] for w in _decode(nl, p["in"][0], p["sel"])))),),
+    "DMux8Way": _gates("DMux8Way") + (
+        lambda nl, p: dict(zip("abcdefgh", ([w] for w in _decode(nl, p["in"][0], p["sel"])))),),
+    "HalfAdder": _gates("HalfAdder") + (
+        lambda nl, p: {"sum": [nl.xor(p["a"][0], p["b"][0])], "carry": [nl.and_(p["a"][0], p["b"][0])]},),
+    "FullAdder": _gates("FullAdder") + (
+        lambda nl, p: dict(zip(("sum", "carry"), ([w] for w in _full_adder(nl, p)))),),
+    "Add16": _gates("Add16") + (lambda nl, p: {"out": _add(nl, p["a"], p["b"])},),
+    "Inc16": _gates("Inc16") + (lambda nl, p: {"out": _add(nl, p["in"], [FALSE] * 16, TRUE)},),
+    "ALU": _gates("ALU") + (_alu,),
+    "DFF": ({"in": 1}, {"out": 1}, lambda nl, p: {"out": [nl.dff(p["in"][0])]}),
+    "Bit": ({"in": 1, "load": 1}, {"out": 1}, lambda nl, p: _register(nl, p["in"], p["load"][0])),
+    "Register": ({"in": 16, "load": 1}, {"out": 16}, lambda nl, p: _register(nl, p["in"], p["load"][0])),
+    "ARegister": ({"in": 16, "load": 1}, {"out": 16}, lambda nl, p: _register(nl, p["in"], p["load"][0])),
+    "DRegister": ({"in": 16, "load": 1}, {"out": 16}, lambda nl, p: _register(nl, p["in"], p["load"][0])),
+    "PC": ({"in": 16, "load": 1, "inc": 1, "reset": 1}, {"out": 16}, _pc),
+    "RAM8": _ram(3),
+    "RAM64": _ram(6),
+    "RAM512": _ram(9),
+    "RAM4K": _ram(12),
+    "RAM16K": _ram(14),
+    "Screen": _ram(13),
+    "Keyboard": ({}, {"out": 16}, lambda nl, p: {"out": nl.memory("keyboard", 1)}),
+    "Memory": ({"in": 16, "load": 1, "address": 15}, {"out": 16}, _memory),
+    "ROM32K": ({"address": 15}, {"out": 16},
+               lambda nl, p: {"out": nl.memory("rom", 1 << 15, address=p["address"])}),
+}
+
+
+def _full_adder(nl, p):
+    (a,), (b,), (c,) = p["a"], p["b"], p["c"]
+    half = nl.xor(a, b)
+    return nl.xor(half, c), nl.or_(nl.and_(a, b), nl.and_(c, half))
+
+
+def to_slices(values, width):
+    """
+    Turn one value per lane into one int per bit with a bit per lane
+    """
+    return [int("".join("1" if value >> bit & 1 else "0" for value in reversed(values)) or "0", 2)
+            for bit in range(width)]
+
+
+def from_slices(slices, lanes):
+    values = [0] * lanes
+    for bit, lane_bits in enumerate(slices):
+        if lane_bits:
+            for lane, char in enumerate(reversed(format(lane_bits, f"0{lanes}b"))):
+                if char == "1":
+                    values[lane] |= 1 << bit
+    return values
+
+
+def from_lane(slices, lane):
+    return sum((lane_bits >> lane & 1) << bit for bit, lane_bits in enumerate(slices))
+
+
+class MemoryBlock(object):
+    """
+    Word-addressed memory behind a netlist, one array of words per lane.
+    Writes latch on tick and land on tock
+    """
+    def __init__(self, kind, size, lanes):
+        self.kind, self.size, self.lanes = kind, size, lanes
+        if kind == "rom":
+            self.words = [array("H", bytes(2 * size))] * lanes
+        else:
+            self.words = [array("H", bytes(2 * size)) for _ in range(lanes)]
+        self.key = 0
+        self.pending = []
+
+    def load(self, words):
+        rom = array("H", words)
+        rom.extend(bytes(2 * (self.size - len(rom))))
+        self.words = [rom] * self.lanes
+
+    def read(self, address):
+        if self.kind == "keyboard":
+            values = [self.key] * self.lanes
+        elif self.lanes == 1:
+            value = self.words[0][from_lane(address, 0)]
+            return [value >> bit & 1 for bit in range(16)]
+        else:
+            values = [words[a] for words, a in zip(self.words, from_slices(address, self.lanes))]
+        return to_slices(values, 16)
+
+    def latch(self, data, load, address):
+        self.pending = []
+        if load:
+            values, addresses = from_slices(data, self.lanes), from_slices(address, self.lanes)
+            self.pending = [(lane, addresses[lane], values[lane]) for lane in range(self.lanes) if load >> lane & 1]
+
+    def commit(self):
+        for lane, address, value in self.pending:
+            self.words[lane][address] = value
+        self.pending = []
+
+
+class Program(object):
+    """
+    A netlist compiled into evaluate(inputs, state, memories, M), which
+    returns the output wires, the next flip-flop values and the memory
+    write ports. Only gates that reach an output or some state are kept
+    """
+    def __init__(self, name, nl, inputs, outputs):
+        self.name = name
+        self.inputs = {pin: len(wires) for pin, wires in inputs.items()}
+        self.outputs = {pin: len(wires) for pin, wires in outputs.items()}
+        self.state = nl.state
+        self.memories = [(kind, size) for kind, size, *_ in nl.memories]
+        self.dff_count = len(nl.dffs)
+        self.source, self.gate_count = self._generate(nl, inputs, outputs)
+        namespace = {}
+        exec(compile(self.source, f"<netlist {name}>", "exec"), namespace)
+        self.evaluate = namespace["evaluate"]
+
+    def _generate(self, nl, inputs, outputs):
+        resolve = nl.resolve
+        producers = {}
+        for op, out, gate_inputs in nl.gates:
+            producers[out] = (op, out, [resolve(w) for w in gate_inputs])
+        for index, (kind, size, data, load, address, out) in enumerate(nl.memories):
+            node = ("read", index, [resolve(w) for w in address], out)
+            for wire in out:
+                producers[wire] = node
+        driven = {FALSE, TRUE} | {out for out, _ in nl.dffs} | {w for wires in inputs.values() for w in wires}
+
+        def name(wire):
+            wire = resolve(wire)
+            return f"w{wire}" if wire in producers or wire in driven else "w0"
+
+        # depth-first from the outputs and the state inputs, emitting each node after its inputs
+        roots = [w for wires in outputs.values() for w in wires] + [data for _, data in nl.dffs]
+        for kind, size, data, load, address, out in nl.memories:
+            roots += data + [load] + address
+        order, done, active = [], set(), set()
+        for root in roots:
+            stack = [(resolve(root), False)]
+            while stack:
+                wire, expanded = stack.pop()
+                node = producers.get(wire)
+                if node is None or id(node) in done:
+                    continue
+                if expanded:
+                    active.discard(id(node))
+                    done.add(id(node))
+                    order.append(node)
+                    continue
+                if id(node) in active:
+                    raise Exception(f"Combinational loop in {self.name}")
+                active.add(id(node))
+                stack.append((wire, True))
+                stack += [(w, False) for w in node[2] if w in producers and id(producers[w]) not in done]
+
+        lines = ["def evaluate(inputs, state, memories, M):", "    w0 = 0", "    w1 = M"]
+        position = 0
+        for wires in inputs.values():
+            for wire in wires:
+                lines.append(f"    w{wire} = inputs[{position}]")
+                position += 1
+        for index, (out, _) in enumerate(nl.dffs):
+            lines.append(f"    w{out} = state[{index}]")
+        expressions = {
+            "nand": "M ^ ({0} & {1})", "not": "M ^ {0}", "and": "{0} & {1}", "or": "{0} | {1}",
+            "xor": "{0} ^ {1}", "mux": "{0} ^ (({0} ^ {1}) & {2})",
+        }
+        gates = 0
+        for node in order:
+            if node[0] == "read":
+                _, index, address, out = node
+                targets = "".join(f"w{w}, " for w in out)
+                lines.append(f"    {targets}= memories[{index}].read(({''.join(name(w) + ', ' for w in address)}))")
+            else:
+                op, out, gate_inputs = node
+                lines.append(f"    w{out} = " + expressions[op].format(*map(name, gate_inputs)))
+                gates += 1
+        wires = lambda ws: "(" + "".join(name(w) + ", " for w in ws) + ")"
+        out_wires = [w for ws in outputs.values() for w in ws]
+        ports = "(" + "".join(f"({wires(data)}, {name(load)}, {wires(address)}), "
+                              for kind, size, data, load, address, out in nl.memories) + ")"
+        lines.append(f"    return {wires(out_wires)}, {wires([data for _, data in nl.dffs])}, {ports}")
+        return "\n".join(lines) + "\n", gates
+
+
+class Circuit(object):
+    """
+    A compiled program with its own flip-flops and memories
+    """
+    def __init__(self, program, lanes):
+        self.program = program
+        self.name = program.name
+        self.inputs = program.inputs
+        self.outputs = program.outputs
+        self.mask = (1 << lanes) - 1
+        self.state = [0] * program.dff_count
+        self.latched = list(self.state)
+        self.next_state = self.state
+        self.ports = ()
+        self.memories = [MemoryBlock(kind, size, lanes) for kind, size in program.memories]
+
+    def evaluate(self, pins):
+        flat = []
+        for pin, width in self.inputs.items():
+            flat += pins[pin]
+        outs, self.next_state, self.ports = self.program.evaluate(flat, self.state, self.memories, self.mask)
+        values, position = {}, 0
+        for pin, width in self.outputs.items():
+            values[pin] = list(outs[position:position + width])
+            position += width
+        return values
+
+    def latch(self):
+        self.latched = list(self.next_state)
+        for memory, (data, load, address) in zip(self.memories, self.ports):
+            if memory.kind == "ram":
+                memory.latch(data, load, address)
+
+    def commit(self):
+        self.state = list(self.latched)
+        for memory in self.memories:
+            memory.commit()
+
+    def blocks(self):
+        return list(self.memories)
+
+    def find_state(self, name):
+        """
+        The flip-flops and memories of the first part called name, as
+        lists of (circuit, index)
+        """
+        if name not in self.program.state:
+            return None
+        dffs, memories = self.program.state[name]
+        return [(self, i) for i in dffs], [(self, i) for i in memories]
+
+
+class Instance(object):
+    """
+    Hierarchical evaluation: each HDL chip evaluates its parts in turn,
+    passing bit slices by pin name, until its internal signals settle.
+    Native parts are compiled circuits of their own
+    """
+    def __init__(self, library, name, lanes):
+        chip = library.chip(name)
+        self.name = name
+        self.inputs, self.outputs = chip.inputs, chip.outputs
+        self.mask = (1 << lanes) - 1
+        self.signals = {}
+        self.parts = []
+        for part_name, connections in chip.parts:
+            if library.chip(part_name) is None:
+                part = Circuit(library.program(part_name), lanes)
+            else:
+                part = Instance(library, part_name, lanes)
+            reads, writes = [], []
+            for pin, pin_range, signal, signal_range in connections:
+                width = part.inputs.get(pin) or part.outputs.get(pin)
+                if width is None:
+                    raise Exception(f"{part_name} has no pin {pin}")
+                low, high = pin_range or (0, width - 1)
+                signal_low = signal_range[0] if signal_range else 0
+                connection = (pin, low, high - low + 1, signal, signal_low)
+                (reads if pin in part.inputs else writes).append(connection)
+            self.parts.append((part, reads, writes))
+
+    def evaluate(self, pins):
+        signals = self.signals
+        signals.update(pins)
+        constants = {"true": self.mask, "false": 0}
+        for _ in range(len(self.parts) + 1):
+            changed = False
+            for part, reads, writes in self.parts:
+                part_pins = {pin: [0] * width for pin, width in part.inputs.items()}
+                for pin, low, count, signal, signal_low in reads:
+                    target = part_pins[pin]
+                    if signal in constants:
+                        target[low:low + count] = [constants[signal]] * count
+                    else:
+                        bits = signals.get(signal, ())
+                        for i in range(count):
+                            if signal_low + i < len(bits):
+                                target[low + i] = bits[signal_low + i]
+                outs = part.evaluate(part_pins)
+                for pin, low, count, signal, signal_low in writes:
+                    bits = signals.setdefault(signal, [])
+                    if len(bits) < signal_low + count:
+                        bits += [0] * (signal_low + count - len(bits))
+                    for i in range(count):
+                        value = outs[pin][low + i]
+                        if bits[signal_low + i] != value:
+                            bits[signal_low + i] = value
+                            changed = True
+            if not changed:
+                break
+        else:
+            raise Exception(f"{self.name} does not settle")
+        return {pin: (signals.get(pin, []) + [0] * width)[:width] for pin, width in self.outputs.items()}
+
+    def latch(self):
+        for part, _, _ in self.parts:
+            part.latch()
+
+    def commit(self):
+        for part, _, _ in self.parts:
+            part.commit()
+
+    def blocks(self):
+        return [block for part, _, _ in self.parts for block in part.blocks()]
+
+    def all_state(self):
+        dffs, memories = [], []
+        for part, _, _ in self.parts:
+            if isinstance(part, Instance):
+                found = part.all_state()
+            else:
+                found = ([(part, i) for i in range(part.program.dff_count)],
+                         [(part, i) for i in range(len(part.memories))])
+            dffs += found[0]
+            memories += found[1]
+        return dffs, memories
+
+    def find_state(self, name):
+        if name == self.name:
+            return self.all_state()
+        for part, _, _ in self.parts:
+            found = part.find_state(name)
+            if found:
+                return found
+        return None
+
+
+class Library(object):
+    """
+    Finds chips: the first .hdl file of that name in the search
+    directories, else the native implementation
+    """
+    def __init__(self, directories, native=()):
+        self.directories = directories
+        self.native = LARGE_MEMORIES | set(native)
+        self.chips = {}
+        self.programs = {}
+
+    def chip(self, name):
+        """
+        The parsed HDL for name, or None when it is simulated natively
+        """
+        if name not in self.chips:
+            self.chips[name] = None
+            if name not in self.native:
+                for directory in self.directories:
+                    path = os.path.join(directory, f"{name}.hdl")
+                    if os.path.exists(path):
+                        with open(path) as f:
+                            chip = parse_hdl(f.read())
+                        if not chip.builtin:
+                            self.chips[name] = chip
+                        break
+            if self.chips[name] is None and name not in NATIVE:
+                raise Exception(f"Can't find chip {name}")
+        return self.chips[name]
+
+    def interface(self, name):
+        chip = self.chip(name)
+        if chip is None:
+            return NATIVE[name][0], NATIVE[name][1]
+        return chip.inputs, chip.outputs
+
+    def instantiate(self, nl, name, pins):
+        """
+        Add one instance of a chip to the netlist, given the wires on its
+        input pins; returns the wires on its output pins
+        """
+        chip = self.chip(name)
+        dffs, memories = len(nl.dffs), len(nl.memories)
+        outputs = self._flatten(nl, chip, pins) if chip else NATIVE[name][2](nl, pins)
+        if len(nl.dffs) > dffs or len(nl.memories) > memories:
+            nl.state.setdefault(name, (range(dffs, len(nl.dffs)), range(memories, len(nl.memories))))
+        return outputs
+
+    def _flatten(self, nl, chip, pins):
+        signals = {pin: list(wires) for pin, wires in pins.items()}
+
+        def signal(name, width):
+            bits = signals.setdefault(name, [])
+            while len(bits) < width:
+                bits.append(nl.wire())
+            return bits
+
+        for pin, width in chip.outputs.items():
+            signal(pin, width)
+        for part, connections in chip.parts:
+            inputs, outputs = self.interface(part)
+            part_pins = {pin: [FALSE] * width for pin, width in inputs.items()}
+            writes = []
+            for pin, pin_range, name, name_range in connections:
+                width = inputs.get(pin) or outputs.get(pin)
+                if width is None:
+                    raise Exception(f"{part} has no pin {pin} (in {chip.name})")
+                low, high = pin_range or (0, width - 1)
+                count = high - low + 1
+                name_low = name_range[0] if name_range else 0
+                if pin in outputs:
+                    writes.append((pin, low, count, name, name_low))
+                elif name in ("true", "false"):
+                    part_pins[pin][low:high + 1] = [TRUE if name == "true" else FALSE] * count
+                else:
+                    part_pins[pin][low:high + 1] = signal(name, name_low + count)[name_low:name_low + count]
+            outs = self.instantiate(nl, part, part_pins)
+            for pin, low, count, name, name_low in writes:
+                if name in chip.inputs:
+                    raise Exception(f"{part} drives input pin {name} of {chip.name}")
+                targets = signal(name, name_low + count)[name_low:name_low + count]
+                for target, wire in zip(targets, outs[pin][low:low + count]):
+                    nl.connect(target, wire)
+        return {pin: signals[pin][:width] for pin, width in chip.outputs.items()}
+
+    def program(self, name):
+        """
+        The chip flattened and compiled, cached by name
+        """
+        if name not in self.programs:
+            nl = Netlist()
+            inputs, outputs = self.interface(name)
+            pins = {pin: [nl.wire() for _ in range(width)] for pin, width in inputs.items()}
+            self.programs[name] = Program(name, nl, pins, self.instantiate(nl, name, pins))
+        return self.programs[name]
+
+
+class Simulator(object):
+    """
+    A chip loaded from its .hdl file, driven like the chips in Chips.py.
+    Values set on a pin may be one per lane; get returns lane 0 and
+    values returns every lane
+    """
+    def __init__(self, filename, lanes=1, flatten=True, search=(), native=()):
+        self.name = os.path.splitext(os.path.basename(filename))[0]
+        self.library = Library([os.path.dirname(os.path.abspath(filename))] + list(search), native)
+        self.inputs, self.outputs = self.library.interface(self.name)
+        self.lanes = lanes
+        self.flatten = flatten
+        self.circuit = self._circuit(lanes)
+        self.clocked = any(self._all_state())
+        self.pins = {pin: [0] * width for pin, width in self.inputs.items()}
+        self.results = {pin: [0] * width for pin, width in self.outputs.items()}
+
+    def _circuit(self, lanes):
+        if self.flatten or self.library.chip(self.name) is None:
+            return Circuit(self.library.program(self.name), lanes)
+        return Instance(self.library, self.name, lanes)
+
+    def _all_state(self):
+        if isinstance(self.circuit, Instance):
+            return self.circuit.all_state()
+        return [(self.circuit, i) for i in range(self.circuit.program.dff_count)], self.circuit.memories
+
+    def width(self, pin):
+        return self.inputs.get(pin) or self.outputs.get(pin) or 16
+
+    def set(self, pin, value):
+        if "[" in pin:
+            self.set_internal(pin, value)
+            return
+        if pin not in self.inputs:
+            raise Exception(f"{self.name} has no input pin {pin}")
+        values = value if isinstance(value, list) else [value] * self.lanes
+        width = self.inputs[pin]
+        self.pins[pin] = to_slices([v & ((1 << width) - 1) for v in values], width)
+
+    def get(self, pin, lane=0):
+        if "[" in pin:
+            return self.internal(pin, lane)
+        return from_lane(self._slices(pin), lane)
+
+    def values(self, pin):
+        return from_slices(self._slices(pin), self.lanes)
+
+    def _slices(self, pin):
+        if pin in self.inputs:
+            return self.pins[pin]
+        if pin not in self.outputs:
+            raise Exception(f"{self.name} has no pin {pin}")
+        return self.results[pin]
+
+    def _state(self, pin):
+        name, index = pin[:pin.index("[")], pin[pin.index("[") + 1:-1]
+        found = self.circuit.find_state(name)
+        if not found:
+            raise Exception(f"{self.name} has no internal pin {pin}")
+        return found, int(index or 0)
+
+    def internal(self, pin, lane=0):
+        (dffs, memories), index = self._state(pin)
+        if memories:
+            circuit, memory = memories[0]
+            return circuit.memories[memory].words[lane][index]
+        return sum((circuit.latched[i] >> lane & 1) << bit for bit, (circuit, i) in enumerate(dffs))
+
+    def set_internal(self, pin, value):
+        (dffs, memories), index = self._state(pin)
+        if not memories:
+            raise Exception(f"Can't set {pin}")
+        circuit, memory = memories[0]
+        for words in circuit.memories[memory].words:
+            words[index] = value & 0xFFFF
+
+    def eval(self):
+        self.results = self.circuit.evaluate(self.pins)
+
+    def tick(self):
+        self.eval()
+        self.circuit.latch()
+
+    def tock(self):
+        self.circuit.commit()
+        self.eval()
+
+    def run(self, cycles):
+        for _ in range(cycles):
+            self.tick()
+            self.tock()
+
+    @property
+    def keyboard(self):
+        return next((block.key for block in self.circuit.blocks() if block.kind == "keyboard"), 0)
+
+    @keyboard.setter
+    def keyboard(self, key):
+        for block in self.circuit.blocks():
+            if block.kind == "keyboard":
+                block.key = key
+
+    def load_rom(self, words):
+        for block in self.circuit.blocks():
+            if block.kind == "rom":
+                block.load(words)
+
+    def evaluate_batch(self, columns):
+        """
+        Evaluate a combinational chip over many input rows at once, one
+        row per lane; columns maps each input pin to its list of values
+        """
+        size = len(next(iter(columns.values()))) if columns else 1
+        circuit = self._circuit(size)
+        pins = {pin: to_slices([v & ((1 << width) - 1) for v in columns.get(pin, [0] * size)], width)
+                for pin, width in self.inputs.items()}
+        return {pin: from_slices(slices, size) for pin, slices in circuit.evaluate(pins).items()}
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Flatten an .hdl chip and report its netlist")
+    argparser.add_argument("chip", help=".hdl file")
+    argparser.add_argument("--search", nargs="*", default=[], help="more directories to look for parts in")
+    argparser.add_argument("--native", nargs="*", default=[], help="chips to simulate natively even with an .hdl")
+    argparser.add_argument("--source", action="store_true", help="print the compiled evaluation function")
+    args = argparser.parse_args()
+
+    start = time.perf_counter()
+    simulator = Simulator(args.chip, search=args.search, native=args.native)
+    program = simulator.circuit.program
+    print(f"{simulator.name}: {program.gate_count} gates, {program.dff_count} flip-flops, "
+          f"{len(program.memories)} memories, compiled in {time.perf_counter() - start:.2f}s")
+    if args.source:
+        sys.stdout.write(program.source)
@@ -0,0 +1,97 @@
+"""
+Times the HDL simulator on 05/CPU.hdl: hierarchical evaluation against
+the flattened netlist, one lane and many, with the parts either native
+(only 05 searched) or built from the project's own HDL down to Nand.
+Every run is checked cycle by cycle against the native CPU in Chips.py.
+"""
+import os
+import time
+import random
+import argparse
+
+import Chips
+from HDL import Simulator
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PROJECTS = os.path.dirname(HERE)
+CPU_HDL = os.path.join(PROJECTS, "05", "CPU.hdl")
+ALL_PARTS = [os.path.join(PROJECTS, d) for d in ("01", "02", os.path.join("03", "a"), os.path.join("03", "b"))]
+
+
+def stimulus(cycles, seed):
+    """
+    Random instructions and inM values; C-instructions get the fixed
+    top bits so every one of them is a valid Hack instruction
+    """
+    rng = random.Random(seed)
+    vectors = []
+    for _ in range(cycles):
+        instruction = rng.getrandbits(16)
+        if instruction & 0x8000:
+            instruction |= 0x6000
+        vectors.append((instruction, rng.getrandbits(16)))
+    return vectors
+
+
+def expected(vectors):
+    cpu = Chips.CPU()
+    rows = []
+    for instruction, in_m in vectors:
+        cpu.set("instruction", instruction)
+        cpu.set("inM", in_m)
+        cpu.tick()
+        rows.append(observe(cpu.get))
+        cpu.tock()
+    return rows
+
+
+def observe(get):
+    write = get("writeM")
+    return get("outM") if write else None, write, get("addressM"), get("pc")
+
+
+def run(simulator, streams):
+    """
+    Clock the CPU through one input stream per lane; returns lane 0's
+    outputs at every tick and the seconds taken
+    """
+    rows = []
+    start = time.perf_counter()
+    for vectors in zip(*streams):
+        simulator.set("instruction", [instruction for instruction, _ in vectors])
+        simulator.set("inM", [in_m for _, in_m in vectors])
+        simulator.tick()
+        rows.append(observe(simulator.get))
+        simulator.tock()
+    return rows, time.perf_counter() - start
+
+
+def benchmark(cycles, lanes, hierarchical_cycles):
+    print(f"{'parts':<8} {'mode':<14} {'lanes':>6} {'gates':>6} {'build s':>8} {'cycles/s':>10} {'lane-cycles/s':>14}")
+    streams = [stimulus(cycles, seed) for seed in range(lanes)]
+    want = expected(streams[0])
+    for parts, search in (("native", []), ("HDL", ALL_PARTS)):
+        for flatten, count in ((False, 1), (True, 1), (True, lanes)):
+            length = cycles if flatten else min(cycles, hierarchical_cycles)
+            start = time.perf_counter()
+            simulator = Simulator(CPU_HDL, lanes=count, flatten=flatten, search=search)
+            build = time.perf_counter() - start
+            gates = simulator.library.program("CPU").gate_count if flatten else ""
+            got, seconds = run(simulator, [stream[:length] for stream in streams[:count]])
+            if got != want[:length]:
+                cycle = next(i for i, (g, w) in enumerate(zip(got, want)) if g != w)
+                raise Exception(f"{parts} {'flattened' if flatten else 'hierarchical'} differs from Chips.CPU "
+                                f"at cycle {cycle}: {got[cycle]} != {want[cycle]}")
+            mode = "flattened" if flatten else "hierarchical"
+            print(f"{parts:<8} {mode:<14} {count:>6} {gates:>6} {build:>8.2f} {length / seconds:>10.0f} "
+                  f"{length * count / seconds:>14.0f}")
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Benchmark flattened against hierarchical HDL simulation")
+    argparser.add_argument("--cycles", type=int, default=2000, help="clock cycles per run")
+    argparser.add_argument("--hierarchical-cycles", type=int, default=50,
+                           help="cycle limit for the (much slower) hierarchical runs")
+    argparser.add_argument("--lanes", type=int, default=1024, help="lanes for the wide flattened run")
+    args = argparser.parse_args()
+    benchmark(args.cycles, args.lanes, args.hierarchical_cycles)
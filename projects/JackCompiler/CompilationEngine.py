@@ -0,0 +1,397 @@
+"""
+Recursive descent compiler for one Jack class. VM commands are emitted
+as each construct is parsed; there is no parse tree. With xml=True the
+engine also records the parse tree in the format of the golden *.xml
+files in projects/10, which is only used to check the parser against
+them.
+"""
+from Tokenizer import tokenize, line_number, escape
+
+SEGMENTS = {"static": "static", "field": "this", "argument": "argument", "var": "local"}
+OPERATORS = {"+": "add", "-": "sub", "*": "call Math.multiply 2", "/": "call Math.divide 2", "&": "and",
+             "|": "or", "<": "lt", ">": "gt", "=": "eq"}
+UNARY = {"-": "neg", "~": "not"}
+TYPES = ("int", "char", "boolean")
+
+
+class SymbolTable(object):
+    """
+    Variables of the class and of the subroutine being compiled, each
+    mapped to its (type, segment, index)
+    """
+    def __init__(self):
+        self.class_scope = {}
+        self.subroutine_scope = {}
+        self.counts = dict.fromkeys(SEGMENTS, 0)
+
+    def start_subroutine(self):
+        self.subroutine_scope = {}
+        self.counts["argument"] = self.counts["var"] = 0
+
+    def define(self, name, type, kind):
+        scope = self.class_scope if kind in ("static", "field") else self.subroutine_scope
+        scope[name] = (type, SEGMENTS[kind], self.counts[kind])
+        self.counts[kind] += 1
+
+    def lookup(self, name):
+        return self.subroutine_scope.get(name) or self.class_scope.get(name)
+
+
+class CompilationEngine(object):
+    def __init__(self, source, filename=None, xml=False):
+        self.source = source
+        self.filename = filename
+        self.tokens = tokenize(source, filename)
+        self.i = 0
+        self.vm = []
+        self.xml = [] if xml else None
+        self.depth = 0
+        self.symbols = SymbolTable()
+        self.classname = None
+        self.labels = 0
+
+    def compile(self):
+        """
+        The VM code for the class, as lines
+        """
+        self.compile_class()
+        if self.i < len(self.tokens):
+            self._error("end of file after the class")
+        return self.vm
+
+    def _error(self, expected):
+        if self.i < len(self.tokens):
+            kind, value, position = self.tokens[self.i]
+            found = f"'{value}'"
+        else:
+            position, found = len(self.source), "end of file"
+        raise Exception(f"{self.filename}:{line_number(self.source, position)}: expected {expected}, found {found}")
+
+    def _peek(self):
+        """
+        The next token if it is a keyword or symbol, which is all the
+        parser needs to look ahead for
+        """
+        if self.i < len(self.tokens):
+            kind, value, _ = self.tokens[self.i]
+            if kind == "keyword" or kind == "symbol":
+                return value
+        return None
+
+    def _take(self):
+        try:
+            kind, value, _ = self.tokens[self.i]
+        except IndexError:
+            self._error("more tokens")
+        self.i += 1
+        if self.xml is not None:
+            self.xml.append(f"{'  ' * self.depth}<{kind}> {escape(value)} </{kind}>")
+        return value
+
+    def _expect(self, value):
+        if self._peek() != value:
+            self._error(f"'{value}'")
+        self._take()
+
+    def _identifier(self):
+        if self.i >= len(self.tokens) or self.tokens[self.i][0] != "identifier":
+            self._error("an identifier")
+        return self._take()
+
+    def _type(self):
+        if self._peek() in TYPES:
+            return self._take()
+        return self._identifier()
+
+    def _open(self, tag):
+        if self.xml is not None:
+            self.xml.append(f"{'  ' * self.depth}<{tag}>")
+            self.depth += 1
+
+    def _close(self, tag):
+        if self.xml is not None:
+            self.depth -= 1
+            self.xml.append(f"{'  ' * self.depth}</{tag}>")
+
+    def _variable(self, name):
+        """
+        (type, segment, index) of a variable. The XML check also parses
+        programs whose names were never declared (ExpressionLessSquare),
+        so undeclared names are only an error when compiling
+        """
+        variable = self.symbols.lookup(name)
+        if variable is None:
+            if self.xml is None:
+                self.i -= 1
+                self._error("a declared variable")
+            variable = (None, "local", 0)
+        return variable
+
+    def _label(self, kind):
+        self.labels += 1
+        return f"{kind}{self.labels - 1}"
+
+    def compile_class(self):
+        self._open("class")
+        self._expect("class")
+        self.classname = self._identifier()
+        self._expect("{")
+        while self._peek() in ("static", "field"):
+            self.compile_class_var_dec()
+        while self._peek() in ("constructor", "function", "method"):
+            self.compile_subroutine()
+        self._expect("}")
+        self._close("class")
+
+    def compile_class_var_dec(self):
+        self._open("classVarDec")
+        kind = self._take()
+        type = self._type()
+        self.symbols.define(self._identifier(), type, kind)
+        while self._peek() == ",":
+            self._take()
+            self.symbols.define(self._identifier(), type, kind)
+        self._expect(";")
+        self._close("classVarDec")
+
+    def compile_subroutine(self):
+        self._open("subroutineDec")
+        self.symbols.start_subroutine()
+        self.labels = 0
+        kind = self._take()
+        if kind == "method":
+            self.symbols.define("this", self.classname, "argument")
+        if self._peek() == "void":
+            self._take()
+        else:
+            self._type()
+        name = self._identifier()
+        self._expect("(")
+        self.compile_parameter_list()
+        self._expect(")")
+
+        self._open("subroutineBody")
+        self._expect("{")
+        while self._peek() == "var":
+            self.compile_var_dec()
+        self.vm.append(f"function {self.classname}.{name} {self.symbols.counts['var']}")
+        if kind == "constructor":
+            self.vm += [f"push constant {self.symbols.counts['field']}", "call Memory.alloc 1", "pop pointer 0"]
+        elif kind == "method":
+            self.vm += ["push argument 0", "pop pointer 0"]
+        self.compile_statements()
+        self._expect("}")
+        self._close("subroutineBody")
+        self._close("subroutineDec")
+
+    def compile_parameter_list(self):
+        self._open("parameterList")
+        if self._peek() != ")":
+            while True:
+                type = self._type()
+                self.symbols.define(self._identifier(), type, "argument")
+                if self._peek() != ",":
+                    break
+                self._take()
+        self._close("parameterList")
+
+    def compile_var_dec(self):
+        self._open("varDec")
+        self._take()
+        type = self._type()
+        self.symbols.define(self._identifier(), type, "var")
+        while self._peek() == ",":
+            self._take()
+            self.symbols.define(self._identifier(), type, "var")
+        self._expect(";")
+        self._close("varDec")
+
+    def compile_statements(self):
+        self._open("statements")
+        while True:
+            keyword = self._peek()
+            if keyword == "let":
+                self.compile_let()
+            elif keyword == "if":
+                self.compile_if()
+            elif keyword == "while":
+                self.compile_while()
+            elif keyword == "do":
+                self.compile_do()
+            elif keyword == "return":
+                self.compile_return()
+            else:
+                break
+        self._close("statements")
+
+    def compile_let(self):
+        self._open("letStatement")
+        self._take()
+        _, segment, index = self._variable(self._identifier())
+        if self._peek() == "[":
+            self._take()
+            self.vm.append(f"push {segment} {index}")
+            self.compile_expression()
+            self._expect("]")
+            self.vm.append("add")
+            self._expect("=")
+            self.compile_expression()
+            self.vm += ["pop temp 0", "pop pointer 1", "push temp 0", "pop that 0"]
+        else:
+            self._expect("=")
+            self.compile_expression()
+            self.vm.append(f"pop {segment} {index}")
+        self._expect(";")
+        self._close("letStatement")
+
+    def compile_if(self):
+        self._open("ifStatement")
+        self._take()
+        otherwise = self._label("IF_FALSE")
+        self._expect("(")
+        self.compile_expression()
+        self._expect(")")
+        self.vm += ["not", f"if-goto {otherwise}"]
+        self._expect("{")
+        self.compile_statements()
+        self._expect("}")
+        if self._peek() == "else":
+            end = self._label("IF_END")
+            self.vm += [f"goto {end}", f"label {otherwise}"]
+            self._take()
+            self._expect("{")
+            self.compile_statements()
+            self._expect("}")
+            self.vm.append(f"label {end}")
+        else:
+            self.vm.append(f"label {otherwise}")
+        self._close("ifStatement")
+
+    def compile_while(self):
+        self._open("whileStatement")
+        self._take()
+        top, end = self._label("WHILE_EXP"), self._label("WHILE_END")
+        self.vm.append(f"label {top}")
+        self._expect("(")
+        self.compile_expression()
+        self._expect(")")
+        self.vm += ["not", f"if-goto {end}"]
+        self._expect("{")
+        self.compile_statements()
+        self._expect("}")
+        self.vm += [f"goto {top}", f"label {end}"]
+        self._close("whileStatement")
+
+    def compile_do(self):
+        self._open("doStatement")
+        self._take()
+        self.compile_call(self._identifier())
+        self._expect(";")
+        self.vm.append("pop temp 0")
+        self._close("doStatement")
+
+    def compile_return(self):
+        self._open("returnStatement")
+        self._take()
+        if self._peek() != ";":
+            self.compile_expression()
+        else:
+            self.vm.append("push constant 0")
+        self._expect(";")
+        self.vm.append("return")
+        self._close("returnStatement")
+
+    def compile_expression(self):
+        self._open("expression")
+        self.compile_term()
+        while self._peek() in OPERATORS:
+            operator = self._take()
+            self.compile_term()
+            self.vm.append(OPERATORS[operator])
+        self._close("expression")
+
+    def compile_term(self):
+        self._open("term")
+        if self.i >= len(self.tokens):
+            self._error("a term")
+        kind, value, _ = self.tokens[self.i]
+        if kind == "integerConstant":
+            self._take()
+            self.vm.append(f"push constant {int(value)}")
+        elif kind == "stringConstant":
+            self._take()
+            self.vm += [f"push constant {len(value)}", "call String.new 1"]
+            for character in value:
+                self.vm += [f"push constant {ord(character)}", "call String.appendChar 2"]
+        elif kind == "keyword" and value in ("true", "false", "null", "this"):
+            self._take()
+            if value == "true":
+                self.vm += ["push constant 0", "not"]
+            elif value == "this":
+                self.vm.append("push pointer 0")
+            else:
+                self.vm.append("push constant 0")
+        elif value == "(" and kind == "symbol":
+            self._take()
+            self.compile_expression()
+            self._expect(")")
+        elif value in UNARY and kind == "symbol":
+            self._take()
+            self.compile_term()
+            self.vm.append(UNARY[value])
+        elif kind == "identifier":
+            name = self._take()
+            following = self._peek()
+            if following == "[":
+                _, segment, index = self._variable(name)
+                self._take()
+                self.vm.append(f"push {segment} {index}")
+                self.compile_expression()
+                self._expect("]")
+                self.vm += ["add", "pop pointer 1", "push that 0"]
+            elif following in ("(", "."):
+                self.compile_call(name)
+            else:
+                _, segment, index = self._variable(name)
+                self.vm.append(f"push {segment} {index}")
+        else:
+            self._error("a term")
+        self._close("term")
+
+    def compile_call(self, name):
+        """
+        The rest of a subroutine call whose first identifier has been
+        read: name(...) is a method of this, variable.name(...) a method
+        of the variable's class and Class.name(...) a function
+        """
+        arguments = 0
+        if self._peek() == ".":
+            self._take()
+            subroutine = self._identifier()
+            variable = self.symbols.lookup(name)
+            if variable is not None:
+                type, segment, index = variable
+                self.vm.append(f"push {segment} {index}")
+                name, arguments = f"{type}.{subroutine}", 1
+            else:
+                name = f"{name}.{subroutine}"
+        else:
+            self.vm.append("push pointer 0")
+            name, arguments = f"{self.classname}.{name}", 1
+        self._expect("(")
+        arguments += self.compile_expression_list()
+        self._expect(")")
+        self.vm.append(f"call {name} {arguments}")
+
+    def compile_expression_list(self):
+        self._open("expressionList")
+        count = 0
+        if self._peek() != ")":
+            self.compile_expression()
+            count = 1
+            while self._peek() == ",":
+                self._take()
+                self.compile_expression()
+                count += 1
+        self._close("expressionList")
+        return count
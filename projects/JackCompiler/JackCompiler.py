@@ -0,0 +1,92 @@
+"""
+Jack compiler: every .jack file is compiled straight to a .vm file of
+the same name. Classes are independent, so a directory is compiled in a
+pool of processes, one class per task.
+"""
+import sys
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from CompilationEngine import CompilationEngine
+from Tokenizer import tokenize, tokens_xml
+
+
+def find_jack_files(input):
+    if os.path.isdir(input):
+        return sorted(os.path.join(input, f) for f in os.listdir(input) if f.endswith(".jack"))
+    if os.path.splitext(input)[1] != ".jack":
+        raise Exception(f"Input {input} is neither a .jack file nor a directory")
+    return [input]
+
+
+def compile_source(source, filename=None):
+    """
+    The VM code for the text of one .jack file, as lines
+    """
+    return CompilationEngine(source, filename).compile()
+
+
+def compile_file(filename):
+    """
+    Compile one .jack file, returning the name of the .vm file written
+    """
+    with open(filename) as f:
+        source = f.read()
+    vm = f"{os.path.splitext(filename)[0]}.vm"
+    lines = compile_source(source, filename)
+    with open(vm, "w") as f:
+        f.writelines(f"{l}\n" for l in lines)
+    return vm
+
+
+def compile_files(filenames, jobs=1):
+    if jobs > 1 and len(filenames) > 1:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(filenames))) as pool:
+            return list(pool.map(compile_file, filenames))
+    return [compile_file(filename) for filename in filenames]
+
+
+def read_golden(filename):
+    with open(filename) as f:
+        return [line.strip() for line in f.read().splitlines()]
+
+
+def check_xml(input):
+    """
+    Compare the tokens and parse tree of every .jack file with the golden
+    XxxT.xml and Xxx.xml files beside it, printing each comparison and
+    returning the number that differ
+    """
+    failures = 0
+    for filename in find_jack_files(input):
+        with open(filename) as f:
+            source = f.read()
+        base = os.path.splitext(filename)[0]
+        engine = CompilationEngine(source, filename, xml=True)
+        engine.compile()
+        for golden, lines in ((f"{base}T.xml", tokens_xml(tokenize(source, filename))), (f"{base}.xml", engine.xml)):
+            if not os.path.exists(golden):
+                continue
+            expected = read_golden(golden)
+            got = [line.strip() for line in lines]
+            if got == expected:
+                print(f"{golden}: ok")
+                continue
+            failures += 1
+            line = next((i for i, (a, b) in enumerate(zip(got, expected)) if a != b), min(len(got), len(expected)))
+            print(f"{golden}: line {line + 1} differs: expected {expected[line] if line < len(expected) else 'end'}, "
+                  f"got {got[line] if line < len(got) else 'end'}")
+    return failures
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Compile Jack classes to VM code")
+    argparser.add_argument("input", help=".jack file or directory of .jack files")
+    argparser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                           help="compile classes in a pool of this many processes")
+    argparser.add_argument("--check-xml", action="store_true",
+                           help="compare tokens and parse trees with the golden XxxT.xml and Xxx.xml files instead")
+    args = argparser.parse_args()
+    if args.check_xml:
+        sys.exit(1 if check_xml(args.input) else 0)
+    compile_files(find_jack_files(args.input), args.jobs)
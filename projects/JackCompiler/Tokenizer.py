@@ -0,0 +1,64 @@
+"""
+Jack tokenizer: one precompiled regular expression with an alternative
+per token kind, so the source is split in a single left to right scan.
+Whitespace and comments match an unnamed alternative and are dropped.
+"""
+import re
+
+KEYWORDS = frozenset(("class", "constructor", "function", "method", "field", "static", "var", "int", "char",
+                      "boolean", "void", "true", "false", "null", "this", "let", "do", "if", "else", "while",
+                      "return"))
+MAX_INTEGER = 32767
+
+TOKEN = re.compile(r"""
+    \s+ | //[^\n]* | /\*.*?\*/
+  | (?P<integerConstant>\d+)
+  | "(?P<stringConstant>[^"\n]*)"
+  | (?P<word>[A-Za-z_]\w*)
+  | (?P<unterminated>/\*|")
+  | (?P<symbol>[{}()\[\].,;+\-*/&|<>=~])
+  | (?P<error>.)
+""", re.S | re.X)
+
+
+def line_number(source, position):
+    return source.count("\n", 0, position) + 1
+
+
+def tokenize(source, filename=None):
+    """
+    (kind, value, position) for every token, kind being the tag the
+    token has in the XML token files: keyword, symbol, integerConstant,
+    stringConstant or identifier
+    """
+    tokens = []
+    append = tokens.append
+    for match in TOKEN.finditer(source):
+        kind = match.lastgroup
+        if kind is None:
+            continue
+        value = match.group(kind)
+        if kind == "word":
+            kind = "keyword" if value in KEYWORDS else "identifier"
+        elif kind == "integerConstant":
+            if int(value) > MAX_INTEGER:
+                raise Exception(f"{filename}:{line_number(source, match.start())}: "
+                                f"integer constant {value} is larger than {MAX_INTEGER}")
+        elif kind == "unterminated":
+            what = "comment" if value == "/*" else "string constant"
+            raise Exception(f"{filename}:{line_number(source, match.start())}: unterminated {what}")
+        elif kind == "error":
+            raise Exception(f"{filename}:{line_number(source, match.start())}: Don't recognise character '{value}'")
+        append((kind, value, match.start()))
+    return tokens
+
+
+def escape(value):
+    return value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+
+
+def tokens_xml(tokens):
+    """
+    The token file (the golden *T.xml) for a list of tokens, as lines
+    """
+    return ["<tokens>"] + [f"<{kind}> {escape(value)} </{kind}>" for kind, value, _ in tokens] + ["</tokens>"]
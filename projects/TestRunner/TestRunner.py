@@ -0,0 +1,447 @@
+"""
+Headless runner for the nand2tetris .tst scripts. Chip scripts run against
+the native chips in HardwareSimulator/Chips.py, scripts that load a
+Hack program run on CPUEmulator and scripts that load .vm code run on
+VMEmulator. Outputs are compared with the .cmp table
+cell by cell ('*' in the .cmp matches anything), and scripts run in a
+process pool with a summary at the end. With --hdl, chips that have an
+.hdl file next to the script are simulated from that file by HDL.py.
+"""
+import sys
+import os
+import re
+import time
+import argparse
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PROJECTS = os.path.dirname(HERE)
+sys.path.insert(0, os.path.join(PROJECTS, "HardwareSimulator"))
+sys.path.insert(0, os.path.join(PROJECTS, "CPUEmulator"))
+sys.path.insert(0, os.path.join(PROJECTS, "VMEmulator"))
+import Chips
+import HDL
+from Machine import CPU, load_program
+from VMEmulator import VM, compile_vm, find_vm_files
+from rom import load_rom
+
+TOKENS = re.compile(r'"[^"]*"|[{},;!]|[^\s{},;!"]+')
+COMMENTS = re.compile(r"//[^\n]*|/\*.*?\*/", re.S)
+OUTPUT_FORMAT = re.compile(r"^(.+?)%([BDXS])(\d+)\.(\d+)\.(\d+)$")
+
+
+class Skip(Exception):
+    pass
+
+
+def parse_script(text):
+    """
+    Parse a test script into a list of commands; each command is a list
+    of words, and repeat/while commands carry their body as a nested list
+    """
+    tokens = TOKENS.findall(COMMENTS.sub("", text))
+    position = 0
+
+    def block():
+        nonlocal position
+        commands, command = [], []
+        while position < len(tokens):
+            token = tokens[position]
+            position += 1
+            if token in ",;!":
+                if command:
+                    commands.append(command)
+                command = []
+            elif token == "{":
+                position_body = block()
+                command.append(position_body)
+                commands.append(command)
+                command = []
+            elif token == "}":
+                break
+            else:
+                command.append(token)
+        if command:
+            commands.append(command)
+        return commands
+
+    return block()
+
+
+def parse_value(text):
+    if text.startswith("%B"):
+        return int(text[2:], 2)
+    if text.startswith("%X"):
+        return int(text[2:], 16)
+    if text.startswith("%D"):
+        text = text[2:]
+    return int(text)
+
+
+class OutputColumn(object):
+    def __init__(self, spec):
+        match = OUTPUT_FORMAT.match(spec)
+        if match:
+            self.name, self.format = match.group(1), match.group(2)
+            self.left, self.width, self.right = (int(match.group(i)) for i in (3, 4, 5))
+        else:
+            self.name, self.format, self.left, self.width, self.right = spec, "B", 1, 16, 1
+
+    def header(self):
+        total = self.left + self.width + self.right
+        name = self.name[:total]
+        pad = (total - len(name)) // 2
+        return " " * pad + name + " " * (total - pad - len(name))
+
+    def cell(self, value, bits=16):
+        if self.format == "S":
+            text = str(value).ljust(self.width)
+        elif self.format == "B":
+            text = format(value & ((1 << self.width) - 1), "b").zfill(self.width)
+        elif self.format == "X":
+            text = format(value & 0xFFFF, "X").zfill(self.width)
+        else:
+            if bits == 16 and value & 0x8000:
+                value -= 0x10000
+            text = str(value).rjust(self.width)
+        return " " * self.left + text[-self.width:] + " " * self.right
+
+
+class Driver(object):
+    """
+    What a test script drives: holds simulated time and formats rows
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.time = "0"
+
+    def row(self, columns):
+        return "|" + "|".join(column.cell(*self.value(column.name)) for column in columns) + "|"
+
+    def value(self, name):
+        if name == "time":
+            return self.time, 0
+        return self.get(name), self.width(name)
+
+    def width(self, name):
+        return 16
+
+    def clock(self, phase):
+        t = int(self.time.rstrip("+"))
+        self.time = f"{t}+" if phase == "tick" else str(t + 1)
+
+    def press_key(self, key):
+        pass
+
+    def run_repeat(self, count, body, execute):
+        for _ in range(count):
+            execute(body)
+
+
+class ChipDriver(Driver):
+    def __init__(self, directory, name, hdl=False):
+        super().__init__(directory)
+        self.name = name
+        path = os.path.join(directory, f"{name}.hdl")
+        if hdl and os.path.exists(path):
+            self.chip = HDL.Simulator(path)
+        else:
+            self.chip = Chips.create(name)
+
+    def get(self, name):
+        return self.chip.get(name)
+
+    def width(self, name):
+        return 16 if "[" in name else self.chip.width(name)
+
+    def set(self, name, value):
+        if "[" in name:
+            self.chip.set_internal(name, value)
+        else:
+            self.chip.set(name, value)
+
+    def eval(self):
+        self.chip.eval()
+
+    def tick(self):
+        self.clock("tick")
+        self.chip.tick()
+
+    def tock(self):
+        self.clock("tock")
+        self.chip.tock()
+
+    def press_key(self, key):
+        self.chip.keyboard = key
+
+    def load_rom(self, filename):
+        self.chip.load_rom(load_rom(os.path.join(self.directory, filename)))
+
+    def evaluate_batch(self, columns):
+        if isinstance(self.chip, HDL.Simulator):
+            return self.chip.evaluate_batch(columns)
+        return Chips.evaluate_batch(self.chip.function, columns)
+
+
+class CPUDriver(Driver):
+    def __init__(self, directory, filename):
+        super().__init__(directory)
+        self.cpu = CPU(load_program(os.path.join(directory, filename)))
+
+    def get(self, name):
+        if name.startswith("RAM["):
+            return self.cpu.ram[int(name[4:-1])]
+        return {"PC": self.cpu.pc, "A": self.cpu.a, "D": self.cpu.d}[name]
+
+    def set(self, name, value):
+        if name.startswith("RAM["):
+            self.cpu.poke(int(name[4:-1]), value)
+        elif name == "PC":
+            self.cpu.pc = value
+            self.cpu.halted = False
+        elif name in ("A", "D"):
+            setattr(self.cpu, name.lower(), value & 0xFFFF)
+        else:
+            raise Exception(f"Can't set {name}")
+
+    def ticktock(self):
+        self.cpu.run(1)
+
+    def run_repeat(self, count, body, execute):
+        if body == [["ticktock"]]:
+            self.cpu.run(count)
+        else:
+            super().run_repeat(count, body, execute)
+
+
+class VMDriver(Driver):
+    """
+    Runs .vm code one VM command per vmstep, so superinstructions are off
+    """
+    POINTERS = {"sp": 0, "local": 1, "argument": 2, "this": 3, "that": 4}
+
+    def __init__(self, directory, filename):
+        super().__init__(directory)
+        self.vm = VM(compile_vm(os.path.join(directory, filename) if filename else directory, fuse=False))
+
+    def _address(self, name):
+        if name in self.POINTERS:
+            return self.POINTERS[name]
+        segment, index = name[:name.index("[")], int(name[name.index("[") + 1:-1])
+        if segment == "RAM":
+            return index
+        if segment == "temp":
+            return 5 + index
+        if segment in self.POINTERS:
+            return self.vm.ram[self.POINTERS[segment]] + index
+        raise Exception(f"Don't recognise VM variable {name}")
+
+    def get(self, name):
+        return self.vm.ram[self._address(name)]
+
+    def set(self, name, value):
+        self.vm.poke(self._address(name), value)
+
+    def vmstep(self):
+        self.vm.run(1)
+
+    def run_repeat(self, count, body, execute):
+        if body == [["vmstep"]]:
+            self.vm.run(count)
+        else:
+            super().run_repeat(count, body, execute)
+
+
+class Script(object):
+    def __init__(self, path, hdl=False):
+        self.path = path
+        self.hdl = hdl
+        self.directory = os.path.dirname(path)
+        with open(path) as f:
+            self.commands = parse_script(f.read())
+        self.driver = None
+        self.columns = []
+        self.header_due = False
+        self.compare_to = None
+        self.lines = []
+
+    def load(self, args):
+        if not args:
+            if not find_vm_files(self.directory):
+                raise Skip("no .vm files (compile the Jack sources first)")
+            self.driver = VMDriver(self.directory, None)
+            return
+        filename = args[0]
+        extension = os.path.splitext(filename)[1]
+        if extension == ".vm":
+            self.driver = VMDriver(self.directory, filename)
+        elif extension == ".hdl":
+            self.driver = ChipDriver(self.directory, os.path.splitext(filename)[0], self.hdl)
+        elif extension in (".asm", ".hack"):
+            self.driver = CPUDriver(self.directory, filename)
+        else:
+            raise Skip(f"can't load {filename}")
+
+    def header(self):
+        # each output-list starts a new table with its own header line
+        if self.header_due:
+            self.lines.append("|" + "|".join(column.header() for column in self.columns) + "|")
+            self.header_due = False
+
+    def output(self):
+        self.header()
+        if isinstance(self.driver, ChipDriver) and not self.driver.chip.clocked:
+            self.driver.eval()
+        self.lines.append(self.driver.row(self.columns))
+
+    def execute(self, commands):
+        for command in commands:
+            word, args = command[0], command[1:]
+            if word == "load":
+                self.load(args)
+            elif word == "output-file" or word == "clear-echo":
+                pass
+            elif word == "echo":
+                if self.driver is not None:
+                    self.driver.press_key(0)
+            elif word == "compare-to":
+                self.compare_to = os.path.join(self.directory, args[0])
+            elif word == "output-list":
+                self.columns = [OutputColumn(spec) for spec in args]
+                self.header_due = True
+            elif word == "set":
+                self.driver.set(args[0], parse_value(args[1]))
+            elif word == "output":
+                self.output()
+            elif word in ("eval", "tick", "tock", "ticktock", "vmstep"):
+                getattr(self.driver, word)()
+            elif word == "repeat":
+                if len(args) == 1:
+                    raise Skip("runs forever")
+                self.driver.run_repeat(int(args[0]), args[1], self.execute)
+            elif word == "while":
+                self.run_while(args)
+            elif word == "ROM32K":
+                self.driver.load_rom(args[1])
+            else:
+                raise Exception(f"Don't recognise script command {word}")
+
+    def run_while(self, args, limit=1000000):
+        """
+        Scripts wait for a key with 'while out <> key'. Headless, the key
+        is held down from here until the next echo
+        """
+        pin, operator, value, body = args
+        if operator != "<>":
+            raise Exception(f"Don't recognise while condition {operator}")
+        self.driver.press_key(parse_value(value))
+        for _ in range(limit):
+            if self.driver.get(pin) == parse_value(value) & 0xFFFF:
+                return
+            self.execute(body)
+        raise Exception(f"while {pin} <> {value} never finished")
+
+    def run_batch(self):
+        """
+        For combinational chips whose script never clocks, gather the
+        inputs at every output and evaluate them all at once
+        """
+        chip = self.driver.chip
+        current = {pin: 0 for pin in chip.inputs}
+        rows = []
+        for command in self.remaining:
+            word, args = command[0], command[1:]
+            if word == "set":
+                current[args[0]] = parse_value(args[1]) & ((1 << chip.inputs[args[0]]) - 1)
+            elif word == "output":
+                rows.append(dict(current))
+            elif word != "eval":
+                raise Exception(f"Don't recognise script command {word}")
+        columns = {pin: [row[pin] for row in rows] for pin in chip.inputs}
+        results = self.driver.evaluate_batch(columns) if rows else {}
+        results.update(columns)
+        self.header()
+        for i in range(len(rows)):
+            self.lines.append("|" + "|".join(
+                column.cell(results[column.name][i], chip.width(column.name)) for column in self.columns) + "|")
+
+    def run(self):
+        # the header commands (load, output-list...) come before the first set
+        header = 0
+        while header < len(self.commands) and self.commands[header][0] not in ("set", "eval", "output", "repeat",
+                                                                                 "tick", "tock", "ticktock", "ROM32K",
+                                                                                 "while", "vmstep"):
+            header += 1
+        self.execute(self.commands[:header])
+        if self.compare_to is None:
+            raise Skip("no compare-to file")
+        self.remaining = self.commands[header:]
+        words = {command[0] for command in self.remaining}
+        if (isinstance(self.driver, ChipDriver) and not self.driver.chip.clocked
+                and words <= {"set", "eval", "output"}):
+            self.run_batch()
+        else:
+            self.execute(self.remaining)
+        return self.compare()
+
+    def compare(self):
+        with open(self.compare_to) as f:
+            expected = [line.rstrip("\n") for line in f if line.strip()]
+        for number, (got, want) in enumerate(zip(self.lines, expected), 1):
+            got_cells = [cell.strip() for cell in got.strip("|").split("|")]
+            want_cells = [cell.strip() for cell in want.strip().strip("|").split("|")]
+            if len(got_cells) != len(want_cells) or any(
+                    w != g and not set(w) <= {"*"} for g, w in zip(got_cells, want_cells)):
+                return f"line {number}: expected {want.strip()} got {got}"
+        if len(self.lines) != len(expected):
+            return f"expected {len(expected)} lines, got {len(self.lines)}"
+        return None
+
+
+def run_script(path, hdl=False):
+    """
+    Run one script; returns (path, status, message, seconds)
+    """
+    start = time.perf_counter()
+    try:
+        failure = Script(path, hdl).run()
+        status, message = ("fail", failure) if failure else ("pass", "")
+    except Skip as skip:
+        status, message = "skip", str(skip)
+    except Exception as e:
+        status, message = "error", f"{type(e).__name__}: {e}"
+    return path, status, message, time.perf_counter() - start
+
+
+def find_scripts(paths):
+    scripts = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                scripts += [os.path.join(root, f) for f in files if f.endswith(".tst")]
+        else:
+            scripts.append(path)
+    return sorted(scripts)
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Run .tst scripts against their .cmp files")
+    argparser.add_argument("paths", nargs="*", default=[PROJECTS], help=".tst files or directories to search")
+    argparser.add_argument("--jobs", type=int, default=os.cpu_count(), help="number of worker processes")
+    argparser.add_argument("--hdl", action="store_true", help="simulate chips from their .hdl files")
+    argparser.add_argument("--verbose", action="store_true", help="list passing and skipped scripts too")
+    args = argparser.parse_args()
+
+    start = time.perf_counter()
+    scripts = find_scripts(args.paths)
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        results = list(pool.map(partial(run_script, hdl=args.hdl), scripts))
+    counts = {}
+    for path, status, message, seconds in results:
+        counts[status] = counts.get(status, 0) + 1
+        if status in ("fail", "error") or args.verbose:
+            print(f"{status.upper():<6} {os.path.relpath(path, PROJECTS)} ({seconds:.2f}s) {message}")
+    summary = ", ".join(f"{counts.get(status, 0)} {status}" for status in ("pass", "fail", "error", "skip"))
+    print(f"{len(results)} scripts: {summary} in {time.perf_counter() - start:.2f}s")
+    sys.exit(1 if counts.get("fail") or counts.get("error") else 0)
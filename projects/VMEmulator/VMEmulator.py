@@ -0,0 +1,486 @@
+"""
+Headless VM emulator. .vm files are compiled into bytecode: one opcode
+and one pre-parsed operand per VM command, with labels, function entry
+points and static addresses resolved up front. Common command pairs are
+fused into superinstructions, and a single dispatch loop runs the result
+against a Hack-style RAM, so the emulator doubles as a reference oracle
+for the translated Hack code.
+"""
+import sys
+import os
+import re
+import argparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PROJECTS = os.path.dirname(HERE)
+sys.path.insert(0, os.path.join(PROJECTS, "VMTranslator"))
+sys.path.insert(0, os.path.join(PROJECTS, "CPUEmulator"))
+from CodeWriter import CodeWriter, Operate, Push, Pop, Label, GoTo, IfGoTo, Call, Function, Return
+
+RAM_SIZE = 0x8000
+STACK_BASE = 256
+STATIC_BASE = 16
+TRUE = 0xFFFF
+
+(PUSH_CONST, PUSH_LOCAL, PUSH_ARG, PUSH_THIS, PUSH_THAT, PUSH_RAM,
+ POP_LOCAL, POP_ARG, POP_THIS, POP_THAT, POP_RAM,
+ ADD, SUB, NEG, EQ, GT, LT, AND, OR, NOT,
+ GOTO, IF_GOTO, CALL, CALL_NATIVE, FUNCTION, RETURN, HALT,
+ ADD_CONST, SUB_CONST, IF_EQ, IF_GT, IF_LT, IF_NOT) = range(33)
+
+SEGMENTS = {"local": (PUSH_LOCAL, POP_LOCAL), "argument": (PUSH_ARG, POP_ARG),
+            "this": (PUSH_THIS, POP_THIS), "that": (PUSH_THAT, POP_THAT)}
+ARITHMETIC = {"add": ADD, "sub": SUB, "neg": NEG, "eq": EQ, "gt": GT, "lt": LT, "and": AND, "or": OR, "not": NOT}
+# (first, second) -> superinstruction; the operand comes from the command named
+SUPERINSTRUCTIONS = {
+    (PUSH_CONST, ADD): (ADD_CONST, 0),
+    (PUSH_CONST, SUB): (SUB_CONST, 0),
+    (EQ, IF_GOTO): (IF_EQ, 1),
+    (GT, IF_GOTO): (IF_GT, 1),
+    (LT, IF_GOTO): (IF_LT, 1),
+    (NOT, IF_GOTO): (IF_NOT, 1),
+}
+
+
+def _signed(value):
+    return value - 0x10000 if value & 0x8000 else value
+
+
+def _divide(x, y):
+    if not y:
+        raise Exception("Math.divide by zero")
+    quotient = abs(_signed(x)) // abs(_signed(y))
+    return quotient if (_signed(x) < 0) == (_signed(y) < 0) else -quotient
+
+
+def _sqrt(x):
+    if _signed(x) < 0:
+        raise Exception(f"Math.sqrt of negative {_signed(x)}")
+    return int(x ** 0.5)
+
+
+# OS functions run natively when the program doesn't define them
+NATIVE_FUNCTIONS = {
+    "Math.multiply": (2, lambda ram, x, y: _signed(x) * _signed(y)),
+    "Math.divide": (2, lambda ram, x, y: _divide(x, y)),
+    "Math.abs": (1, lambda ram, x: abs(_signed(x))),
+    "Math.min": (2, lambda ram, x, y: min(_signed(x), _signed(y))),
+    "Math.max": (2, lambda ram, x, y: max(_signed(x), _signed(y))),
+    "Math.sqrt": (1, lambda ram, x: _sqrt(x)),
+    "Memory.peek": (1, lambda ram, address: ram[address]),
+    "Memory.poke": (2, lambda ram, address, value: ram.__setitem__(address, value) or 0),
+}
+
+
+class Program(object):
+    """
+    Bytecode for a set of .vm files: parallel lists of opcodes and
+    operands, plus where each command came from
+    """
+    def __init__(self):
+        self.code = []
+        self.operands = []
+        self.sources = []           # (file, line, command) for each opcode
+        self.functions = {}
+        self.labels = {}
+        self.statics = {}
+        self.fused = 0
+
+    def emit(self, opcode, operand, source):
+        self.code.append(opcode)
+        self.operands.append(operand)
+        self.sources.append(source)
+
+    def static(self, base, index):
+        return self.statics.setdefault(f"{base}.{index}", STATIC_BASE + len(self.statics))
+
+    def add_file(self, base, text):
+        function = None
+        for number, line in enumerate(text.splitlines(), 1):
+            command = line.split("//")[0].strip()
+            if not command:
+                continue
+            source = (f"{base}.vm", number, command)
+            words = command.split()
+            handler = next((h for m, h in CodeWriter.mapping.items() if words[0] == m), Operate)
+            try:
+                if handler is Push or handler is Pop:
+                    self._memory_command(handler is Push, words[1], int(words[2]), base, source)
+                elif handler is Label:
+                    self.labels[(function, words[1])] = len(self.code)
+                elif handler is GoTo or handler is IfGoTo:
+                    self.emit(GOTO if handler is GoTo else IF_GOTO, (function, words[1]), source)
+                elif handler is Call:
+                    self.emit(CALL, (words[1], int(words[2])), source)
+                elif handler is Function:
+                    function = words[1]
+                    self.functions[function] = len(self.code)
+                    self.emit(FUNCTION, int(words[2]), source)
+                elif handler is Return:
+                    self.emit(RETURN, None, source)
+                elif handler is Operate and words[0] in ARITHMETIC:
+                    self.emit(ARITHMETIC[words[0]], None, source)
+                else:
+                    raise Exception(f"Don't recognise VM command {command}")
+            except (IndexError, ValueError):
+                raise Exception(f"{base}.vm:{number}: malformed VM command {command}")
+            except Exception as e:
+                raise Exception(f"{base}.vm:{number}: {e}")
+
+    def _memory_command(self, push, segment, index, base, source):
+        if segment == "constant":
+            if not push:
+                raise Exception("Can't pop to constant")
+            self.emit(PUSH_CONST, index & 0xFFFF, source)
+        elif segment in SEGMENTS:
+            self.emit(SEGMENTS[segment][0 if push else 1], index, source)
+        elif segment in ("temp", "pointer", "static"):
+            address = {"temp": 5 + index, "pointer": 3 + index}.get(segment) or self.static(base, index)
+            self.emit(PUSH_RAM if push else POP_RAM, address, source)
+        else:
+            raise Exception(f"Don't recognise segment {segment}")
+
+    def link(self, fuse=True):
+        """
+        Resolve jump targets and calls, turn jumps to themselves into
+        halts and, with fuse, rewrite command pairs as superinstructions.
+        The second command of a pair stays in place (the superinstruction
+        skips over it) so no address moves
+        """
+        self.emit(HALT, None, ("", 0, "end of program"))
+        targets = set(self.labels.values()) | set(self.functions.values())
+        for pc, (opcode, operand) in enumerate(zip(self.code, self.operands)):
+            file, line, command = self.sources[pc]
+            if opcode in (GOTO, IF_GOTO):
+                if operand not in self.labels:
+                    raise Exception(f"{file}:{line}: no label {operand[1]} in {operand[0]}")
+                target = self.labels[operand]
+                if opcode == GOTO and target == pc:
+                    self.code[pc] = HALT
+                self.operands[pc] = target
+            elif opcode == CALL:
+                name, arguments = operand
+                if name in self.functions:
+                    self.operands[pc] = (self.functions[name], arguments)
+                    targets.add(pc + 1)
+                elif name in NATIVE_FUNCTIONS and NATIVE_FUNCTIONS[name][0] == arguments:
+                    self.code[pc] = CALL_NATIVE
+                    self.operands[pc] = NATIVE_FUNCTIONS[name]
+                else:
+                    raise Exception(f"{file}:{line}: no function {name}")
+        if fuse:
+            pc = 0
+            while pc < len(self.code) - 1:
+                fused = SUPERINSTRUCTIONS.get((self.code[pc], self.code[pc + 1]))
+                if fused and pc + 1 not in targets:
+                    opcode, operand_from = fused
+                    self.code[pc] = opcode
+                    self.operands[pc] = self.operands[pc + operand_from]
+                    self.fused += 1
+                    pc += 1
+                pc += 1
+        return self
+
+
+def find_vm_files(input):
+    if os.path.isdir(input):
+        return sorted(os.path.join(input, f) for f in os.listdir(input) if f.endswith(".vm"))
+    return [input]
+
+
+def compile_vm(input, fuse=True):
+    """
+    Compile a .vm file or a directory of them into linked bytecode
+    """
+    program = Program()
+    for filename in find_vm_files(input):
+        with open(filename) as f:
+            program.add_file(os.path.splitext(os.path.basename(filename))[0], f.read())
+    return program.link(fuse)
+
+
+class VM(object):
+    def __init__(self, program):
+        self.program = program
+        self.ram = [0] * RAM_SIZE
+        self.pc = program.functions.get("Sys.init", 0)
+        self.halted = False
+        self.dispatched = 0
+        self.commands = 0
+
+    def boot(self):
+        """
+        What the translator's bootstrap does: SP=256, call Sys.init 0.
+        The saved return address is the final halt
+        """
+        ram = self.ram
+        frame = [len(self.program.code) - 1] + ram[1:5]
+        ram[STACK_BASE:STACK_BASE + 5] = frame
+        ram[0] = ram[1] = STACK_BASE + 5
+        ram[2] = STACK_BASE
+        self.pc = self.program.functions["Sys.init"]
+
+    def peek(self, address):
+        return _signed(self.ram[address])
+
+    def poke(self, address, value):
+        self.ram[address] = value & 0xFFFF
+
+    def run(self, steps):
+        """
+        Dispatch up to steps opcodes (a superinstruction counts as one),
+        stopping at a halt. Returns the number dispatched
+        """
+        code, operands, ram = self.program.code, self.program.operands, self.ram
+        halt = len(code) - 1                # returns to addresses outside the program halt
+        pc, sp = self.pc, ram[0]
+        fused = 0
+        executed = 0
+        while executed < steps:
+            executed += 1
+            op = code[pc]
+            if op == PUSH_CONST:
+                ram[sp] = operands[pc]
+                sp += 1
+                pc += 1
+            elif op == PUSH_LOCAL:
+                ram[sp] = ram[ram[1] + operands[pc]]
+                sp += 1
+                pc += 1
+            elif op == PUSH_ARG:
+                ram[sp] = ram[ram[2] + operands[pc]]
+                sp += 1
+                pc += 1
+            elif op == POP_LOCAL:
+                sp -= 1
+                ram[ram[1] + operands[pc]] = ram[sp]
+                pc += 1
+            elif op == ADD_CONST:
+                ram[sp - 1] = (ram[sp - 1] + operands[pc]) & 0xFFFF
+                pc += 2
+                fused += 1
+            elif op == IF_LT or op == IF_GT or op == IF_EQ:
+                sp -= 2
+                difference = (ram[sp] - ram[sp + 1]) & 0xFFFF     # wrapped x-y, as the translator tests it
+                if (difference >= 0x8000 if op == IF_LT else
+                        (0 < difference < 0x8000 if op == IF_GT else not difference)):
+                    pc = operands[pc]
+                else:
+                    pc += 2
+                fused += 1
+            elif op == IF_NOT:
+                sp -= 1
+                pc = operands[pc] if ram[sp] != TRUE else pc + 2     # not x is zero only for x = -1
+                fused += 1
+            elif op == GOTO:
+                pc = operands[pc]
+            elif op == IF_GOTO:
+                sp -= 1
+                pc = operands[pc] if ram[sp] else pc + 1
+            elif op == ADD:
+                sp -= 1
+                ram[sp - 1] = (ram[sp - 1] + ram[sp]) & 0xFFFF
+                pc += 1
+            elif op == SUB:
+                sp -= 1
+                ram[sp - 1] = (ram[sp - 1] - ram[sp]) & 0xFFFF
+                pc += 1
+            elif op == SUB_CONST:
+                ram[sp - 1] = (ram[sp - 1] - operands[pc]) & 0xFFFF
+                pc += 2
+                fused += 1
+            elif op == PUSH_THIS:
+                ram[sp] = ram[ram[3] + operands[pc]]
+                sp += 1
+                pc += 1
+            elif op == PUSH_THAT:
+                ram[sp] = ram[ram[4] + operands[pc]]
+                sp += 1
+                pc += 1
+            elif op == PUSH_RAM:
+                ram[sp] = ram[operands[pc]]
+                sp += 1
+                pc += 1
+            elif op == POP_ARG:
+                sp -= 1
+                ram[ram[2] + operands[pc]] = ram[sp]
+                pc += 1
+            elif op == POP_THIS:
+                sp -= 1
+                ram[ram[3] + operands[pc]] = ram[sp]
+                pc += 1
+            elif op == POP_THAT:
+                sp -= 1
+                ram[ram[4] + operands[pc]] = ram[sp]
+                pc += 1
+            elif op == POP_RAM:
+                sp -= 1
+                ram[operands[pc]] = ram[sp]
+                pc += 1
+            elif op == CALL:
+                target, arguments = operands[pc]
+                ram[sp:sp + 5] = (pc + 1, ram[1], ram[2], ram[3], ram[4])
+                sp += 5
+                ram[2] = sp - 5 - arguments
+                ram[1] = sp
+                pc = target
+            elif op == FUNCTION:
+                count = operands[pc]
+                ram[sp:sp + count] = [0] * count
+                sp += count
+                pc += 1
+            elif op == RETURN:
+                frame = ram[1]
+                pc = min(ram[frame - 5], halt)     # read before the result can overwrite it
+                result = ram[sp - 1]
+                sp = ram[2]
+                ram[sp] = result
+                sp += 1
+                ram[1:5] = ram[frame - 4:frame]
+            elif op == LT or op == GT or op == EQ:
+                sp -= 1
+                difference = (ram[sp - 1] - ram[sp]) & 0xFFFF     # wrapped x-y, as the translator tests it
+                ram[sp - 1] = TRUE if (difference >= 0x8000 if op == LT else
+                                       (0 < difference < 0x8000 if op == GT else not difference)) else 0
+                pc += 1
+            elif op == NOT:
+                ram[sp - 1] ^= 0xFFFF
+                pc += 1
+            elif op == NEG:
+                ram[sp - 1] = -ram[sp - 1] & 0xFFFF
+                pc += 1
+            elif op == AND:
+                sp -= 1
+                ram[sp - 1] &= ram[sp]
+                pc += 1
+            elif op == OR:
+                sp -= 1
+                ram[sp - 1] |= ram[sp]
+                pc += 1
+            elif op == CALL_NATIVE:
+                arguments, function = operands[pc]
+                sp -= arguments
+                try:
+                    ram[sp] = function(ram, *ram[sp:sp + arguments]) & 0xFFFF
+                except Exception as e:
+                    file, line, command = self.program.sources[pc]
+                    raise Exception(f"{file}:{line}: {e}")
+                sp += 1
+                pc += 1
+            elif op == HALT:
+                executed -= 1
+                self.halted = True
+                break
+            else:
+                raise Exception(f"Don't recognise opcode {op}")
+        self.pc = pc
+        ram[0] = sp
+        self.dispatched += executed
+        self.commands += executed + fused
+        return executed
+
+
+def differential(input, addresses, ram=(), steps=10000000, cycles=10000000, intrinsics=(), outline=None):
+    """
+    Run a VM program on the emulator and, translated, on CPUEmulator in
+    each translation mode (with the OS calls in intrinsics lowered, which
+    checks them against the native OS, and outlined at speed outline if
+    it is set). Returns {mode: (cycles, differences)} for the RAM
+    addresses given, and "vm": (dispatches, commands). lt and gt test the
+    sign of the 16-bit x-y here, as every translation mode does, so a
+    comparison whose difference overflows (100 < -32767 is true) agrees
+    with the Hack code rather than with true signed order
+    """
+    from Machine import CPU
+    from VMTranslator import vm2hack
+
+    if not addresses:
+        raise Exception(f"No RAM addresses to compare for {input}")
+    vm = VM(compile_vm(input))
+    for address, value in ram:
+        vm.poke(address, value)
+    if len(find_vm_files(input)) > 1:
+        vm.boot()
+    vm.run(steps)
+    want = {address: vm.peek(address) for address in addresses}
+    results = {"vm": (vm.dispatched, vm.commands)}
+    for registers in (False, True):
+        for optimize in (False, True):
+            for shared in (False, True):
+                cpu = CPU(vm2hack(input, optimize=optimize, shared=shared, registers=registers, intrinsics=intrinsics,
+                                   outline=outline))
+                for address, value in ram:
+                    cpu.poke(address, value)
+                executed = cpu.run(cycles)
+                got = {address: cpu.peek(address) for address in addresses}
+                differences = {a: (got[a], want[a]) for a in addresses if got[a] != want[a]}
+                mode = ("registers " if registers else "") + ("optimized " if optimize else "") + \
+                    ("shared" if shared else "inline")
+                results[mode] = (executed, differences)
+    return results
+
+
+def test_setup(directory):
+    """
+    RAM initialisation, output addresses and cycle count from the CPU
+    test script next to a program (the one not ending VME.tst)
+    """
+    scripts = [f for f in os.listdir(directory) if f.endswith(".tst") and not f.endswith("VME.tst")]
+    if not scripts:
+        return [], [], None
+    with open(os.path.join(directory, scripts[0])) as f:
+        text = f.read()
+    ram = [(int(a), int(v)) for a, v in re.findall(r"set RAM\[(\d+)\]\s+(-?\d+)", text)]
+    outputs = text.split("output-list")[1].split(";")[0]
+    cycles = re.search(r"repeat\s+(\d+)", text)
+    return ram, [int(a) for a in re.findall(r"RAM\[(\d+)\]", outputs)], cycles and int(cycles.group(1))
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Run .vm programs on a bytecode VM")
+    argparser.add_argument("input", help=".vm file or directory of .vm files")
+    argparser.add_argument("--steps", type=int, default=10000000, help="dispatch budget")
+    argparser.add_argument("--set", action="append", default=[], metavar="ADDRESS=VALUE",
+                           help="initialise a RAM word before running")
+    argparser.add_argument("--dump", action="append", default=[], metavar="START[:END]",
+                           help="RAM range to print at exit")
+    argparser.add_argument("--no-fuse", action="store_true", help="don't use superinstructions")
+    argparser.add_argument("--boot", action="store_true",
+                           help="start with the translator's bootstrap (SP=256, call Sys.init)")
+    argparser.add_argument("--check", action="store_true",
+                           help="compare against the translated program on CPUEmulator, using the RAM set-up "
+                                "and outputs of the directory's test script")
+    argparser.add_argument("--compare", action="append", default=[], metavar="START[:END]",
+                           help="with --check, RAM range to compare as well as the test script's outputs "
+                                "(needed when there is no test script)")
+    args = argparser.parse_args()
+
+    if args.check:
+        directory = args.input if os.path.isdir(args.input) else os.path.dirname(args.input)
+        ram, addresses, cycles = test_setup(directory)
+        ram += [tuple(map(int, assignment.split("="))) for assignment in args.set]
+        for text in args.compare:
+            start, _, end = text.partition(":")
+            addresses += range(int(start), int(end) if end else int(start) + 1)
+        if not addresses:
+            argparser.error(f"no test script in {directory}: give the RAM to compare with --compare")
+        results = differential(args.input, addresses, ram, args.steps, cycles or args.steps)
+        dispatched, commands = results.pop("vm")
+        print(f"vm: {commands} commands in {dispatched} dispatches")
+        for mode, (cycles, differences) in results.items():
+            print(f"{mode}: {cycles} cycles, " + (f"differs at {differences}" if differences else "matches"))
+        sys.exit(1 if any(differences for _, differences in results.values()) else 0)
+
+    vm = VM(compile_vm(args.input, fuse=not args.no_fuse))
+    for assignment in args.set:
+        address, value = assignment.split("=")
+        vm.poke(int(address), int(value))
+    if args.boot:
+        vm.boot()
+    vm.run(args.steps)
+    print(f"{vm.commands} commands in {vm.dispatched} dispatches{' (halted)' if vm.halted else ''}, "
+          f"{vm.program.fused} superinstructions")
+    for text in args.dump:
+        start, _, end = text.partition(":")
+        for address in range(int(start), int(end) if end else int(start) + 1):
+            print(f"RAM[{address}] = {vm.peek(address)}")
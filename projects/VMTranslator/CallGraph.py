@@ -0,0 +1,132 @@
+"""
+Whole-program call graph for multi-file VM builds. Functions are found
+by their 'function' commands and edges by 'call' commands; everything
+not reachable from Sys.init, which the bootstrap calls, is dead and can
+be left out of the ROM.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "06"))
+from assembler import MAX_ADDRESS, clean_lines
+from SourceMap import origin_name
+
+
+def split_functions(lines):
+    """
+    The commands before the first function, and (name, commands) for
+    every function after it
+    """
+    preamble, functions = [], []
+    for line in lines:
+        if line.startswith("function"):
+            functions.append((line.split()[1], [line]))
+        elif functions:
+            functions[-1][1].append(line)
+        else:
+            preamble.append(line)
+    return preamble, functions
+
+
+class CallGraph(object):
+    ENTRY = "Sys.init"
+
+    def __init__(self, sources, ignore=()):
+        """
+        sources maps each file name to the text of its .vm file; calls to
+        the functions in ignore (intrinsics the translator lowers) are not
+        edges
+        """
+        self.files = {}
+        self.functions = {}
+        self.calls = {}
+        for filename, source in sources.items():
+            preamble, functions = split_functions(clean_lines(source.splitlines()))
+            self.files[filename] = (preamble, functions)
+            for name, lines in functions:
+                if name in self.functions:
+                    raise Exception(f"Function {name} defined in {self.functions[name]} and {filename}")
+                self.functions[name] = filename
+                self.calls[name] = [line.split()[1] for line in lines
+                                    if line.startswith("call") and line.split()[1] not in ignore]
+
+    def reachable(self, roots=None):
+        """
+        Names of the functions reachable from roots (Sys.init by default),
+        in the order they are first reached
+        """
+        roots = [self.ENTRY] if roots is None else roots
+        seen = {}
+        todo = [root for root in roots if root in self.functions]
+        while todo:
+            name = todo.pop()
+            if name in seen:
+                continue
+            seen[name] = True
+            todo += [callee for callee in reversed(self.calls[name]) if callee in self.functions and callee not in seen]
+        return list(seen)
+
+    def undefined(self):
+        """
+        (caller, callee) for every call to a function no file defines
+        """
+        return [(name, callee) for name, callees in self.calls.items() for callee in callees
+                if callee not in self.functions]
+
+    def prune(self, roots=None):
+        """
+        The sources with unreachable functions removed, as {filename:
+        source}; files left with nothing in them are dropped
+        """
+        live = set(self.reachable(roots))
+        pruned = {}
+        for filename, (preamble, functions) in self.files.items():
+            lines = list(preamble)
+            for name, body in functions:
+                if name in live:
+                    lines += body
+            if lines:
+                pruned[filename] = "\n".join(lines) + "\n"
+        return pruned
+
+
+def function_sizes(code, origins):
+    """
+    ROM words per function, largest first, from translated code and the
+    origins of its comments (Parser.origins)
+    """
+    sizes = {}
+    origin = None
+    index = 0
+    for instruction in code:
+        kind = instruction[0]
+        if kind == "//":
+            origin = origin_name(origins[index])
+            index += 1
+        elif kind != "(":
+            sizes[origin] = sizes.get(origin, 0) + 1
+    return sorted(sizes.items(), key=lambda item: -item[1])
+
+
+def rom_report(parsers, top=20):
+    """
+    Print the ROM words each function takes, with and without the
+    functions Sys.init can't reach, and list the ones pruning removes.
+    parsers are the same program's Parsers without and with prune
+    """
+    sizes = []
+    for parser in parsers:
+        code = parser.translate_code()
+        sizes.append(dict(function_sizes(code, parser.origins)))
+    print(f"{'function':<32} {'ROM words':>10} {'pruned':>10}")
+    for name, size in sorted(sizes[0].items(), key=lambda item: -item[1])[:top]:
+        print(f"{name:<32} {size:>10} {sizes[1].get(name, 0):>10}")
+    totals = [sum(functions.values()) for functions in sizes]
+    print(f"{'total':<32} {totals[0]:>10} {totals[1]:>10}")
+    for total in totals:
+        if total > MAX_ADDRESS + 1:
+            print(f"{total} words do not fit in the {MAX_ADDRESS + 1} word ROM")
+    if parser.removed:
+        print(f"{len(parser.removed)} unreachable functions: {' '.join(parser.removed)}")
+    if parser.undefined:
+        print(f"calls to undefined functions: {' '.join(f'{caller}->{callee}' for caller, callee in parser.undefined)}")
@@ -1,29 +1,98 @@
+import os
+import sys
 from itertools import count
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "06"))
+from assembler import C_INSTRUCTIONS, encode_c_instruction
+from Commands import (ADD, SUB, NEG, EQ, GT, LT, AND, OR, NOT, PUSH, POP, LABEL, GOTO, IF_GOTO, FUNCTION, CALL,
+                      RETURN, COMMANDS, SEGMENTS, parse_commands)
+
+# The ("C", word, text) tuple of each (computation, dest, jump), built once
+C_CODE = {}
+
+
+def code_to_lines(code):
+    """
+    Render instruction tuples as .asm lines: ("//", comment), ("@", address),
+    ("(", label) and ("C", word, text)
+    """
+    lines = []
+    for instruction in code:
+        kind = instruction[0]
+        if kind == "C":
+            lines.append(instruction[2])
+        elif kind == "(":
+            lines.append(f"({instruction[1]})")
+        else:
+            lines.append(f"{kind}{instruction[1]}")
+    return lines
+
+
+def lines_to_code(lines):
+    code = []
+    for line in lines:
+        if line.startswith("//"):
+            code.append(("//", line[2:]))
+        elif line.startswith("@"):
+            code.append(("@", line[1:]))
+        elif line.startswith("("):
+            code.append(("(", line[1:-1]))
+        else:
+            code.append(("C", encode_c_instruction(line), line))
+    return code
+
+
+class Counters(object):
+    """
+    Label counters for one translation unit, so that each file's labels
+    only depend on that file and it can be translated on its own
+    """
+    def __init__(self):
+        self.cmp_label = count(0)
+        self.return_address_label = count(0)
+
+
 class Instruction(object):
+    """
+    Code generation for the VM commands, one _write_* method per kind of
+    command taking its Command record, and the helpers they share
+    """
     cmp_label = count(0)
     return_address_label = count(0)
+    shared = False
+    basename = None
+    functionname = "null"
+    BINARY = {ADD: "A+D", SUB: "A-D", AND: "A&D", OR: "D|A"}
+    UNARY = {NEG: "-D", NOT: "!D"}
+    COMPARISONS = {LT: "JLT", GT: "JGT", EQ: "JEQ"}
+    # The method translating each opcode
+    WRITERS = {ADD: "_write_binary", SUB: "_write_binary", AND: "_write_binary", OR: "_write_binary",
+               NEG: "_write_unary", NOT: "_write_unary",
+               LT: "_write_comparison", GT: "_write_comparison", EQ: "_write_comparison",
+               PUSH: "_write_push", POP: "_write_pop", LABEL: "_write_label", GOTO: "_write_goto",
+               IF_GOTO: "_write_if_goto", FUNCTION: "_write_function", CALL: "_write_call", RETURN: "_write_return"}
 
     def __init__(self, instruction):
-        self.assembly_lines = [f"//{instruction}"]
+        self.code = [("//", instruction)]
 
         
     def _c_command(self, computation, dest=None, jump=None):
-        first_half = f"{dest}={computation}" if dest else computation
-        self.assembly_lines += [
-            f"{first_half}; {jump}" 
-            if jump else f"{first_half}"
-        ]
+        key = (computation, dest, jump)
+        instruction = C_CODE.get(key)
+        if instruction is None:
+            first_half = f"{dest}={computation}" if dest else computation
+            if jump:
+                instruction = ("C", C_INSTRUCTIONS[f"{first_half};{jump}"], f"{first_half}; {jump}")
+            else:
+                instruction = ("C", C_INSTRUCTIONS[first_half], first_half)
+            C_CODE[key] = instruction
+        self.code.append(instruction)
     
     def _a_command(self, address):
-        self.assembly_lines += [
-            f"@{address}"
-        ]
+        self.code.append(("@", address))
     
     def _label(self, label):
-        self.assembly_lines += [
-            f"({label})"
-        ]
+        self.code.append(("(", label))
     
     def _decrement_sp(self):
         self._a_command("SP")
@@ -60,18 +129,29 @@ class Instruction(object):
     
     def _compare_two(self, jump):
         cmp_label = next(self.cmp_label)
+        if self.shared:
+            return_addr = self._unique_label(f"$$CMP.ret.{cmp_label}")
+            self._a_command(return_addr)
+            self._c_command(dest="D", computation="A")
+            self._a_command("R15")
+            self._c_command(dest="M", computation="D")  # R15=returnAddr
+            self._goto(goto=f"$$CMP.{jump}")            # goto $$CMP.<jump>
+            self._label(return_addr)                    # ($$CMP.ret.i)
+            return
         self._read_sp("D")                      # D=*SP
         self._read_sp("A")                      # A=*SP
         self._c_command(dest="D", computation="A-D")             
                                                 # D=A-D
-        self._a_command(f"EQ{cmp_label}")       # @EQ
+        eq_label = self._unique_label(f"EQ{cmp_label}")
+        ne_label = self._unique_label(f"NE{cmp_label}")
+        self._a_command(eq_label)               # @EQ
         self._c_command("D", jump=jump)         # D;jump to label_eq
         self._write_sp('0')                     # *SP=0
-        self._a_command(f"NE{cmp_label}")       # @NE
+        self._a_command(ne_label)               # @NE
         self._c_command('0', jump='JMP')        # 0;JMP to NE
-        self._label(f"EQ{cmp_label}")           # (EQ)
+        self._label(eq_label)                   # (EQ)
         self._write_sp('-1')                    # *SP=-1
-        self._label(f"NE{cmp_label}")           # (NE)
+        self._label(ne_label)                   # (NE)
     
     def _push(self, push_type, val):
         if push_type == "constant":
@@ -87,7 +167,7 @@ class Instruction(object):
                 "local": "LCL",
                 "argument": "ARG"
             }
-            self._a_command(mapping[self.push_type])
+            self._a_command(mapping[push_type])
             self._c_command(dest="D", computation="M")
             self._a_command(val)
             self._c_command(dest="A", computation="D+A")
@@ -99,7 +179,7 @@ class Instruction(object):
             self._c_command(dest="A", computation="D+A")
             self._c_command(dest="D", computation="M")      # D=*(5+val)
         elif push_type == "static":
-            self._a_command(f"{self.basename}.{self.val}")
+            self._a_command(f"{self.basename}.{val}")
             self._c_command(dest="D", computation="M")      # D=*(basename.val)
         else:
             raise Exception(f"Don't recognise push type {push_type}")
@@ -150,7 +230,21 @@ class Instruction(object):
         self._c_command(dest="M", computation="D") 
     
     def _call(self, functionname, call_functionname, num_args):
-        return_addr = f"{functionname}$ret.{next(self.return_address_label)}"
+        return_addr = self._unique_label(f"{functionname}$ret.{next(self.return_address_label)}")
+        if self.shared:
+            self._a_command(f"{5 + int(num_args)}")
+            self._c_command(dest="D", computation="A")
+            self._a_command("R13")
+            self._c_command(dest="M", computation="D") # R13=5+nArgs
+            self._a_command(call_functionname)
+            self._c_command(dest="D", computation="A")
+            self._a_command("R14")
+            self._c_command(dest="M", computation="D") # R14=call_functionname
+            self._a_command(return_addr)
+            self._c_command(dest="D", computation="A") # D=returnAddr
+            self._goto(goto="$$CALL")                  # goto $$CALL
+            self._label(return_addr)                   # (functionname$ret.i)
+            return
         self._a_command(return_addr)
         self._c_command(dest="D", computation="A")
         self._write_sp("D")                        # *SP=returnAddr
@@ -179,149 +273,136 @@ class Instruction(object):
         self._goto(goto=call_functionname)         # goto call_functionname
         self._label(return_addr)                   # (functionname$ret.i)
     
+    def _return(self):
+        self._a_command("LCL")
+        self._c_command(dest="D", computation="M")
+        self._a_command("endFrame")
+        self._c_command(dest="M", computation="D")   # endFrame=LCL
+        self._endframe_to_seg("retAddr", 5)          # retAddr = *(endFrame-5)
+        self._pop(pop_type="argument", val="0")
+        self._a_command("ARG")
+        self._c_command(dest="D", computation="M+1")
+        self._a_command("SP")
+        self._c_command(dest="M", computation="D")   # SP=ARG+1
+
+        self._endframe_to_seg("THAT", 1)             # THAT=*(endFrame-1)
+        self._endframe_to_seg("THIS", 2)             # THIS=*(endFrame-2)
+        self._endframe_to_seg("ARG", 3)              # ARG=*(endFrame-3)
+        self._endframe_to_seg("LCL", 4)              # LCL=*(endFrame-4)
+
+        self._a_command("retAddr")
+        self._c_command(dest="A", computation="M")
+        self._c_command(computation="0", jump="JMP") # @GOTO retAddr
+
     def _goto(self, goto):
         self._a_command(f"{goto}")                     # @GOTO
         self._c_command(computation="0", jump="JMP")   # 0; JMP
     
+    def _unique_label(self, label):
+        # Translator-generated labels are namespaced by file
+        return f"{self.basename}${label}" if self.basename else label
+
     @staticmethod
     def _create_label(basename, this_functionname, label):
         return f"{basename}.{this_functionname}${label}"
     
+    def _write_binary(self, command):
+        self._operate_two(self.BINARY[command.opcode])
+
+    def _write_unary(self, command):
+        self._operate_one(self.UNARY[command.opcode])
+
+    def _write_comparison(self, command):
+        self._compare_two(self.COMPARISONS[command.opcode])
+
+    def _write_push(self, command):
+        self._push(SEGMENTS[command.segment], str(command.index))
+
+    def _write_pop(self, command):
+        self._pop(SEGMENTS[command.segment], str(command.index))
+
+    def _write_label(self, command):
+        self._label(self._create_label(self.basename, self.functionname, command.name))
+
+    def _write_goto(self, command):
+        self._goto(self._create_label(self.basename, self.functionname, command.name))
+
+    def _write_if_goto(self, command):
+        self._read_sp("D")                                                   # D=*SP
+        self._a_command(self._create_label(self.basename, self.functionname, command.name))
+        self._c_command(computation="D", jump="JNE")                         # D; JNE
+
+    def _write_function(self, command):
+        self.functionname = command.name
+        self._label(command.name)
+        for _ in range(command.index):
+            self._push(push_type="constant", val="0")
+
+    def _write_call(self, command):
+        self._call(functionname=self.functionname, call_functionname=command.name, num_args=command.index)
+
+    def _write_return(self, command):
+        if self.shared:
+            self._goto(goto="$$RETURN")
+        else:
+            self._return()
+
     def write_assembly(self):
         raise NotImplementedError
 
     def get_assembly(self):
-        return self.assembly_lines
+        return code_to_lines(self.code)
 
 
-class Operate(Instruction): 
-    def __init__(self, instruction, basename, functionname):
-        self.instruction = instruction
-        super().__init__(instruction)
-    
-    def write_assembly(self):
-        instructions = {
-            "add": (self._operate_two, {"computation": "A+D"}),
-            "sub": (self._operate_two, {"computation": "A-D"}),
-            "neg": (self._operate_one, {"computation": "-D"}),
-            "and": (self._operate_two, {"computation": "A&D"}),
-            "or": (self._operate_two, {"computation": "D|A"}),
-            "not": (self._operate_one, {"computation": "!D"}),
-            "lt": (self._compare_two, {"jump": "JLT"}),
-            "gt": (self._compare_two, {"jump": "JGT"}),
-            "eq": (self._compare_two, {"jump": "JEQ"}),
-        }
-        operation, kwargs = instructions[self.instruction]
-        operation(**kwargs)
-
-
-class Push(Instruction):
+class VMCommand(Instruction):
+    """
+    One VM command translated on its own, by the same writer method
+    CommandWriter dispatches its opcode to
+    """
     def __init__(self, instruction, basename, functionname):
         self.basename = basename
-        self.push_type, self.val = instruction.split()[1], instruction.split()[2]
+        self.functionname = functionname
+        self.command = parse_commands(instruction)[0]
         super().__init__(instruction)
-    
+
     def write_assembly(self):
-        self._push(push_type=self.push_type, val=self.val)
+        getattr(self, self.WRITERS[self.command.opcode])(self.command)
 
 
-class Pop(Instruction):
-    def __init__(self, instruction, basename, functionname):
-        self.basename = basename
-        self.pop_type, self.val = instruction.split()[1], instruction.split()[2]
-        super().__init__(instruction)
-    
-    def write_assembly(self):
-        self._pop(pop_type=self.pop_type, val=self.val)
+class Operate(VMCommand):
+    pass
 
 
-class Label(Instruction):
-    def __init__(self, instruction, basename, functionname):
-        self.basename = basename
-        self.functionname = functionname
-        self.label = instruction.split()[1]
-        super().__init__(instruction)
-    
-    def write_assembly(self):
-        label = self._create_label(self.basename, self.functionname, self.label)
-        self._label(label)
+class Push(VMCommand):
+    pass
 
 
-class GoTo(Instruction):
-    def __init__(self, instruction, basename, functionname):
-        self.basename = basename
-        self.functionname = functionname
-        self.goto = instruction.split()[1]
-        super().__init__(instruction)
-    
-    def write_assembly(self):
-        label = self._create_label(self.basename, self.functionname, self.goto)
-        self._goto(label)
+class Pop(VMCommand):
+    pass
 
 
-class IfGoTo(Instruction):
-    def __init__(self, instruction, basename, functionname):
-        self.basename = basename
-        self.functionname = functionname
-        self.goto = instruction.split()[1]
-        super().__init__(instruction)
-    
-    def write_assembly(self):
-        self._read_sp("D")                                                   # D=*SP
-        label = self._create_label(self.basename, self.functionname, self.goto)
-        self._a_command(label)                                               # @GOTO
-        self._c_command(computation="D", jump="JNE")                         # D; JNE
-    
-class Call(Instruction): 
-    def __init__(self, instruction, basename, functionname):
-        self.this_functionname = functionname
-        self.call_functionname, self.num_args = instruction.split()[1], instruction.split()[2]
-        super().__init__(instruction)
-    
-    def write_assembly(self):
-        self._call(functionname=self.this_functionname,
-                   call_functionname=self.call_functionname, 
-                   num_args=self.num_args)
+class Label(VMCommand):
+    pass
 
 
-class Function(Instruction): 
-    def __init__(self, instruction, basename, functionname):
-        self.baseandfunctionname, self.num_vars = instruction.split()[1], instruction.split()[2]
-        super().__init__(instruction)
-    
-    def write_assembly(self):
-        self._label(self.baseandfunctionname)                # (basename.functionname)
-        for i in range(int(self.num_vars)):
-            self._push(push_type="constant", val="0") 
+class GoTo(VMCommand):
+    pass
 
 
-class Return(Instruction): 
-    def __init__(self, instruction, basename, functionname):
-        self.basename = basename
-        self.functionname = functionname
-        self.instruction = instruction
-        super().__init__(instruction)
-        
-    def write_assembly(self):
-        self._a_command("LCL")
-        self._c_command(dest="D", computation="M")
-        self._a_command("endFrame")
-        self._c_command(dest="M", computation="D")   # endFrame=LCL
-        self._endframe_to_seg("retAddr", 5)          # retAddr = *(endFrame-5)
-        self._pop(pop_type="argument", val="0")
-        self._a_command("ARG")
-        self._c_command(dest="D", computation="M+1")
-        self._a_command("SP")
-        self._c_command(dest="M", computation="D")   # SP=ARG+1
+class IfGoTo(VMCommand):
+    pass
 
-        self._endframe_to_seg("THAT", 1)             # THAT=*(endFrame-1)
-        self._endframe_to_seg("THIS", 2)             # THIS=*(endFrame-2)
-        self._endframe_to_seg("ARG", 3)              # ARG=*(endFrame-3)
-        self._endframe_to_seg("LCL", 4)              # LCL=*(endFrame-4)
 
-        self._a_command("retAddr")
-        self._c_command(dest="A", computation="M")
-        self._c_command(computation="0", jump="JMP") # @GOTO retAddr
+class Call(VMCommand):
+    pass
+
+
+class Function(VMCommand):
+    pass
+
+
+class Return(VMCommand):
+    pass
 
 
 class Init(Instruction):
@@ -350,10 +431,71 @@ class End(Instruction):
         self._c_command(dest=None, computation="0", jump="JMP")
 
 
+class SharedRoutines(Instruction):
+    """
+    The $$CALL, $$RETURN and $$CMP.<jump> subroutines that call, return
+    and lt/gt/eq sites jump to when translating in shared mode. Each
+    routine starts with its own comment so the source map can tell them
+    apart
+    """
+    def __init__(self, instruction, basename, functionname):
+        super().__init__(instruction)
+
+    def write_assembly(self):
+        self.code.append(("//", "$$CALL"))
+        self._label("$$CALL")                        # D=returnAddr, R13=5+nArgs, R14=function
+        self._write_sp("D")                          # push returnAddr
+        for seg in ("LCL", "ARG", "THIS", "THAT"):
+            self._a_command(seg)
+            self._c_command(dest="D", computation="M")
+            self._write_sp("D")                      # push seg
+        self._a_command("R13")
+        self._c_command(dest="D", computation="M")
+        self._a_command("SP")
+        self._c_command(dest="D", computation="M-D")
+        self._a_command("ARG")
+        self._c_command(dest="M", computation="D")   # ARG = SP-5-nArgs
+        self._a_command("SP")
+        self._c_command(dest="D", computation="M")
+        self._a_command("LCL")
+        self._c_command(dest="M", computation="D")   # LCL=SP
+        self._a_command("R14")
+        self._c_command(dest="A", computation="M")
+        self._c_command(computation="0", jump="JMP") # goto function
+
+        self.code.append(("//", "$$RETURN"))
+        self._label("$$RETURN")
+        self._return()
+
+        for jump in ("JLT", "JGT", "JEQ"):           # R15=returnAddr
+            self.code.append(("//", f"$$CMP.{jump}"))
+            self._label(f"$$CMP.{jump}")
+            self._read_sp("D")                       # D=*SP
+            self._read_sp("A")                       # A=*SP
+            self._c_command(dest="D", computation="A-D")
+            self._a_command("$$CMP.TRUE")
+            self._c_command("D", jump=jump)          # D;jump to $$CMP.TRUE
+            self._a_command("$$CMP.FALSE")
+            self._c_command("0", jump="JMP")
+        self.code.append(("//", "$$CMP.TRUE"))
+        self._label("$$CMP.TRUE")
+        self._write_sp("-1")                         # *SP=-1
+        self._a_command("R15")
+        self._c_command(dest="A", computation="M")
+        self._c_command(computation="0", jump="JMP") # goto returnAddr
+        self.code.append(("//", "$$CMP.FALSE"))
+        self._label("$$CMP.FALSE")
+        self._write_sp("0")                          # *SP=0
+        self._a_command("R15")
+        self._c_command(dest="A", computation="M")
+        self._c_command(computation="0", jump="JMP") # goto returnAddr
+
+
 class CodeWriter(Instruction): 
     mapping = {
         "init": Init,
         "end": End,
+        "routines": SharedRoutines,
         "push": Push,
         "pop": Pop,
         "label": Label,
@@ -364,7 +506,7 @@ class CodeWriter(Instruction):
         "return": Return
     }   
 
-    def __init__(self, basename, instruction, functionname):
+    def __init__(self, basename, instruction, functionname, shared=False, counters=None):
         self.basename = basename
 
         for m, handler in self.mapping.items():
@@ -373,7 +515,56 @@ class CodeWriter(Instruction):
                 break
         else:
             self.instruction = Operate(instruction, basename, functionname)
+        self.instruction.shared = shared
+        self.instruction.basename = basename
+        if counters is not None:
+            self.instruction.cmp_label = counters.cmp_label
+            self.instruction.return_address_label = counters.return_address_label
         
     def get_lines(self):
         self.instruction.write_assembly()
-        return self.instruction.get_assembly() 
\ No newline at end of file
+        return self.instruction.get_assembly()
+
+    def get_code(self):
+        """
+        The translation as instruction tuples for Assembler.feed_code
+        """
+        self.instruction.write_assembly()
+        return self.instruction.code
+
+
+class CommandWriter(Instruction):
+    """
+    Translates the Command records of one file into a single code list,
+    dispatching on their opcodes through a table. Push, pop, return and
+    arithmetic other than comparisons have no generated labels, so their
+    code is kept by command text and reused when the command comes again
+    """
+    REUSABLE = {PUSH, POP, ADD, SUB, NEG, AND, OR, NOT, RETURN}
+
+    def __init__(self, basename, shared=False, counters=None):
+        self.code = []
+        self.basename = basename
+        self.shared = shared
+        self.counters = counters or Counters()
+        self.cmp_label = self.counters.cmp_label
+        self.return_address_label = self.counters.return_address_label
+        self.functionname = "null"
+        self.reused = {}
+        self.dispatch = [getattr(self, self.WRITERS[opcode]) for opcode in range(len(COMMANDS))]
+
+    def translate(self, commands):
+        for command in commands:
+            self.write(command)
+        return self.code
+
+    def write(self, command):
+        code = self.reused.get(command.text)
+        if code is not None:
+            self.code += code
+            return
+        start = len(self.code)
+        self.code.append(("//", command.text))
+        self.dispatch[command.opcode](command)
+        if command.opcode in self.REUSABLE:
+            self.reused[command.text] = self.code[start:]
@@ -0,0 +1,76 @@
+"""
+VM front end: a .vm file is tokenized in one pass into Command records,
+each holding an integer opcode, the segment id and integer index of push
+and pop, or the label or function name of the others. The writers
+dispatch on the opcode through a table instead of matching the command
+text, and malformed commands are reported with their file and line.
+"""
+ARITHMETIC = ("add", "sub", "neg", "eq", "gt", "lt", "and", "or", "not")
+COMMANDS = ARITHMETIC + ("push", "pop", "label", "goto", "if-goto", "function", "call", "return")
+(ADD, SUB, NEG, EQ, GT, LT, AND, OR, NOT,
+ PUSH, POP, LABEL, GOTO, IF_GOTO, FUNCTION, CALL, RETURN) = range(len(COMMANDS))
+OPCODES = {name: opcode for opcode, name in enumerate(COMMANDS)}
+# Arguments after the command word
+ARGUMENTS = [0] * len(ARITHMETIC) + [2, 2, 1, 1, 1, 2, 2, 0]
+
+SEGMENTS = ("constant", "local", "argument", "this", "that", "pointer", "temp", "static")
+CONSTANT, LOCAL, ARGUMENT, THIS, THAT, POINTER, TEMP, STATIC = range(len(SEGMENTS))
+SEGMENT_IDS = {name: segment for segment, name in enumerate(SEGMENTS)}
+
+
+class Command(object):
+    """
+    One VM command. text is the command as written, less comments and
+    surrounding space, for the comment the translation starts with
+    """
+    __slots__ = ("opcode", "segment", "index", "name", "text", "line")
+
+    def __init__(self, opcode, text, line, segment=None, index=None, name=None):
+        self.opcode = opcode
+        self.text = text
+        self.line = line
+        self.segment = segment
+        self.index = index
+        self.name = name
+
+    def __repr__(self):
+        return f"Command({self.text!r}, line {self.line})"
+
+
+def parse_commands(source, filename="<vm>"):
+    """
+    The commands in the text of a .vm file
+    """
+    commands = []
+    for number, line in enumerate(source.splitlines(), 1):
+        if "//" in line:
+            line = line[:line.index("//")]
+        words = line.split()
+        if not words:
+            continue
+        text = line.strip()
+        opcode = OPCODES.get(words[0])
+        if opcode is None:
+            raise Exception(f"{filename}:{number}: Don't recognise VM command {text}")
+        if len(words) != ARGUMENTS[opcode] + 1:
+            raise Exception(f"{filename}:{number}: malformed VM command {text}")
+        if opcode == PUSH or opcode == POP:
+            segment = SEGMENT_IDS.get(words[1])
+            if segment is None:
+                raise Exception(f"{filename}:{number}: Don't recognise segment {words[1]}")
+            if segment == CONSTANT and opcode == POP:
+                raise Exception(f"{filename}:{number}: Can't pop to constant")
+            commands.append(Command(opcode, text, number, segment, _index(words[2], filename, number)))
+        elif opcode == FUNCTION or opcode == CALL:
+            commands.append(Command(opcode, text, number, None, _index(words[2], filename, number), words[1]))
+        elif len(words) > 1:
+            commands.append(Command(opcode, text, number, None, None, words[1]))
+        else:
+            commands.append(Command(opcode, text, number))
+    return commands
+
+
+def _index(word, filename, number):
+    if not word.isdigit():
+        raise Exception(f"{filename}:{number}: {word} is not a non-negative integer")
+    return int(word)
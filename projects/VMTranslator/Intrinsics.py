@@ -0,0 +1,370 @@
+"""
+Intrinsic lowering of the OS arithmetic functions (--intrinsics). Calls
+to Math.multiply, Math.divide, Math.min and Math.max jump to shared
+$$MUL, $$DIV and $$MIN/$$MAX routines with only a return address, and
+Math.abs and multiplication by a constant power of two are done inline,
+so none of them builds a call frame. Results are those of VMEmulator's
+native Math functions: 16-bit products, quotients truncated towards
+zero, and min/max on signed values. Division by zero, an OS error, is
+not detected.
+
+The routines keep their state in the $$MATH.* variables, as the
+translator's return code does in endFrame and retAddr.
+"""
+from CodeWriter import Instruction
+from Commands import CALL, PUSH, CONSTANT
+
+INTRINSICS = ("Math.multiply", "Math.divide", "Math.abs", "Math.min", "Math.max")
+ROUTINES = {"Math.multiply": "$$MUL", "Math.divide": "$$DIV", "Math.min": "$$MIN", "Math.max": "$$MAX"}
+
+
+def signed(value):
+    return value - 0x10000 if value & 0x8000 else value
+
+
+def fold(name, args):
+    """
+    Constant result of an intrinsic on constant arguments, or None when
+    it can't be folded (division by zero)
+    """
+    if name == "Math.abs":
+        return abs(signed(args[0])) & 0xFFFF
+    x, y = map(signed, args)
+    if name == "Math.multiply":
+        return (x * y) & 0xFFFF
+    if name == "Math.divide":
+        if y == 0:
+            return None
+        quotient = abs(x) // abs(y)
+        return (quotient if (x < 0) == (y < 0) else -quotient) & 0xFFFF
+    return (min(x, y) if name == "Math.min" else max(x, y)) & 0xFFFF
+
+
+def power_of_two(value):
+    """
+    k when value is 2**k, else None
+    """
+    if 0 < value <= 0x4000 and value & (value - 1) == 0:
+        return value.bit_length() - 1
+    return None
+
+
+def parse_intrinsic(command, intrinsics):
+    """
+    The function name when command is a call to an intrinsic
+    """
+    if command.opcode == CALL and command.name in intrinsics:
+        return command.name
+    return None
+
+
+def constant_shift(command):
+    """
+    k when command pushes the constant 2**k
+    """
+    if command.opcode == PUSH and command.segment == CONSTANT:
+        return power_of_two(command.index)
+    return None
+
+
+class IntrinsicCall(Instruction):
+    """
+    Call site code for an intrinsic working on the real stack
+    """
+    def __init__(self, instruction, name, basename, counters, shift=None):
+        super().__init__(instruction)
+        self.name = name
+        self.shift = shift
+        self.basename = basename
+        self.cmp_label = counters.cmp_label
+        self.return_address_label = counters.return_address_label
+
+    def write_assembly(self):
+        if self.shift is not None:
+            self._shift_top(self.shift)
+        elif self.name == "Math.abs":
+            label = self._unique_label(f"ABS{next(self.cmp_label)}")
+            self._a_command("SP")
+            self._c_command(dest="A", computation="M-1")
+            self._c_command(dest="D", computation="M")      # D=*(SP-1)
+            self._a_command(label)
+            self._c_command("D", jump="JGE")
+            self._a_command("SP")
+            self._c_command(dest="A", computation="M-1")
+            self._c_command(dest="M", computation="-D")     # *(SP-1)=-D
+            self._label(label)
+        else:
+            return_addr = self._unique_label(f"{ROUTINES[self.name]}.ret.{next(self.return_address_label)}")
+            self._a_command(return_addr)
+            self._c_command(dest="D", computation="A")      # D=returnAddr
+            self._goto(goto=ROUTINES[self.name])
+            self._label(return_addr)
+
+    def _shift_top(self, shift):
+        # *(SP-1) *= 2**shift
+        if shift == 0:
+            return
+        self._a_command("SP")
+        self._c_command(dest="A", computation="M-1")
+        self._c_command(dest="D", computation="M")
+        self._c_command(dest="M", computation="D+M")
+        for _ in range(shift - 1):
+            self._c_command(dest="D", computation="M")
+            self._c_command(dest="M", computation="D+M")
+
+
+def lower_intrinsic(commands, i, basename, intrinsics, counters):
+    """
+    Code for commands[i] when it is part of an intrinsic: a push of 2**k
+    feeding Math.multiply translates to nothing and the call to k
+    doublings, and other intrinsic calls to their call site. None when
+    the command writer should translate it
+    """
+    command = commands[i]
+    if "Math.multiply" in intrinsics and constant_shift(command) is not None and i + 1 < len(commands) and \
+            parse_intrinsic(commands[i + 1], intrinsics) == "Math.multiply":
+        return [("//", command.text)]
+    name = parse_intrinsic(command, intrinsics)
+    if name is None:
+        return None
+    shift = constant_shift(commands[i - 1]) if name == "Math.multiply" and i > 0 else None
+    call = IntrinsicCall(command.text, name, basename, counters, shift)
+    call.write_assembly()
+    return call.code
+
+
+class MathRoutines(Instruction):
+    """
+    The shared routines for the given intrinsics. Each is entered with
+    the return address in D and its arguments on the stack, and leaves
+    the result in place of the first argument
+    """
+    def __init__(self, intrinsics):
+        super().__init__("$$MATH")
+        self.code = []
+        self.intrinsics = intrinsics
+
+    def _enter(self, routine):
+        self.code.append(("//", routine))
+        self._label(routine)
+        self._a_command("$$MATH.return")
+        self._c_command(dest="M", computation="D")          # $$MATH.return=D
+
+    def _arguments(self):
+        self._a_command("SP")
+        self._c_command(dest="AM", computation="M-1")
+        self._c_command(dest="D", computation="M")
+        self._a_command("$$MATH.b")
+        self._c_command(dest="M", computation="D")          # b=y, SP--
+        self._a_command("SP")
+        self._c_command(dest="A", computation="M-1")
+        self._c_command(dest="D", computation="M")
+        self._a_command("$$MATH.a")
+        self._c_command(dest="M", computation="D")          # a=x
+
+    def _leave(self, variable):
+        self._a_command(variable)
+        self._c_command(dest="D", computation="M")
+        self._a_command("SP")
+        self._c_command(dest="A", computation="M-1")
+        self._c_command(dest="M", computation="D")          # *(SP-1)=variable
+        self._a_command("$$MATH.return")
+        self._c_command(dest="A", computation="M")
+        self._c_command(computation="0", jump="JMP")
+
+    def _multiply(self):
+        # result += a for each bit of b, doubling a; stop when no bits of b are left
+        self._enter("$$MUL")
+        self._arguments()
+        self._a_command("$$MATH.result")
+        self._c_command(dest="M", computation="0")
+        self._a_command("$$MATH.bit")
+        self._c_command(dest="M", computation="1")
+        self._label("$$MUL.LOOP")
+        self._a_command("$$MATH.bit")
+        self._c_command(dest="D", computation="-M")
+        self._a_command("$$MATH.b")
+        self._c_command(dest="D", computation="D&M")        # bits of b from bit up
+        self._a_command("$$MUL.END")
+        self._c_command("D", jump="JEQ")
+        self._a_command("$$MATH.bit")
+        self._c_command(dest="D", computation="M")
+        self._a_command("$$MATH.b")
+        self._c_command(dest="D", computation="D&M")
+        self._a_command("$$MUL.NEXT")
+        self._c_command("D", jump="JEQ")
+        self._a_command("$$MATH.a")
+        self._c_command(dest="D", computation="M")
+        self._a_command("$$MATH.result")
+        self._c_command(dest="M", computation="D+M")        # result+=a
+        self._label("$$MUL.NEXT")
+        self._a_command("$$MATH.a")
+        self._c_command(dest="D", computation="M")
+        self._c_command(dest="M", computation="D+M")        # a+=a
+        self._a_command("$$MATH.bit")
+        self._c_command(dest="D", computation="M")
+        self._c_command(dest="M", computation="D+M")        # bit+=bit
+        self._goto("$$MUL.LOOP")
+        self._label("$$MUL.END")
+        self._leave("$$MATH.result")
+
+    def _absolute(self, variable, label):
+        # variable=|D|, flipping $$MATH.sign when D<0
+        self._a_command(label)
+        self._c_command("D", jump="JGE")
+        self._a_command("$$MATH.sign")
+        self._c_command(dest="M", computation="!M")
+        self._c_command(dest="D", computation="-D")
+        self._label(label)
+        self._a_command(variable)
+        self._c_command(dest="M", computation="D")
+
+    def _divide(self):
+        # Shift-subtract division of |x| by |y| as unsigned 16-bit values,
+        # after skipping the leading zero bits of |x|
+        self._enter("$$DIV")
+        self._a_command("$$MATH.sign")
+        self._c_command(dest="M", computation="0")
+        self._a_command("SP")
+        self._c_command(dest="AM", computation="M-1")
+        self._c_command(dest="D", computation="M")
+        self._absolute("$$MATH.b", "$$DIV.B")               # b=|y|, SP--
+        self._a_command("SP")
+        self._c_command(dest="A", computation="M-1")
+        self._c_command(dest="D", computation="M")
+        self._absolute("$$MATH.a", "$$DIV.A")               # a=|x|
+        self._a_command("$$MATH.result")
+        self._c_command(dest="M", computation="0")
+        self._a_command("$$MATH.rest")
+        self._c_command(dest="M", computation="0")
+        self._a_command("16")
+        self._c_command(dest="D", computation="A")
+        self._a_command("$$MATH.bit")
+        self._c_command(dest="M", computation="D")          # bits left=16
+        self._a_command("$$MATH.a")
+        self._c_command(dest="D", computation="M")
+        self._a_command("$$DIV.END")
+        self._c_command("D", jump="JEQ")
+        self._label("$$DIV.SKIP")
+        self._a_command("$$MATH.a")
+        self._c_command(dest="D", computation="M")
+        self._a_command("$$DIV.LOOP")
+        self._c_command("D", jump="JLT")
+        self._a_command("$$MATH.a")
+        self._c_command(dest="M", computation="D+M")        # a+=a
+        self._a_command("$$MATH.bit")
+        self._c_command(dest="M", computation="M-1")
+        self._goto("$$DIV.SKIP")
+        self._label("$$DIV.LOOP")
+        self._a_command("$$MATH.rest")
+        self._c_command(dest="D", computation="M")
+        self._c_command(dest="M", computation="D+M")        # rest+=rest
+        self._a_command("$$MATH.a")
+        self._c_command(dest="D", computation="M")
+        self._c_command(dest="M", computation="D+M")        # a+=a
+        self._a_command("$$DIV.SHIFTED")
+        self._c_command("D", jump="JGE")
+        self._a_command("$$MATH.rest")
+        self._c_command(dest="M", computation="M+1")        # rest+=top bit of a
+        self._label("$$DIV.SHIFTED")
+        self._a_command("$$MATH.result")
+        self._c_command(dest="D", computation="M")
+        self._c_command(dest="M", computation="D+M")        # result+=result
+        self._a_command("$$MATH.rest")
+        self._c_command(dest="D", computation="M")
+        self._a_command("$$DIV.SUBTRACT")
+        self._c_command("D", jump="JLT")                    # rest>=0x8000>=b
+        self._a_command("$$MATH.b")
+        self._c_command(dest="D", computation="D-M")
+        self._a_command("$$DIV.NEXT")
+        self._c_command("D", jump="JLT")                    # rest<b
+        self._label("$$DIV.SUBTRACT")
+        self._a_command("$$MATH.b")
+        self._c_command(dest="D", computation="M")
+        self._a_command("$$MATH.rest")
+        self._c_command(dest="M", computation="M-D")        # rest-=b
+        self._a_command("$$MATH.result")
+        self._c_command(dest="M", computation="M+1")        # result+=1
+        self._label("$$DIV.NEXT")
+        self._a_command("$$MATH.bit")
+        self._c_command(dest="MD", computation="M-1")
+        self._a_command("$$DIV.LOOP")
+        self._c_command("D", jump="JGT")
+        self._label("$$DIV.END")
+        self._a_command("$$MATH.sign")
+        self._c_command(dest="D", computation="M")
+        self._a_command("$$DIV.DONE")
+        self._c_command("D", jump="JEQ")
+        self._a_command("$$MATH.result")
+        self._c_command(dest="M", computation="-M")
+        self._label("$$DIV.DONE")
+        self._leave("$$MATH.result")
+
+    def _min_max(self):
+        # $$MATH.sign is 0 for min and -1 for max. Signs are compared
+        # first so x-y can't overflow
+        for routine, sign in (("$$MIN", "0"), ("$$MAX", "-1")):
+            self._enter(routine)
+            self._a_command("$$MATH.sign")
+            self._c_command(dest="M", computation=sign)
+            if routine == "$$MIN":
+                self._goto("$$MINMAX")
+        self._label("$$MINMAX")
+        self._arguments()
+        self._a_command("$$MINMAX.XPOS")
+        self._c_command("D", jump="JGE")
+        self._a_command("$$MATH.b")
+        self._c_command(dest="D", computation="M")
+        self._a_command("$$MINMAX.XLESS")
+        self._c_command("D", jump="JGE")                    # x<0<=y
+        self._goto("$$MINMAX.SAME")
+        self._label("$$MINMAX.XPOS")
+        self._a_command("$$MATH.b")
+        self._c_command(dest="D", computation="M")
+        self._a_command("$$MINMAX.YLESS")
+        self._c_command("D", jump="JLT")                    # y<0<=x
+        self._label("$$MINMAX.SAME")
+        self._a_command("$$MATH.b")
+        self._c_command(dest="D", computation="M")
+        self._a_command("$$MATH.a")
+        self._c_command(dest="D", computation="M-D")
+        self._a_command("$$MINMAX.XLESS")
+        self._c_command("D", jump="JLT")
+        self._label("$$MINMAX.YLESS")                       # y<=x: min is y, max is x
+        self._a_command("$$MATH.sign")
+        self._c_command(dest="D", computation="M")
+        self._a_command("$$MINMAX.DONE")
+        self._c_command("D", jump="JNE")
+        self._leave("$$MATH.b")
+        self._label("$$MINMAX.XLESS")                       # x<y: min is x, max is y
+        self._a_command("$$MATH.sign")
+        self._c_command(dest="D", computation="M")
+        self._a_command("$$MINMAX.DONE")
+        self._c_command("D", jump="JEQ")
+        self._leave("$$MATH.b")
+        self._label("$$MINMAX.DONE")
+        self._a_command("$$MATH.return")
+        self._c_command(dest="A", computation="M")
+        self._c_command(computation="0", jump="JMP")
+
+    def write_assembly(self):
+        if "Math.multiply" in self.intrinsics:
+            self._multiply()
+        if "Math.divide" in self.intrinsics:
+            self._divide()
+        if "Math.min" in self.intrinsics or "Math.max" in self.intrinsics:
+            self._min_max()
+
+
+def routines_code(intrinsics, code):
+    """
+    The routines the translated code jumps to, or nothing when it uses
+    none of them
+    """
+    targets = {instruction[1] for instruction in code if instruction[0] == "@"}
+    used = [name for name, routine in ROUTINES.items() if name in intrinsics and routine in targets]
+    if not used:
+        return []
+    routines = MathRoutines(used)
+    routines.write_assembly()
+    return routines.code
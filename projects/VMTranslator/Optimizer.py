@@ -0,0 +1,311 @@
+"""
+Peephole optimizer for the assembly produced by CodeWriter. It works on
+the instruction stream (the //<vm command> comments are kept and skipped
+over) and relies on properties of the generated code: the stack never
+overlaps RAM[0..15], and R13/R14 are free scratch registers.
+"""
+import os
+import sys
+
+SEGMENT_POINTERS = ("LCL", "ARG", "THIS", "THAT")
+MAX_INLINE_OFFSET = 3
+SP_PAIR_WINDOW = 32
+
+
+def is_comment(line):
+    return line.startswith("//")
+
+
+def is_label(line):
+    return line.startswith("(")
+
+
+def split_c_command(line):
+    """
+    Split a C-instruction into (dest, comp, jump)
+    """
+    line = line.replace(" ", "")
+    dest, _, comp = line.rpartition("=")
+    comp, _, jump = comp.partition(";")
+    return dest, comp, jump
+
+
+def count_instructions(lines):
+    return sum(1 for line in lines if not is_comment(line) and not is_label(line))
+
+
+class Peephole(object):
+    def __init__(self, lines):
+        self.lines = list(lines)
+
+    def _code(self, lines, start, count):
+        """
+        Return the indices of the next count code lines from start,
+        skipping comments
+        """
+        indices = []
+        i = start
+        while i < len(lines) and len(indices) < count:
+            if not is_comment(lines[i]):
+                indices.append(i)
+            i += 1
+        return indices
+
+    def _matches(self, lines, indices, pattern):
+        return len(indices) == len(pattern) and all(
+            lines[i] == p for i, p in zip(indices, pattern)
+        )
+
+    def remove_sp_pairs(self, lines):
+        """
+        @SP/M=M+1 ... @SP/M=M-1 cancels out when the code in between
+        neither branches nor uses a computed A, and nothing after the pair
+        relies on A still holding SP
+        """
+        dropped = set()
+        i = 0
+        while i < len(lines):
+            head = self._code(lines, i, 2)
+            if not self._matches(lines, head, ["@SP", "M=M+1"]):
+                i += 1
+                continue
+            j = head[-1] + 1
+            constant_a = False
+            seen = 0
+            while j < len(lines) and seen < SP_PAIR_WINDOW:
+                line = lines[j]
+                j += 1
+                if is_comment(line):
+                    continue
+                seen += 1
+                if line == "@SP":
+                    tail = self._code(lines, j, 2)
+                    if (self._matches(lines, tail[:1], ["M=M-1"])
+                            and (len(tail) == 1 or lines[tail[1]][0] in "@(")):
+                        dropped.update(head + [j - 1] + tail[:1])
+                    break
+                if is_label(line):
+                    break
+                if line.startswith("@"):
+                    constant_a = line != "@0"
+                    continue
+                dest, comp, jump = split_c_command(line)
+                if jump or not constant_a:
+                    break
+                if "A" in dest:
+                    constant_a = False
+            i = head[-1] + 1
+        return [line for i, line in enumerate(lines) if i not in dropped]
+
+    def _fused_store(self, address_code):
+        """
+        Given the pop template's address computation, return code that
+        stores D straight to that address, or None if it isn't recognised
+        """
+        if len(address_code) == 2 and address_code[1] == "D=A":
+            return [address_code[0], "M=D"]                      # static/pointer
+        if len(address_code) != 4 or address_code[3] != "D=D+A":
+            return None
+        base, load, offset = address_code[0], address_code[1], address_code[2][1:]
+        if not offset.isdigit():
+            return None
+        if base == "@5" and load == "D=A":
+            return [f"@{5 + int(offset)}", "M=D"]                # temp
+        if base[1:] in SEGMENT_POINTERS and load == "D=M":
+            if int(offset) <= MAX_INLINE_OFFSET:
+                return [base, "A=M"] + ["A=A+1"] * int(offset) + ["M=D"]
+            return ["@R14", "M=D", base, "D=M", address_code[2], "D=D+A",
+                    "@R13", "M=D", "@R14", "D=M", "@R13", "A=M", "M=D"]
+        return None
+
+    def fuse_push_pop(self, lines):
+        """
+        A push leaving D on the stack followed directly by a pop becomes a
+        store of D to the pop's destination
+        """
+        pop_tail = ["@R13", "M=D", "@SP", "A=M", "D=M", "@R13", "A=M", "M=D"]
+        out = []
+        i = 0
+        while i < len(lines):
+            store = self._code(lines, i, 3)
+            if self._matches(lines, store, ["@SP", "A=M", "M=D"]):
+                for address_length in (2, 4):
+                    window = self._code(lines, store[-1] + 1, address_length + len(pop_tail))
+                    if not self._matches(lines, window[address_length:], pop_tail):
+                        continue
+                    fused = self._fused_store([lines[k] for k in window[:address_length]])
+                    if fused is None:
+                        continue
+                    comments = [lines[k] for k in range(i, window[-1] + 1) if is_comment(lines[k])]
+                    out += comments + fused
+                    i = window[-1] + 1
+                    break
+                else:
+                    out.append(lines[i])
+                    i += 1
+                continue
+            out.append(lines[i])
+            i += 1
+        return out
+
+    def remove_reloads(self, lines):
+        """
+        Track what A and D hold within a basic block to drop @X when A is
+        already X, @SP/A=M when A already holds *SP, and D=M when D already
+        equals M
+        """
+        out = []
+        a = None            # ("@", X): A == X, ("*", X): A == RAM[X]
+        d_is_m = None       # the A state at which D == M
+        i = 0
+        while i < len(lines):
+            line = lines[i]
+            if is_comment(line):
+                out.append(line)
+            elif is_label(line):
+                a = d_is_m = None
+                out.append(line)
+            elif line.startswith("@"):
+                symbol = line[1:]
+                following = self._code(lines, i + 1, 1)
+                if a == ("*", symbol) and self._matches(lines, following, ["A=M"]):
+                    out += [lines[k] for k in range(i + 1, following[0]) if is_comment(lines[k])]
+                    i = following[0] + 1
+                    continue
+                if a != ("@", symbol):
+                    a = ("@", symbol)
+                    out.append(line)
+            else:
+                dest, comp, jump = split_c_command(line)
+                if dest == "D" and comp == "M" and not jump and a is not None and d_is_m == a:
+                    i += 1
+                    continue
+                out.append(line)
+                if "A" in dest:
+                    if dest == "A" and comp == "M" and a is not None and a[0] == "@":
+                        a = ("*", a[1])
+                    else:
+                        a = None
+                    d_is_m = None
+                elif "M" in dest:
+                    d_is_m = a if comp == "D" or "D" in dest else None
+                elif "D" in dest:
+                    d_is_m = a if comp == "M" else None
+                if jump == "JMP":
+                    a = d_is_m = None
+            i += 1
+        return out
+
+    def remove_unreachable(self, lines):
+        """
+        Drop code between an unconditional jump and the next label
+        """
+        out = []
+        reachable = True
+        for line in lines:
+            if is_label(line):
+                reachable = True
+            if reachable or is_comment(line):
+                out.append(line)
+            if not is_comment(line) and not is_label(line) and not line.startswith("@"):
+                if split_c_command(line)[2] == "JMP":
+                    reachable = False
+        return out
+
+    def optimize(self):
+        lines = self.lines
+        while True:
+            size = len(lines)
+            lines = self.remove_unreachable(lines)
+            lines = self.remove_sp_pairs(lines)
+            lines = self.fuse_push_pop(lines)
+            lines = self.remove_reloads(lines)
+            if len(lines) == size:
+                return lines
+
+
+def path_length(lines, taken):
+    """
+    Count the instructions executed running straight through a snippet,
+    following jumps to labels inside it and taking (or not) every
+    conditional jump, until control leaves the snippet
+    """
+    labels = {}
+    code = []
+    for line in lines:
+        if is_label(line):
+            labels[line[1:-1]] = len(code)
+        elif not is_comment(line):
+            code.append(line)
+    executed, pc, a = 0, 0, None
+    while pc < len(code):
+        line = code[pc]
+        executed += 1
+        pc += 1
+        if line.startswith("@"):
+            a = line[1:]
+            continue
+        dest, comp, jump = split_c_command(line)
+        if jump and (jump == "JMP" or taken):
+            if a not in labels:
+                break
+            pc = labels[a]
+        if "A" in dest:
+            a = None
+    return executed
+
+
+def compare_modes(inputs):
+    """
+    Print the ROM size of each program in inline and shared mode, and the
+    instructions executed per call/return/compare in each mode
+    """
+    from CodeWriter import CodeWriter
+    from VMTranslator import Parser
+
+    print(f"{'program':<20} {'inline ROM bytes':>16} {'shared ROM bytes':>16}")
+    for input in inputs:
+        sizes = [count_instructions(Parser(input, shared=shared).translate()) * 2 for shared in (False, True)]
+        print(f"{os.path.basename(os.path.normpath(input)):<20} {sizes[0]:>16} {sizes[1]:>16}")
+
+    routines = CodeWriter(instruction="routines", basename=None, functionname=None).get_lines()
+    print(f"{'operation':<20} {'inline executed':>16} {'shared executed':>16}")
+    for command in ("call Foo.bar 2", "return", "lt", "eq"):
+        for taken in ((False,) if command[0] in "cr" else (True, False)):
+            counts = []
+            for shared in (False, True):
+                lines = CodeWriter(instruction=command, basename="Foo", functionname="Foo.baz", shared=shared).get_lines()
+                counts.append(path_length(lines + (routines if shared else []), taken))
+            label = command if command[0] in "cr" else f"{command} ({'true' if taken else 'false'})"
+            print(f"{label:<20} {counts[0]:>16} {counts[1]:>16}")
+
+
+def report(directories):
+    """
+    Translate every VM program under the given directories with and
+    without the peephole pass and print the ROM size and the instructions
+    executed to the end of the program's test script (or its halt) before
+    and after
+    """
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Benchmarks"))
+    from Benchmarks import dynamic_count
+    from VMTranslator import Parser, vm2hack
+
+    print(f"{'program':<20} {'ROM':>6} {'optimized':>10} {'saved':>6} {'cycles':>8} {'optimized':>10} {'saved':>6}")
+    for directory in directories:
+        for root, dirs, files in sorted(os.walk(directory)):
+            vms = [f for f in files if f.endswith(".vm")]
+            if not vms:
+                continue
+            source = os.path.join(root, vms[0]) if len(vms) == 1 else root
+            lines = Parser(source).translate()
+            before, after = count_instructions(lines), count_instructions(Peephole(lines).optimize())
+            cycles = [dynamic_count(vm2hack(source, optimize=optimize), root) for optimize in (False, True)]
+            print(f"{os.path.basename(root):<20} {before:>6} {after:>10} {before - after:>6} "
+                  f"{cycles[0]:>8} {cycles[1]:>10} {cycles[0] - cycles[1]:>6}")
+
+
+if __name__ == "__main__":
+    here = os.path.dirname(os.path.abspath(__file__))
+    projects = os.path.dirname(here)
+    report(sys.argv[1:] or [os.path.join(projects, "07"), os.path.join(projects, "08")])
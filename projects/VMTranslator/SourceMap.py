@@ -0,0 +1,129 @@
+"""
+Source map from ROM address back to the VM command it was translated
+from. CodeWriter starts every command's code with a //<vm command>
+comment; the assembler records the address each comment lands on
+(Assembler(marks=True)) and the translator pairs those marks with the
+file and function each command came from.
+"""
+import os
+from bisect import bisect_right
+
+
+def code_origins(code, filename):
+    """
+    (file, function, command) for every comment tuple in one file's
+    translation, in order
+    """
+    origins = []
+    function = None
+    for instruction in code:
+        if instruction[0] == "//":
+            command = instruction[1]
+            if command.startswith("function"):
+                function = command.split()[1]
+            origins.append((filename, function, command))
+    return origins
+
+
+def origin_name(origin):
+    """
+    The function a command belongs to; code outside any function is named
+    after its file, and the translator's own code (bootstrap, halt loop,
+    shared routines) after its command
+    """
+    file, function, command = origin
+    if function:
+        return function
+    if file:
+        return os.path.splitext(file)[0]
+    return command
+
+
+def command_type(command):
+    """
+    The translation template a command uses: push/pop keep their segment,
+    everything else is its first word ('call', 'return', 'add', '$$CALL')
+    """
+    parts = command.split()
+    if parts[0] in ("push", "pop"):
+        return " ".join(parts[:2])
+    return parts[0]
+
+
+class SourceMap(object):
+    def __init__(self, starts, origins, size):
+        self.starts = starts
+        self.origins = origins
+        self.size = size
+
+    @classmethod
+    def from_marks(cls, marks, origins, size):
+        """
+        Pair the assembler's (address, comment) marks with their origins.
+        Commands that produce no code (labels) share their address with
+        the next command and are dropped
+        """
+        if len(marks) != len(origins):
+            raise Exception(f"{len(marks)} marks for {len(origins)} VM commands")
+        starts, kept = [], []
+        for (address, _), origin in zip(marks, origins):
+            if starts and starts[-1] == address:
+                kept[-1] = origin
+            else:
+                starts.append(address)
+                kept.append(origin)
+        return cls(starts, kept, size)
+
+    @classmethod
+    def from_assembly_marks(cls, marks, size):
+        """
+        Best effort map for an .asm file translated earlier: the functions
+        are followed through the comments, and the file is taken to be the
+        function's class
+        """
+        origins = []
+        for origin in code_origins([("//", text) for _, text in marks], None):
+            _, function, command = origin
+            origins.append((function.split(".")[0] if function else None, function, command))
+        return cls.from_marks(marks, origins, size)
+
+    def index(self, address):
+        return bisect_right(self.starts, address) - 1
+
+    def lookup(self, address):
+        """
+        (file, function, command) of the code at a ROM address, or None
+        """
+        if not 0 <= address < self.size:
+            return None
+        i = self.index(address)
+        return self.origins[i] if i >= 0 else None
+
+    def ranges(self):
+        """
+        (start, end, origin) for every command that produced code
+        """
+        ends = self.starts[1:] + [self.size]
+        return zip(self.starts, ends, self.origins)
+
+    def write(self, filename):
+        with open(filename, "w") as f:
+            f.write(f"{self.size}\n")
+            for start, origin in zip(self.starts, self.origins):
+                file, function, command = origin
+                f.write(f"{start}\t{file or ''}\t{function or ''}\t{command}\n")
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            size = int(f.readline())
+            starts, origins = [], []
+            for line in f:
+                start, file, function, command = line.rstrip("\n").split("\t")
+                starts.append(int(start))
+                origins.append((file or None, function or None, command))
+        return cls(starts, origins, size)
+
+
+def map_filename(rom_filename):
+    return f"{os.path.splitext(rom_filename)[0]}.map"
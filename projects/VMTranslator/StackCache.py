@@ -0,0 +1,464 @@
+"""
+Stack caching for the VM translator (--registers). Within a basic block
+the top of the VM stack is kept out of RAM: constants are carried as
+compile time values and folded, the value on top lives in D, and values
+under it are spilled to R5-R12 instead of being pushed. Comparisons
+leave x-y in D and only turn it into true/false if something other than
+an if-goto (or a not, which flips the jump) consumes them. With
+--intrinsics, OS arithmetic on constants is folded too, and Math.abs and
+multiplication by 2**k work on the value in D.
+
+The cached values are written to the real stack before every label,
+goto, call, function and return, and at the end of the file, so block
+boundaries always see the stack CodeWriter's code expects.
+
+R5-R12 are the temp segment. They are only used in functions that never
+touch temp, and only when no function in the program may read a temp
+value across a call (see keeps_temp_across_calls), since a callee
+caching in them would overwrite it. The Jack compiler only uses temp
+between a pop and the push or pop pointer right after it, so its output
+keeps the registers.
+"""
+from CodeWriter import CommandWriter
+from Commands import NEG, NOT, PUSH, POP, LABEL, IF_GOTO, FUNCTION, CALL, TEMP, COMMANDS, SEGMENTS
+from Intrinsics import IntrinsicCall, fold as fold_intrinsic, power_of_two
+
+SEGMENT_POINTERS = {"local": "LCL", "argument": "ARG", "this": "THIS", "that": "THAT"}
+REGISTERS = [f"R{i}" for i in range(5, 13)]
+MAX_INLINE_OFFSET = 3
+INVERSE_JUMPS = {"JLT": "JGE", "JGE": "JLT", "JGT": "JLE", "JLE": "JGT", "JEQ": "JNE", "JNE": "JEQ"}
+COMPARE_JUMPS = {"lt": "JLT", "gt": "JGT", "eq": "JEQ"}
+# Comp with x in D and y in A, and with y in D and x in A
+COMPUTATIONS = {
+    "add": ("D+A", "D+A"),
+    "sub": ("D-A", "A-D"),
+    "and": ("D&A", "D&A"),
+    "or": ("D|A", "D|A"),
+}
+SMALL_CONSTANTS = {0: "0", 1: "1", 0xFFFF: "-1"}
+
+
+def signed(value):
+    return value - 0x10000 if value & 0x8000 else value
+
+
+def fold(operation, x, y):
+    """
+    Constant result of a binary operation; comparisons test x-y like the
+    generated code does, overflow included
+    """
+    if operation == "add":
+        return (x + y) & 0xFFFF
+    if operation == "sub":
+        return (x - y) & 0xFFFF
+    if operation == "and":
+        return x & y
+    if operation == "or":
+        return x | y
+    difference = signed((x - y) & 0xFFFF)
+    true = {"lt": difference < 0, "gt": difference > 0, "eq": difference == 0}[operation]
+    return 0xFFFF if true else 0
+
+
+def functions_using_temp(commands):
+    functions = set()
+    functionname = "null"
+    for command in commands:
+        if command.opcode == FUNCTION:
+            functionname = command.name
+        elif (command.opcode == PUSH or command.opcode == POP) and command.segment == TEMP:
+            functions.add(functionname)
+    return functions
+
+
+def keeps_temp_across_calls(commands):
+    """
+    Whether a push temp may read a value not popped to it since the last
+    call, label or function entry, so one set before a call, or by a
+    function that returned, or on another path
+    """
+    written = set()
+    for command in commands:
+        opcode = command.opcode
+        if opcode == CALL or opcode == LABEL or opcode == FUNCTION:
+            written = set()
+        elif command.segment == TEMP:
+            if opcode == POP:
+                written.add(command.index)
+            elif command.index not in written:
+                return True
+    return False
+
+
+class StackCache(CommandWriter):
+    """
+    Translates one file. Stack entries not yet in RAM are tuples:
+    ("const", value), ("reg", register), ("D",), ("cmp", jump) for x-y
+    in D, and ("real",) for a value taken off the real stack on demand
+    """
+    def __init__(self, basename, shared=False, counters=None, intrinsics=(), temp_registers=True):
+        super().__init__(basename, shared=shared, counters=counters)
+        self.intrinsics = intrinsics
+        self.registers = list(REGISTERS) if temp_registers else []
+        self.stack = []
+        self.free = []
+
+    def translate(self, commands):
+        temp_functions = functions_using_temp(commands)
+        self.free = [] if self.functionname in temp_functions else list(self.registers)
+        for command in commands:
+            opcode = command.opcode
+            self.code.append(("//", command.text))
+            if opcode == PUSH:
+                self._push_segment(SEGMENTS[command.segment], command.index)
+            elif opcode == POP and self.stack:
+                self._pop_segment(SEGMENTS[command.segment], command.index)
+            elif opcode in self.BINARY or opcode in self.COMPARISONS:
+                self._binary(COMMANDS[opcode])
+            elif opcode == NEG or opcode == NOT:
+                self._unary(COMMANDS[opcode])
+            elif opcode == IF_GOTO and self.stack:
+                self._if_goto(self.functionname, command.name)
+            elif opcode == CALL and command.name in self.intrinsics:
+                self._intrinsic(command.name, command.text)
+            else:
+                self.flush()
+                if opcode == FUNCTION:
+                    self.free = [] if command.name in temp_functions else list(self.registers)
+                self.dispatch[opcode](command)
+        self.flush()
+        return self.code
+
+    def _d_index(self):
+        for i, entry in enumerate(self.stack):
+            if entry[0] in ("D", "cmp"):
+                return i
+        return None
+
+    def _release(self, entry):
+        if entry[0] == "reg" and entry[1] in REGISTERS:
+            self.free.append(entry[1])
+
+    def _take(self):
+        return self.stack.pop() if self.stack else ("real",)
+
+    def _boolean(self, jump):
+        """
+        D = -1 if D jump 0 else 0
+        """
+        n = next(self.cmp_label)
+        true_label = self._unique_label(f"TRUE{n}")
+        done_label = self._unique_label(f"DONE{n}")
+        self._a_command(true_label)
+        self._c_command("D", jump=jump)
+        self._c_command(dest="D", computation="0")
+        self._a_command(done_label)
+        self._c_command("0", jump="JMP")
+        self._label(true_label)
+        self._c_command(dest="D", computation="-1")
+        self._label(done_label)
+
+    def _to_d(self, entry):
+        """
+        Put an entry's value in D. D must not hold any other live value
+        """
+        kind = entry[0]
+        if kind == "const":
+            value = entry[1]
+            if value in SMALL_CONSTANTS:
+                self._c_command(dest="D", computation=SMALL_CONSTANTS[value])
+            elif value <= 0x7FFF:
+                self._a_command(str(value))
+                self._c_command(dest="D", computation="A")
+            else:
+                self._a_command(str(value ^ 0xFFFF))
+                self._c_command(dest="D", computation="!A")
+        elif kind == "reg":
+            self._a_command(entry[1])
+            self._c_command(dest="D", computation="M")
+        elif kind == "real":
+            self._a_command("SP")
+            self._c_command(dest="AM", computation="M-1")
+            self._c_command(dest="D", computation="M")
+        elif kind == "cmp":
+            self._boolean(entry[1])
+
+    def _operand(self, entry):
+        """
+        Make an entry's value addressable without touching D; returns the
+        register ("A" or "M") it can be read from
+        """
+        kind = entry[0]
+        if kind == "const":
+            value = entry[1]
+            if value <= 0x7FFF:
+                self._a_command(str(value))
+            else:
+                self._a_command(str(value ^ 0xFFFF))
+                self._c_command(dest="A", computation="!A")
+            return "A"
+        if kind == "reg":
+            self._a_command(entry[1])
+            return "M"
+        self._a_command("SP")
+        self._c_command(dest="AM", computation="M-1")
+        return "M"
+
+    def _free_d(self):
+        """
+        Move whatever cached stack value is in D out of it, to a register
+        or, when there are none left, with the rest of the stack to RAM
+        """
+        i = self._d_index()
+        if i is None:
+            return
+        if not self.free:
+            self.flush()
+            return
+        entry = self.stack[i]
+        if entry[0] == "cmp":
+            self._boolean(entry[1])
+        register = self.free.pop()
+        self._a_command(register)
+        self._c_command(dest="M", computation="D")
+        self.stack[i] = ("reg", register)
+
+    def flush(self):
+        """
+        Write the cached entries to the real stack
+        """
+        if not self.stack:
+            return
+        entries = self.stack
+        self.stack = []
+        order = list(range(len(entries)))
+        i = next((i for i, entry in enumerate(entries) if entry[0] in ("D", "cmp")), None)
+        if i is not None:
+            order.remove(i)
+            order.insert(0, i)
+        for i in order:
+            entry = entries[i]
+            if entry[0] == "const" and entry[1] in SMALL_CONSTANTS:
+                value = SMALL_CONSTANTS[entry[1]]
+            else:
+                self._to_d(entry)
+                value = "D"
+            self._a_command("SP")
+            if i == 0:
+                self._c_command(dest="A", computation="M")
+            else:
+                self._c_command(dest="A", computation="M+1")
+                for _ in range(i - 1):
+                    self._c_command(dest="A", computation="A+1")
+            self._c_command(dest="M", computation=value)
+            self._release(entry)
+        self._a_command("SP")
+        if len(entries) <= 2:
+            for _ in entries:
+                self._c_command(dest="M", computation="M+1")
+        else:
+            self._c_command(dest="D", computation="M")
+            self._a_command(str(len(entries)))
+            self._c_command(dest="D", computation="D+A")
+            self._a_command("SP")
+            self._c_command(dest="M", computation="D")
+
+    def _segment_address(self, segment, index):
+        """
+        Point A at a segment entry, when that takes no D
+        """
+        if segment == "temp":
+            self._a_command(str(5 + index))
+        elif segment == "static":
+            self._a_command(f"{self.basename}.{index}")
+        elif segment == "pointer":
+            self._a_command("THIS" if index == 0 else "THAT")
+        elif index <= MAX_INLINE_OFFSET:
+            self._a_command(SEGMENT_POINTERS[segment])
+            if index == 0:
+                self._c_command(dest="A", computation="M")
+            else:
+                self._c_command(dest="A", computation="M+1")
+                for _ in range(index - 1):
+                    self._c_command(dest="A", computation="A+1")
+        else:
+            return False
+        return True
+
+    def _push_segment(self, segment, index):
+        if segment == "constant":
+            self.stack.append(("const", index))
+            return
+        if segment not in SEGMENT_POINTERS and segment not in ("temp", "static", "pointer"):
+            raise Exception(f"Don't recognise push type {segment}")
+        self._free_d()
+        if not self._segment_address(segment, index):
+            self._a_command(SEGMENT_POINTERS[segment])
+            self._c_command(dest="D", computation="M")
+            self._a_command(str(index))
+            self._c_command(dest="A", computation="D+A")
+        self._c_command(dest="D", computation="M")
+        self.stack.append(("D",))
+
+    def _pop_segment(self, segment, index):
+        if segment not in SEGMENT_POINTERS and segment not in ("temp", "static", "pointer"):
+            raise Exception(f"Don't recognise pop type {segment}")
+        entry = self.stack.pop()
+        large_offset = segment in SEGMENT_POINTERS and index > MAX_INLINE_OFFSET
+        small_constant = entry[0] == "const" and entry[1] in SMALL_CONSTANTS
+        if entry[0] not in ("D", "cmp") and (large_offset or not small_constant):
+            self._free_d()
+        if large_offset:
+            if entry[0] in ("D", "cmp"):
+                self._to_d(entry)
+                self._a_command("R14")
+                self._c_command(dest="M", computation="D")
+                entry = ("reg", "R14")
+            self._a_command(SEGMENT_POINTERS[segment])
+            self._c_command(dest="D", computation="M")
+            self._a_command(str(index))
+            self._c_command(dest="D", computation="D+A")
+            self._a_command("R13")
+            self._c_command(dest="M", computation="D")
+            self._to_d(entry)
+            self._a_command("R13")
+            self._c_command(dest="A", computation="M")
+            self._c_command(dest="M", computation="D")
+        elif small_constant:
+            self._segment_address(segment, index)
+            self._c_command(dest="M", computation=SMALL_CONSTANTS[entry[1]])
+        else:
+            self._to_d(entry)
+            self._segment_address(segment, index)
+            self._c_command(dest="M", computation="D")
+        self._release(entry)
+
+    def _binary(self, operation):
+        y = self._take()
+        x = self._take()
+        if x[0] == "const" and y[0] == "const":
+            self.stack.append(("const", fold(operation, x[1], y[1])))
+            return
+        if y[0] == "real" or x[0] not in ("D", "cmp") and y[0] not in ("D", "cmp"):
+            # y first: if both are on the real stack, y is the one on top
+            self._free_d()
+            if y[0] == "real":
+                self._to_d(y)
+                y = ("D",)
+            else:
+                self._to_d(x)
+                x = ("D",)
+        if x[0] == "cmp":
+            self._boolean(x[1])
+        if y[0] == "cmp":
+            self._boolean(y[1])
+        d_is_x = x[0] in ("D", "cmp")
+        source = self._operand(y if d_is_x else x)
+        if operation in COMPARE_JUMPS:
+            computation = "D-A" if d_is_x else "A-D"
+        else:
+            computation = COMPUTATIONS[operation][0 if d_is_x else 1]
+        self._c_command(dest="D", computation=computation.replace("A", source))
+        self._release(x)
+        self._release(y)
+        self.stack.append(("cmp", COMPARE_JUMPS[operation]) if operation in COMPARE_JUMPS else ("D",))
+
+    def _unary(self, operation):
+        entry = self._take()
+        kind = entry[0]
+        if kind == "const":
+            value = (-entry[1]) & 0xFFFF if operation == "neg" else entry[1] ^ 0xFFFF
+            self.stack.append(("const", value))
+            return
+        if kind == "cmp" and operation == "not":
+            self.stack.append(("cmp", INVERSE_JUMPS[entry[1]]))
+            return
+        computation = "-" if operation == "neg" else "!"
+        if kind == "real":
+            self._a_command("SP")
+            self._c_command(dest="A", computation="M-1")
+            self._c_command(dest="M", computation=f"{computation}M")
+            return
+        if kind == "reg":
+            self._free_d()
+            self._a_command(entry[1])
+            self._c_command(dest="D", computation=f"{computation}M")
+            self._release(entry)
+        else:
+            self._to_d(entry)
+            self._c_command(dest="D", computation=f"{computation}D")
+        self.stack.append(("D",))
+
+    def _if_goto(self, functionname, label):
+        entry = self.stack.pop()
+        target = self._create_label(self.basename, functionname, label)
+        if entry[0] == "const":
+            self.flush()
+            if entry[1]:
+                self._goto(target)
+            return
+        jump = entry[1] if entry[0] == "cmp" else "JNE"
+        if self.stack:
+            if entry[0] in ("D", "cmp"):
+                self._to_d(entry)
+                self._a_command("R14")
+                self._c_command(dest="M", computation="D")
+                entry, jump = ("reg", "R14"), "JNE"
+            self.flush()
+        if entry[0] != "cmp":
+            self._to_d(entry)
+        self._release(entry)
+        self._a_command(target)
+        self._c_command("D", jump=jump)
+
+
+    def _intrinsic(self, name, instruction):
+        """
+        Fold an intrinsic on constants, do abs and multiplication by 2**k
+        on the value in D, and call the shared routine for the rest
+        """
+        arity = 1 if name == "Math.abs" else 2
+        arguments = self.stack[-arity:]
+        if len(arguments) == arity and all(entry[0] == "const" for entry in arguments):
+            value = fold_intrinsic(name, [entry[1] for entry in arguments])
+            if value is not None:
+                del self.stack[-arity:]
+                self.stack.append(("const", value))
+                return
+        shift = None
+        if name == "Math.multiply":
+            for i in (-1, -2):
+                if len(self.stack) >= -i and self.stack[i][0] == "const":
+                    shift = power_of_two(self.stack[i][1])
+                    if shift is not None:
+                        del self.stack[i]
+                        break
+        if name != "Math.abs" and shift is None:
+            self.flush()
+            call = IntrinsicCall(instruction, name, self.basename, self.counters)
+            call.write_assembly()
+            self.code += call.code[1:]
+            return
+        entry = self._take()
+        if entry[0] not in ("D", "cmp"):
+            self._free_d()
+        self._to_d(entry)
+        self._release(entry)
+        if shift is None:
+            label = self._unique_label(f"ABS{next(self.cmp_label)}")
+            self._a_command(label)
+            self._c_command("D", jump="JGE")
+            self._c_command(dest="D", computation="-D")
+            self._label(label)
+        for _ in range(shift or 0):
+            self._c_command(dest="A", computation="D")
+            self._c_command(dest="D", computation="D+A")
+        self.stack.append(("D",))
+
+
+def translate_cached(commands, base, shared=False, intrinsics=(), temp_registers=True):
+    """
+    Translate the commands of one file with stack caching, spilling to
+    R5-R12 only with temp_registers
+    """
+    return StackCache(base, shared=shared, intrinsics=intrinsics, temp_registers=temp_registers).translate(commands)
@@ -1,41 +1,300 @@
 import sys
 import os 
-from CodeWriter import CodeWriter
+import argparse
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from CodeWriter import CodeWriter, CommandWriter, Counters, code_to_lines, lines_to_code
+from assembler import Assembler
+from outliner import outline_report
+from rom import FORMATS, write_rom
+from Optimizer import Peephole, compare_modes
+from SourceMap import SourceMap, code_origins, map_filename
+from StackCache import keeps_temp_across_calls, translate_cached
+from CallGraph import CallGraph, rom_report
+from Commands import parse_commands
+from Intrinsics import INTRINSICS, lower_intrinsic, routines_code
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _translator_version():
+    """
+    Hash of the translator source, so cached fragments are invalidated
+    whenever code generation changes
+    """
+    digest = hashlib.sha256()
+    for module in ("Commands.py", "CodeWriter.py", "StackCache.py", "Intrinsics.py", "VMTranslator.py"):
+        with open(os.path.join(HERE, module), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+TRANSLATOR_VERSION = _translator_version()
+
+
+def translate_code(source, base, shared=False, registers=False, intrinsics=(), temp_registers=True):
+    """
+    Translate the text of one .vm file into CodeWriter instruction tuples.
+    Labels only depend on this file, so the result can be cached and
+    concatenated with other files' fragments. temp_registers lets stack
+    caching use R5-R12, which is only safe if no file in the program keeps
+    temp values across calls
+    """
+    commands = parse_commands(source, f"{base}.vm")
+    if registers:
+        return translate_cached(commands, base, shared, intrinsics, temp_registers)
+
+    writer = CommandWriter(base, shared=shared)
+    if not intrinsics:
+        return writer.translate(commands)
+    for i, command in enumerate(commands):
+        lowered = lower_intrinsic(commands, i, base, intrinsics, writer.counters)
+        if lowered is None:
+            writer.write(command)
+        else:
+            writer.code += lowered
+    return writer.code
+
+
+def translate_source(source, base, shared=False, registers=False, intrinsics=(), temp_registers=True):
+    return code_to_lines(translate_code(source, base, shared, registers, intrinsics, temp_registers))
+
+
+class FragmentCache(object):
+    """
+    Translated .vm files stored on disk, keyed by a hash of the file
+    contents, its name, the translation modes and the translator version
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(source, base, shared, registers=False, intrinsics=(), temp_registers=True):
+        digest = hashlib.sha256(f"{TRANSLATOR_VERSION}\0{base}\0{int(shared)}\0{int(registers)}\0"
+                                f"{','.join(sorted(intrinsics))}\0{int(temp_registers)}\0".encode())
+        digest.update(source.encode())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.asm")
+
+    def get(self, key):
+        try:
+            with open(self._path(key)) as f:
+                return f.read().splitlines()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, assembly):
+        path = self._path(key)
+        with open(f"{path}.{os.getpid()}.tmp", "w") as f:
+            f.writelines(f"{l}\n" for l in assembly)
+        os.replace(f"{path}.{os.getpid()}.tmp", path)
+
 
 class Parser(object): 
-    def __init__(self, input):
+    def __init__(self, input, optimize=False, shared=False, jobs=1, cache=None, registers=False, prune=False,
+                 intrinsics=()):
+        self.optimize = optimize
+        self.shared = shared
+        self.registers = registers
+        self.intrinsics = tuple(intrinsics)
+        self.prune = prune
+        self.removed = []
+        self.undefined = []
+        self.jobs = jobs
+        self.cache = FragmentCache(cache) if cache else None
+        self.translated = 0
+        self.origins = []
         if os.path.isfile(input):
             self.filenames = [input]
             self.asm = f"{os.path.splitext(input)[0]}.asm"
         elif os.path.isdir(input):
-            self.filenames = [os.path.join(input, f) for f in os.listdir(input) if os.path.splitext(f)[1] == ".vm"]
+            self.filenames = sorted(os.path.join(input, f) for f in os.listdir(input) if os.path.splitext(f)[1] == ".vm")
             self.asm = os.path.join(input, f"{os.path.basename(os.path.normpath(input))}.asm")
         else: 
             raise Exception(f"Input {input} is neither file nor directory")
 
+    def _read_sources(self):
+        """
+        The text of every file; with prune, only the functions reachable
+        from Sys.init are kept and files left empty are dropped from
+        self.filenames
+        """
+        sources = {}
+        for filename in self.filenames:
+            with open(filename) as f:
+                sources[filename] = f.read()
+        if self.prune and len(self.filenames) > 1:
+            graph = CallGraph(sources, ignore=self.intrinsics)
+            self.removed = sorted(set(graph.functions) - set(graph.reachable()))
+            self.undefined = graph.undefined()
+            sources = graph.prune()
+            self.filenames = [filename for filename in self.filenames if filename in sources]
+        return sources
+
+    def _translate_files(self):
+        """
+        Translate every file to instruction tuples, taking fragments from
+        the cache where possible and translating the rest in a process pool
+        """
+        sources = self._read_sources()
+        temp_registers = not (self.registers and any(
+            keeps_temp_across_calls(parse_commands(sources[filename], filename)) for filename in self.filenames))
+        fragments = [None] * len(self.filenames)
+        todo = []
+        for i, filename in enumerate(self.filenames):
+            source = sources[filename]
+            base = os.path.basename(os.path.splitext(filename)[0])
+            key = self.cache.key(source, base, self.shared, self.registers, self.intrinsics,
+                                 temp_registers) if self.cache else None
+            cached = self.cache.get(key) if key is not None else None
+            if cached is not None:
+                fragments[i] = lines_to_code(cached)
+            else:
+                todo.append((i, key, source, base))
+
+        if self.jobs > 1 and len(todo) > 1:
+            with ProcessPoolExecutor(max_workers=self.jobs) as pool:
+                results = list(pool.map(translate_code, *zip(*[(source, base, self.shared, self.registers,
+                                                                  self.intrinsics, temp_registers)
+                                                                 for _, _, source, base in todo])))
+        else:
+            results = [translate_code(source, base, self.shared, self.registers, self.intrinsics, temp_registers)
+                       for _, _, source, base in todo]
+
+        for (i, key, _, _), code in zip(todo, results):
+            fragments[i] = code
+            if key is not None:
+                self.cache.put(key, code_to_lines(code))
+        self.translated = len(todo)
+        return fragments
+
+    def translate_code(self):
+        """
+        Translate every file, leaving the (file, function, command) of each
+        comment tuple in self.origins for the source map
+        """
+        parts = []
+        if len(self.filenames) > 1:
+            init = CodeWriter(instruction="init", basename=None, functionname=None, shared=self.shared,
+                              counters=Counters())
+            parts.append((None, init.get_code()))
+        for filename, fragment in zip(self.filenames, self._translate_files()):
+            parts.append((os.path.basename(filename), fragment))
+
+        end = CodeWriter(instruction="end", basename=None, functionname=None)
+        parts.append((None, end.get_code()))
+        if self.shared:
+            routines = CodeWriter(instruction="routines", basename=None, functionname=None)
+            parts.append((None, routines.get_code()))
+        if self.intrinsics:
+            parts.append((None, routines_code(self.intrinsics, [i for _, fragment in parts for i in fragment])))
+
+        code = []
+        self.origins = []
+        for filename, fragment in parts:
+            code += fragment
+            self.origins += code_origins(fragment, filename)
+        return code
+
+    def translate(self):
+        return code_to_lines(self.translate_code())
+
     def parse(self):
+        assembly = self.translate()
+        if self.optimize:
+            assembly = Peephole(assembly).optimize()
         with open(self.asm, "w+") as f:
-            if len(self.filenames) > 1:
-                init = CodeWriter(instruction="init", basename=None, functionname=None)
-                f.writelines(f"{l}\n" for l in init.get_lines())
-            for filename in self.filenames:
-                functionname = "null"
-                lines_no_comments = map(lambda x: x.split("//")[0], open(filename).readlines())
-                lines = list(filter(lambda x: x != "", map(lambda x: x.strip(" \n"), lines_no_comments)))
-                base = os.path.basename(os.path.splitext(filename)[0])
-
-                for instruction in lines:
-                    if instruction.startswith("function"):
-                        functionname = instruction.split()[1]
-            
-                    code_writer = CodeWriter(instruction=instruction, basename=base, functionname=functionname)
-                    f.writelines(f"{l}\n" for l in code_writer.get_lines())
-
-            end = CodeWriter(instruction="end", basename=None, functionname=None)
-            f.writelines(f"{l}\n" for l in end.get_lines())
-
-if len(sys.argv) < 2:
-    raise Exception("Expected filename or directory in command line argument")
-parser = Parser(sys.argv[1])
-parser.parse()
+            f.writelines(f"{l}\n" for l in assembly)
+
+
+def vm2hack(input, optimize=False, shared=False, jobs=1, cache=None, write_asm=False, source_map=False,
+            registers=False, prune=False, intrinsics=(), outline=None):
+    """
+    Translate and assemble in one process, returning the ROM words, or
+    (words, SourceMap) with source_map=True. CodeWriter's instruction
+    tuples go straight into the assembler; text is only produced for the
+    peephole pass (which works on lines) and when write_asm asks for the
+    .asm as debug output. With outline set to a speed, repeated sequences
+    are moved into subroutines (see outliner.Outliner) before assembly
+    """
+    parser = Parser(input, optimize=optimize, shared=shared, jobs=jobs, cache=cache, registers=registers,
+                    prune=prune, intrinsics=intrinsics)
+    code = parser.translate_code()
+    assembler = Assembler(marks=source_map)
+    if optimize:
+        code = lines_to_code(Peephole(code_to_lines(code)).optimize())
+    if outline is not None:
+        code = assembler.outline(code, outline)
+        parser.origins += [(None, None, name) for name in assembler.outliner.routines]
+    if write_asm:
+        with open(parser.asm, "w+") as f:
+            f.writelines(f"{l}\n" for l in code_to_lines(code))
+    assembler.feed_code(code)
+    words = assembler.finish()
+    if source_map:
+        return words, SourceMap.from_marks(assembler.marks, parser.origins, len(words))
+    return words
+
 
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Translate VM code to Hack assembly")
+    argparser.add_argument("input", help=".vm file or directory of .vm files")
+    argparser.add_argument("--optimize", action="store_true", help="run the peephole optimizer over the output")
+    argparser.add_argument("--shared", action="store_true",
+                           help="call shared $$CALL/$$RETURN/$$CMP routines instead of inlining them")
+    argparser.add_argument("--registers", action="store_true",
+                           help="fold constants and cache the top of the stack in D and R5-R12 within basic blocks")
+    argparser.add_argument("--intrinsics", nargs="*", choices=INTRINSICS, metavar="FUNCTION",
+                           help="lower calls to these OS Math functions (all of them when none are named) to "
+                                "inline code and shared routines without a call frame")
+    argparser.add_argument("--prune", action="store_true",
+                           help="leave out functions Sys.init can't reach (directories only)")
+    argparser.add_argument("--jobs", type=int, default=1, help="translate files in a pool of this many processes")
+    argparser.add_argument("--cache", help="directory of cached per-file fragments, reused while a file is unchanged")
+    argparser.add_argument("--hack", action="store_true",
+                           help="assemble in memory and write the ROM instead of the .asm")
+    argparser.add_argument("--format", choices=FORMATS, default="hack", dest="rom_format",
+                           help="ROM format for --hack")
+    argparser.add_argument("--asm", action="store_true", help="with --hack, also write the .asm for debugging")
+    argparser.add_argument("--map", action="store_true",
+                           help="with --hack, also write a .map from ROM address to VM file, function and command")
+    argparser.add_argument("--outline", nargs="?", type=float, const=0.0, metavar="SPEED",
+                           help="with --hack, move repeated instruction sequences into subroutines, charging each "
+                                "call site SPEED words per cycle it adds (default 0: smallest ROM)")
+    argparser.add_argument("--outline-report", action="store_true",
+                           help="report the ROM words left after outlining at a range of speeds")
+    argparser.add_argument("--rom-report", action="store_true",
+                           help="report the ROM words per function, with and without pruning")
+    argparser.add_argument("--compare-modes", action="store_true",
+                           help="report ROM size and per-operation cost of inline against shared mode")
+    args = argparser.parse_args()
+    if args.outline is not None and not args.hack:
+        argparser.error("--outline needs --hack")
+    intrinsics = () if args.intrinsics is None else args.intrinsics or INTRINSICS
+    if args.compare_modes:
+        compare_modes([args.input])
+    elif args.outline_report:
+        code = Parser(args.input, shared=args.shared, registers=args.registers, prune=args.prune,
+                      intrinsics=intrinsics).translate_code()
+        if args.optimize:
+            code = lines_to_code(Peephole(code_to_lines(code)).optimize())
+        outline_report(code)
+    elif args.rom_report:
+        rom_report([Parser(args.input, shared=args.shared, registers=args.registers, prune=prune,
+                           intrinsics=intrinsics) for prune in (False, True)])
+    elif args.hack:
+        words = vm2hack(args.input, optimize=args.optimize, shared=args.shared, jobs=args.jobs, cache=args.cache,
+                        write_asm=args.asm, source_map=args.map, registers=args.registers, prune=args.prune,
+                        intrinsics=intrinsics, outline=args.outline)
+        rom = f"{os.path.splitext(Parser(args.input).asm)[0]}{FORMATS[args.rom_format][0]}"
+        if args.map:
+            words, source_map = words
+            source_map.write(map_filename(rom))
+        write_rom(rom, words, args.rom_format)
+    else:
+        parser = Parser(args.input, optimize=args.optimize, shared=args.shared, jobs=args.jobs, cache=args.cache,
+                        registers=args.registers, prune=args.prune, intrinsics=intrinsics)
+        parser.parse()